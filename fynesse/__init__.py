@@ -1,2 +1,12 @@
-from . import access
-from . import assess
+import importlib
+
+from .config import *
+
+# Submodules pull in heavy dependencies, so they are imported on first use
+__all__ = ["access", "assess", "address", "config"]
+
+
+def __getattr__(name):
+    if name in ("access", "assess", "address"):
+        return importlib.import_module(f".{name}", __name__)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
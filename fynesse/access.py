@@ -1,24 +1,812 @@
 from .config import *
 
 import pymysql
-import requests
+import sqlite3
 import os
+import sys
+import re
+import csv
+import math
+import zlib
+import json
+import time
+import hashlib
+import datetime
 import zipfile
+import queue
+import threading
+import decimal
+import functools
+import itertools
+import collections
+import numpy as np
 import pandas as pd
-import osmnx as ox
+from . import instrument
+from .lazy import lazy_module
+from pymysql.constants import FIELD_TYPE
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+# Only needed for downloads and the parquet store, so imported on first use
+requests = lazy_module("requests")
+pa = lazy_module("pyarrow")
+pc = lazy_module("pyarrow.compute")
+pv = lazy_module("pyarrow.csv")
+ds = lazy_module("pyarrow.dataset")
 
 # This file accesses the data
 
+# Categories of the Land Registry code columns, fixed so streamed chunks share one dtype
+CATEGORIES = {
+    "property_type": ["D", "S", "T", "F", "O"],
+    "tenure_type": ["F", "L", "U"],
+}
+
+# Columns of the per-year prices_coordinates_data csv files, as written by the join, with the
+# names of their pyarrow types
+PRICES_COORDINATES_COLUMNS = [
+    ("price", "int64"),
+    ("date_of_transfer", "date32"),
+    ("postcode", "string"),
+    ("property_type", "string"),
+    ("new_build_flag", "string"),
+    ("tenure_type", "string"),
+    ("locality", "string"),
+    ("town_city", "string"),
+    ("district", "string"),
+    ("county", "string"),
+    ("country", "string"),
+    ("latitude", "float64"),
+    ("longitude", "float64"),
+]
+
+
+def prices_coordinates_schema():
+    """
+    Returns the pyarrow schema of the per-year prices_coordinates_data csv files
+    """
+    return pa.schema(
+        [(name, getattr(pa, type_name)()) for name, type_name in PRICES_COORDINATES_COLUMNS]
+    )
+
+
+# Columns of pp_data in the order of the Land Registry csv files
+PP_COLUMNS = [
+    "transaction_unique_identifier",
+    "price",
+    "date_of_transfer",
+    "postcode",
+    "property_type",
+    "new_build_flag",
+    "tenure_type",
+    "primary_addressable_object_name",
+    "secondary_addressable_object_name",
+    "street",
+    "locality",
+    "town_city",
+    "district",
+    "county",
+    "ppd_category_type",
+    "record_status",
+]
+
+# Columns of prices_coordinates_data copied from pp_data by the join
+PP_PRICES_COORDINATES_COLUMNS = [
+    "price",
+    "date_of_transfer",
+    "postcode",
+    "property_type",
+    "new_build_flag",
+    "tenure_type",
+    "locality",
+    "town_city",
+    "district",
+    "county",
+]
+
+PRICES_COORDINATES_TABLE = """
+CREATE TABLE IF NOT EXISTS `prices_coordinates_data` (
+    `price` int(10) unsigned NOT NULL,
+    `date_of_transfer` date NOT NULL,
+    `postcode` varchar(8) COLLATE utf8_bin NOT NULL,
+    `property_type` varchar(1) COLLATE utf8_bin NOT NULL,
+    `new_build_flag` varchar(1) COLLATE utf8_bin NOT NULL,
+    `tenure_type` varchar(1) COLLATE utf8_bin NOT NULL,
+    `locality` tinytext COLLATE utf8_bin NOT NULL,
+    `town_city` tinytext COLLATE utf8_bin NOT NULL,
+    `district` tinytext COLLATE utf8_bin NOT NULL,
+    `county` tinytext COLLATE utf8_bin NOT NULL,
+    `country` enum('England', 'Wales', 'Scotland', 'Northern Ireland', 'Channel Islands', 'Isle of Man') NOT NULL,
+    `latitude` decimal(11,8) NOT NULL,
+    `longitude` decimal(10,8) NOT NULL,
+    `db_id` bigint(20) unsigned NOT NULL
+  ) DEFAULT CHARSET=utf8 COLLATE=utf8_bin AUTO_INCREMENT=1 ;
+"""
+
+# Side in degrees of the grid cells behind the opt-in spatial index on prices_coordinates_data
+GRID_CELL_SIZE = 0.02
+
+# Cell id of a (latitude, longitude), as used by the grid_cell column
+GRID_CELL_SQL = f"FLOOR((latitude + 90) / {GRID_CELL_SIZE}) * 100000 + FLOOR((longitude + 180) / {GRID_CELL_SIZE})"
+
+# Histogram buckets per unit of log price in the price cube. Quantiles read from the cube are
+# within half a bucket, about 2.5%, of the exact value.
+PRICE_CUBE_RESOLUTION = 20
+
+# Strata for Database.stratified_sample that aren't plain columns
+STRATA = {"year": "YEAR(date_of_transfer)"}
+
+DECIMAL_TYPES = (FIELD_TYPE.DECIMAL, FIELD_TYPE.NEWDECIMAL)
+DATE_TYPES = (FIELD_TYPE.DATE, FIELD_TYPE.NEWDATE, FIELD_TYPE.DATETIME, FIELD_TYPE.TIMESTAMP)
+INTEGER_TYPES = (
+    FIELD_TYPE.TINY,
+    FIELD_TYPE.SHORT,
+    FIELD_TYPE.INT24,
+    FIELD_TYPE.LONG,
+    FIELD_TYPE.LONGLONG,
+)
+
 """Place commands in this file to access the data electronically. Don't remove any missing values, or deal with outliers. Make sure you have legalities correct, both intellectual property and personal data privacy rights. Beyond the legal side also think about the ethical issues around this data. """
 
 
+def column_dtypes(description):
+    """
+    Works out pandas dtypes for the columns of a cursor description: categoricals for the
+    Land Registry code columns, float64 for decimals, datetime64 for dates and int64 for
+    non-null integers. Other columns are left as object.
+    """
+    dtypes = {}
+    for name, type_code, _, _, _, _, null_ok in description:
+        if name in CATEGORIES:
+            dtypes[name] = pd.CategoricalDtype(CATEGORIES[name])
+        elif type_code in DECIMAL_TYPES:
+            dtypes[name] = "float64"
+        elif type_code in DATE_TYPES:
+            dtypes[name] = "datetime64[ns]"
+        elif type_code in INTEGER_TYPES:
+            dtypes[name] = "Int64" if null_ok else "int64"
+        else:
+            dtypes[name] = "object"
+    return dtypes
+
+
+def typed_frame(rows, dtypes):
+    """
+    Builds a DataFrame from row tuples, converting each column straight to its dtype
+    """
+    columns = list(zip(*rows)) if rows else [()] * len(dtypes)
+    data = {}
+    for (name, dtype), values in zip(dtypes.items(), columns):
+        if dtype == "datetime64[ns]":
+            data[name] = pd.to_datetime(pd.Series(values, dtype="object")).astype(dtype)
+        else:
+            data[name] = pd.Series(values, dtype="object").astype(dtype)
+    return pd.DataFrame(data)
+
+
+def quote_identifier(name):
+    """
+    Backtick quotes a table or column name, which can't be a bound argument. Names containing
+    a backtick are rejected rather than escaped, as none of the package's tables need one.
+    """
+    name = str(name)
+    if "`" in name:
+        raise ValueError(f"Identifier {name!r} contains a backtick")
+    return f"`{name}`"
+
+
+def in_clause(column, values):
+    """
+    Returns the sql and arguments for column IN (values)
+    """
+    values = list(values)
+    return f"{column} IN ({', '.join(['%s'] * len(values))})", values
+
+
+def year_range(year):
+    """
+    Returns the arguments for a date range covering one year
+    """
+    return [datetime.date(year, 1, 1), datetime.date(year + 1, 1, 1)]
+
+
+def month_range(month):
+    """
+    Returns the arguments for a date range covering the month starting on the date month
+    """
+    if month.month == 12:
+        return [month, datetime.date(month.year + 1, 1, 1)]
+    return [month, datetime.date(month.year, month.month + 1, 1)]
+
+
+def prices_coordinates_join_sql(year):
+    """
+    Returns the sql and arguments of the pp_data and postcode_data join for one year, with
+    the columns of prices_coordinates_data other than db_id
+    """
+    sql = """
+        SELECT
+        price, date_of_transfer, pp_data.postcode, property_type, new_build_flag, tenure_type, locality, town_city, district, county, country, latitude, longitude
+        FROM pp_data
+        INNER JOIN postcode_data
+        ON pp_data.postcode = postcode_data.postcode
+        WHERE
+            date_of_transfer >= %s AND
+            date_of_transfer < %s
+        """
+    return sql, year_range(year)
+
+
+def _fetch_df(cur):
+    """
+    Returns the rows of an executed cursor as a DataFrame
+    """
+    rows = cur.fetchall()
+    cols = [i[0] for i in cur.description]
+    return pd.DataFrame(rows, columns=cols)
+
+
+def load_data_sql(table, file_name):
+    """
+    Returns the sql and arguments of the LOAD DATA statement for a comma separated file without
+    a header
+    """
+    sql = f"""
+LOAD DATA LOCAL INFILE %s
+INTO TABLE {quote_identifier(table)}
+FIELDS TERMINATED BY ',' OPTIONALLY ENCLOSED by '"'
+LINES STARTING BY '' TERMINATED BY '\n';
+"""
+    return sql, (file_name,)
+
+
+def count_lines(file_name, chunk_size=1 << 20):
+    """
+    Counts the lines of a file, including a last line without a trailing newline
+    """
+    lines = 0
+    last = b"\n"
+    with open(file_name, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            lines += chunk.count(b"\n")
+            last = chunk[-1:]
+    return lines + (last != b"\n")
+
+
+class ConnectionPool:
+    """
+    Bounded pool of connections created on demand by the connect callable.
+
+    Connections are health-checked with a ping (reconnecting if the server dropped them) every
+    time they are borrowed. At most size connections exist at once; further borrowers block until
+    one is returned.
+    """
+
+    def __init__(self, connect, size=4):
+        self.connect = connect
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrows a healthy connection for the duration of the with block
+        """
+        self._slots.acquire()
+        conn = None
+        try:
+            conn, generation = self._checkout()
+            yield conn
+        except pymysql.err.OperationalError:
+            # The link is in an unknown state, so don't hand it to anyone else
+            self._discard(conn)
+            conn = None
+            raise
+        finally:
+            if conn is not None:
+                if generation == self._generation:
+                    self._idle.put((conn, generation))
+                else:
+                    self._discard(conn)
+            self._slots.release()
+
+    def _checkout(self):
+        while True:
+            try:
+                conn, generation = self._idle.get_nowait()
+            except queue.Empty:
+                return self.connect(), self._generation
+            if generation != self._generation:
+                self._discard(conn)
+                continue
+            try:
+                conn.ping(reconnect=True)
+                return conn, generation
+            except pymysql.err.Error:
+                self._discard(conn)
+
+    def _discard(self, conn):
+        if conn is None:
+            return
+        try:
+            conn.close()
+        except pymysql.err.Error:
+            pass
+
+    def reset(self):
+        """
+        Closes all idle connections. Borrowed connections are closed when they are returned.
+        """
+        with self._lock:
+            self._generation += 1
+        while True:
+            try:
+                conn, _ = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            self._discard(conn)
+
+
+class Downloader:
+    """
+    Downloads files over a shared requests.Session using a pool of worker threads.
+
+    Files are streamed in chunks to a .part file next to their destination and renamed into place
+    once complete, so an interrupted download never looks finished. A leftover .part file is
+    resumed with an HTTP Range request. The size and sha256 of every completed file are recorded
+    in a JSON manifest, which is what decides whether a file needs downloading again.
+    """
+
+    def __init__(
+        self,
+        manifest_path="data/manifest.json",
+        max_workers=4,
+        chunk_size=1 << 20,
+        session=None,
+        progress=None,
+        verbose=True,
+    ):
+        self.manifest_path = manifest_path
+        self.max_workers = max_workers
+        self.chunk_size = chunk_size
+        self.session = session or requests.Session()
+        self.progress = progress
+        self.verbose = verbose
+        self._lock = threading.Lock()
+        self.manifest = {}
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as file:
+                self.manifest = json.load(file)
+
+    def _record(self, file_path, url, size, sha256):
+        with self._lock:
+            self.manifest[file_path] = {"url": url, "size": size, "sha256": sha256}
+            os.makedirs(os.path.dirname(self.manifest_path) or ".", exist_ok=True)
+            with open(f"{self.manifest_path}.part", "w") as file:
+                json.dump(self.manifest, file, indent=2, sort_keys=True)
+            os.replace(f"{self.manifest_path}.part", self.manifest_path)
+
+    def is_complete(self, file_path, verify=False):
+        """
+        Checks file_path against its manifest entry, by size or, if verify, by sha256
+        """
+        entry = self.manifest.get(file_path)
+        if entry is None or not os.path.exists(file_path):
+            return False
+        if os.path.getsize(file_path) != entry["size"]:
+            return False
+        return not verify or file_sha256(file_path) == entry["sha256"]
+
+    def _adopt(self, url, file_path):
+        """
+        Records a file downloaded before the manifest existed, if its size matches the server's
+        """
+        response = self.session.head(url, allow_redirects=True)
+        size = response.headers.get("Content-Length")
+        if response.ok and size is not None and int(size) == os.path.getsize(file_path):
+            self._record(file_path, url, int(size), file_sha256(file_path))
+            return True
+        return False
+
+    def download(self, url, file_path, verify=False, verbose=None):
+        """
+        Downloads url to file_path unless a complete copy is already there. Returns the number of
+        bytes transferred.
+        """
+        if self.is_complete(file_path, verify):
+            if self.verbose if verbose is None else verbose:
+                print(f"File {file_path} exists. Skipping download.")
+            return 0
+        if file_path not in self.manifest and os.path.exists(file_path):
+            if self._adopt(url, file_path):
+                print(f"File {file_path} matches the server. Skipping download.")
+                return 0
+
+        part_path = f"{file_path}.part"
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        # Byte counts and Range offsets only line up with an unencoded body
+        headers = {"Accept-Encoding": "identity"}
+        if offset:
+            headers["Range"] = f"bytes={offset}-"
+
+        start = time.perf_counter()
+        with self.session.get(url, headers=headers, stream=True) as response:
+            if response.status_code == 416:
+                # The partial file is no use, start over
+                os.remove(part_path)
+                return self.download(url, file_path, verify, verbose)
+            response.raise_for_status()
+            if response.status_code != 206:
+                offset = 0
+            remaining = response.headers.get("Content-Length")
+            total = offset + int(remaining) if remaining is not None else None
+
+            if offset:
+                print(f"Resuming {file_path} from {url} at {offset} bytes")
+            else:
+                print(f"Downloading file {file_path} from {url}")
+            done = offset
+            with open(part_path, "ab" if offset else "wb") as out_file:
+                try:
+                    for chunk in response.iter_content(self.chunk_size):
+                        out_file.write(chunk)
+                        done += len(chunk)
+                        if self.progress:
+                            self.progress(file_path, done, total)
+                except (
+                    requests.exceptions.ChunkedEncodingError,
+                    requests.exceptions.ConnectionError,
+                ) as e:
+                    raise IOError(
+                        f"Download of {url} stopped at {done} of {total} bytes. Rerun to resume."
+                    ) from e
+
+        if total is not None and done != total:
+            raise IOError(
+                f"Download of {url} stopped at {done} of {total} bytes. Rerun to resume."
+            )
+        os.replace(part_path, file_path)
+        self._record(file_path, url, done, file_sha256(file_path))
+
+        transferred = done - offset
+        elapsed = time.perf_counter() - start
+        print(
+            f"Downloaded {file_path}: {transferred / 1e6:.1f} MB in {elapsed:.1f} s ({transferred / 1e6 / max(elapsed, 1e-9):.1f} MB/s)"
+        )
+        return transferred
+
+    def download_many(self, items, verify=False):
+        """
+        Downloads (url, file_path) pairs concurrently and returns the file paths
+        """
+        items = list(items)
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            transferred = sum(
+                executor.map(lambda item: self.download(*item, verify=verify), items)
+            )
+        elapsed = time.perf_counter() - start
+        print(
+            f"Fetched {len(items)} files, {transferred / 1e6:.1f} MB in {elapsed:.1f} s ({transferred / 1e6 / max(elapsed, 1e-9):.1f} MB/s)"
+        )
+        return [file_path for _, file_path in items]
+
+
+def file_sha256(file_path, chunk_size=1 << 20):
+    """
+    Returns the hex sha256 of a file, read in chunks
+    """
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def create_prices_coordinates_store(
+    store_path="data/prices_coordinates_parquet",
+    years=range(1995, 2023),
+    row_group_size=65536,
+):
+    """
+    Builds a Parquet copy of prices_coordinates_data from the per-year csv files written by
+    Database.create_prices_coordinates_data, partitioned by year and postcode area.
+
+    Rows are sorted by latitude and longitude within each partition so that the row group
+    min/max statistics on those columns let bbox queries skip most row groups. Rebuilding a
+    year replaces only that year's partitions.
+    """
+    for year in years:
+        filepath = f"data/prices_coordinates_data_{year}.csv"
+        if not os.path.exists(filepath):
+            print(f"{filepath} does not exist. Skipping.")
+            continue
+        schema = prices_coordinates_schema()
+        table = pv.read_csv(
+            filepath,
+            read_options=pv.ReadOptions(column_names=schema.names),
+            convert_options=pv.ConvertOptions(
+                column_types=schema,
+                strings_can_be_null=False,
+            ),
+        )
+        areas = pc.struct_field(
+            pc.extract_regex(table["postcode"], r"^(?P<area>[A-Za-z]{1,2})"), [0]
+        )
+        table = table.append_column(
+            "year", pa.array([year] * table.num_rows, pa.int16())
+        ).append_column("postcode_area", pc.utf8_upper(areas))
+        table = table.sort_by([("latitude", "ascending"), ("longitude", "ascending")])
+        ds.write_dataset(
+            table,
+            store_path,
+            format="parquet",
+            partitioning=["year", "postcode_area"],
+            partitioning_flavor="hive",
+            existing_data_behavior="delete_matching",
+            max_rows_per_group=row_group_size,
+            min_rows_per_group=min(row_group_size, table.num_rows),
+        )
+        print(f"Stored {table.num_rows} rows for {year} in {store_path}.")
+
+
+# Width of the postcode keys of PostcodeIndex: the outcode padded to four characters followed by
+# the three character incode, so that every outcode and sector is a contiguous run of keys
+POSTCODE_KEY_WIDTH = 7
+
+# Positions and names of the columns of open_postcode_geo.csv used by PostcodeIndex
+POSTCODE_INDEX_COLUMNS = {0: "postcode", 1: "status", 7: "latitude", 8: "longitude"}
+
+
+def postcode_keys(postcodes):
+    """
+    Returns the fixed-width keys of postcodes as a bytes array, in any case and spacing. Strings
+    that can't be postcodes get an empty key, which matches nothing.
+    """
+    compact = (
+        pd.Series(postcodes, dtype=object)
+        .fillna("")
+        .astype(str)
+        .str.upper()
+        .str.replace(r"\s+", "", regex=True)
+    )
+    keys = compact.str[:-3].str.ljust(4) + compact.str[-3:]
+    valid = (
+        compact.str.len().between(5, POSTCODE_KEY_WIDTH) & compact.str.fullmatch("[A-Z0-9]+")
+    ).to_numpy()
+    return np.where(valid, keys.to_numpy(dtype=str), "").astype(f"S{POSTCODE_KEY_WIDTH}")
+
+
+def format_postcode_keys(keys):
+    """
+    Returns the postcodes of fixed-width keys in their usual "outcode incode" form
+    """
+    keys = pd.Series(np.asarray(keys).astype(str))
+    return keys.str[:4].str.rstrip() + " " + keys.str[4:]
+
+
+class PostcodeIndex:
+    """
+    In-process postcode geocoder built from open_postcode_geo.csv by build. Postcodes are kept as
+    sorted fixed-width keys (see postcode_keys) alongside float32 latitudes and longitudes and a
+    live flag, each stored as a .npy file in the directory at path.
+
+    The arrays are memory-mapped read-only on first use and again whenever the index is rebuilt,
+    so worker processes opening the same index share one copy in the page cache.
+    """
+
+    ARRAYS = ("keys", "latitude", "longitude", "live")
+
+    def __init__(self, path="data/postcode_index"):
+        self.path = path
+        self._arrays = None
+        self._mtime = None
+        self._lock = threading.Lock()
+
+    def _file(self, name):
+        return os.path.join(self.path, f"{name}.npy")
+
+    def _meta_file(self):
+        return os.path.join(self.path, "meta.json")
+
+    def exists(self):
+        return os.path.exists(self._meta_file())
+
+    def build(self, csv_files, chunk_size=500000):
+        """
+        Reads the postcode, status and coordinates of every row of csv_files, in the layout of
+        open_postcode_geo.csv, and writes the sorted arrays. Postcodes without coordinates are
+        kept with NaN ones.
+        """
+        parts = {name: [] for name in self.ARRAYS}
+        for csv_file in csv_files:
+            for chunk in pd.read_csv(
+                csv_file,
+                header=None,
+                usecols=list(POSTCODE_INDEX_COLUMNS),
+                dtype={0: str, 1: str, 7: float, 8: float},
+                na_values={7: ["\\N"], 8: ["\\N"]},
+                keep_default_na=False,
+                chunksize=chunk_size,
+            ):
+                chunk = chunk.rename(columns=POSTCODE_INDEX_COLUMNS)
+                parts["keys"].append(postcode_keys(chunk["postcode"]))
+                parts["latitude"].append(chunk["latitude"].to_numpy(np.float32))
+                parts["longitude"].append(chunk["longitude"].to_numpy(np.float32))
+                parts["live"].append((chunk["status"] == "live").to_numpy())
+        arrays = {
+            name: np.concatenate(values) if values else np.array([])
+            for name, values in parts.items()
+        }
+        arrays["keys"] = arrays["keys"].astype(f"S{POSTCODE_KEY_WIDTH}")
+        order = np.argsort(arrays["keys"], kind="stable")
+        keep = order[arrays["keys"][order] != b""]
+        os.makedirs(self.path, exist_ok=True)
+        for name in self.ARRAYS:
+            with open(f"{self._file(name)}.part", "wb") as file:
+                np.save(file, arrays[name][keep])
+            os.replace(f"{self._file(name)}.part", self._file(name))
+        # Written last, so that readers only remap once every array has been replaced
+        meta_path = self._meta_file()
+        with open(f"{meta_path}.part", "w") as file:
+            json.dump(
+                {"rows": len(keep), "live": int(arrays["live"][keep].sum()), "built": time.time()},
+                file,
+            )
+        os.replace(f"{meta_path}.part", meta_path)
+        print(f"Indexed {len(keep)} postcodes in {self.path}.")
+
+    def arrays(self):
+        """
+        Returns the memory-mapped arrays by name
+        """
+        mtime = os.path.getmtime(self._meta_file())
+        with self._lock:
+            if self._arrays is None or self._mtime != mtime:
+                self._arrays = {
+                    name: np.load(self._file(name), mmap_mode="r") for name in self.ARRAYS
+                }
+                self._mtime = mtime
+            return self._arrays
+
+    def __len__(self):
+        return len(self.arrays()["keys"])
+
+    def _status_mask(self, live, status):
+        if status is None:
+            return np.ones(len(live), dtype=bool)
+        if status not in ("live", "terminated"):
+            raise ValueError(f"status must be 'live', 'terminated' or None, not {status!r}")
+        return live if status == "live" else ~live
+
+    def positions(self, postcodes, status=None):
+        """
+        Returns the positions in the index of postcodes, -1 for those not found or, with status
+        'live' or 'terminated', not of that status
+        """
+        arrays = self.arrays()
+        keys = arrays["keys"]
+        queries = postcode_keys(postcodes)
+        positions = np.searchsorted(keys, queries)
+        clipped = np.minimum(positions, max(len(keys) - 1, 0))
+        found = (positions < len(keys)) & (queries != b"")
+        if len(keys):
+            found &= keys[clipped] == queries
+            found &= self._status_mask(np.asarray(arrays["live"][clipped]), status)
+        return np.where(found, positions, -1)
+
+    def lookup(self, postcodes, status=None):
+        """
+        Geocodes a batch of postcodes. Returns a DataFrame in the order of postcodes with their
+        latitude, longitude and live flag, NaN coordinates and a false found column for those
+        not found (or not of status).
+        """
+        arrays = self.arrays()
+        positions = self.positions(postcodes, status=status)
+        found = positions >= 0
+        taken = np.where(found, positions, 0)
+        latitude = np.full(len(positions), np.nan, dtype=np.float32)
+        longitude = np.full(len(positions), np.nan, dtype=np.float32)
+        live = np.zeros(len(positions), dtype=bool)
+        if len(arrays["keys"]):
+            latitude[found] = arrays["latitude"][taken][found]
+            longitude[found] = arrays["longitude"][taken][found]
+            live[found] = arrays["live"][taken][found]
+        return pd.DataFrame(
+            {
+                "postcode": list(postcodes),
+                "latitude": latitude,
+                "longitude": longitude,
+                "live": live,
+                "found": found,
+            }
+        )
+
+    def prefix(self, prefix, status=None):
+        """
+        Returns the postcodes whose key starts with prefix, with their coordinates and live flag,
+        as a DataFrame in key order. Use outcode and sector rather than building keys by hand.
+        """
+        arrays = self.arrays()
+        keys = arrays["keys"]
+        start, stop = np.searchsorted(keys, np.array([prefix, prefix + b"\xff"]))
+        live = np.asarray(arrays["live"][start:stop])
+        mask = self._status_mask(live, status)
+        return pd.DataFrame(
+            {
+                "postcode": format_postcode_keys(keys[start:stop][mask]).to_numpy(),
+                "latitude": np.asarray(arrays["latitude"][start:stop])[mask],
+                "longitude": np.asarray(arrays["longitude"][start:stop])[mask],
+                "live": live[mask],
+            }
+        )
+
+    def outcode(self, outcode, status=None):
+        """
+        Returns the postcodes of an outcode such as "CB2"
+        """
+        outcode = outcode.strip().upper()
+        if not 2 <= len(outcode) <= 4:
+            raise ValueError(f"{outcode!r} is not an outcode")
+        return self.prefix(outcode.ljust(4).encode(), status=status)
+
+    def sector(self, sector, status=None):
+        """
+        Returns the postcodes of a sector such as "CB2 1"
+        """
+        parts = sector.upper().split()
+        if len(parts) != 2 or len(parts[1]) != 1 or not 2 <= len(parts[0]) <= 4:
+            raise ValueError(f"{sector!r} is not a postcode sector")
+        return self.prefix((parts[0].ljust(4) + parts[1]).encode(), status=status)
+
+
+postcode_index = PostcodeIndex()
+
+
 class Database:
-    def __init__(self, username, password, url, port=3306):
+    # Errors meaning the server went away, after which a read can safely be retried
+    RECONNECT_ERRORS = (2006, 2013)
+    # Deadlocks, after which InnoDB has rolled the transaction back and it can be run again
+    DEADLOCK_ERRORS = (1213,)
+
+    def __init__(self, username, password, url, port=3306, pool_size=4):
         self.username = username
         self.password = password
         self.url = url
         self.port = port
-        self.conn = self.connect()
+        self.database = None
+        self._downloader = None
+        self.pool = ConnectionPool(self._new_connection, size=pool_size)
+        try:
+            with self.pool.connection():
+                print(f"Successfully connected to server.")
+        except Exception as e:
+            print(f"Error connecting to the MariaDB Server: {e}")
+
+    @property
+    def downloader(self):
+        """
+        The Downloader used by get_file_from_url and get_pp_data, created on first use so that
+        requests is only imported when something is downloaded
+        """
+        if self._downloader is None:
+            self._downloader = Downloader()
+        return self._downloader
+
+    def _new_connection(self):
+        return pymysql.connect(
+            user=self.username,
+            passwd=self.password,
+            host=self.url,
+            port=self.port,
+            database=self.database,
+            autocommit=True,
+            local_infile=1,
+            client_flag=pymysql.constants.CLIENT.MULTI_STATEMENTS,
+        )
 
     def connect(self):
         """
@@ -26,19 +814,93 @@ class Database:
         """
         conn = None
         try:
-            conn = pymysql.connect(
-                user=self.username,
-                passwd=self.password,
-                host=self.url,
-                port=self.port,
-                local_infile=1,
-                client_flag=pymysql.constants.CLIENT.MULTI_STATEMENTS,
-            )
+            conn = self._new_connection()
             print(f"Successfully connected to server.")
         except Exception as e:
             print(f"Error connecting to the MariaDB Server: {e}")
         return conn
 
+    @contextmanager
+    def cursor(self, cursor_class=None):
+        """
+        Borrows a pooled connection and yields a cursor on it, closing the cursor afterwards.
+        While instrumentation is enabled, the statements run on it are recorded.
+        """
+        with self.pool.connection() as conn:
+            with conn.cursor(cursor_class) as cur:
+                if not instrument.recorder.enabled:
+                    yield cur
+                    return
+                cur = instrument.InstrumentedCursor(cur)
+                try:
+                    yield cur
+                finally:
+                    cur.finish()
+
+    def _run(self, sql, fetch, args=None):
+        """
+        Executes sql with bound args on a pooled connection and returns fetch(cur). Reads are
+        retried once if the server dropped the connection.
+        """
+        words = sql.split(None, 1)
+        if not words:
+            raise ValueError("sql is empty")
+        is_read = words[0].upper() in ("SELECT", "SHOW", "EXPLAIN")
+        try:
+            with self.cursor() as cur:
+                cur.execute(sql, args)
+                return fetch(cur)
+        except pymysql.err.OperationalError as e:
+            if not is_read or e.args[0] not in self.RECONNECT_ERRORS:
+                raise
+            print(f"Lost connection to server ({e}). Retrying.")
+            with self.cursor() as cur:
+                cur.execute(sql, args)
+                return fetch(cur)
+
+    def _run_transaction(self, work, read_committed=False, retries=3):
+        """
+        Runs work(cur) in one transaction on a pooled connection and returns its result,
+        committing if it returns and rolling back if it raises. With read_committed the
+        transaction runs at READ COMMITTED, where InnoDB doesn't take the gap locks on which
+        concurrent range deletes and inserts deadlock. Transactions chosen as deadlock victims
+        are retried up to retries times.
+        """
+        for attempt in range(retries + 1):
+            try:
+                with self.cursor() as cur:
+                    if read_committed:
+                        # Applies to the next transaction only, so pooled connections keep
+                        # their default
+                        cur.execute("SET TRANSACTION ISOLATION LEVEL READ COMMITTED;")
+                    cur.execute("START TRANSACTION;")
+                    try:
+                        result = work(cur)
+                        cur.execute("COMMIT;")
+                        return result
+                    except Exception:
+                        cur.execute("ROLLBACK;")
+                        raise
+            except pymysql.err.OperationalError as e:
+                if e.args[0] not in self.DEADLOCK_ERRORS or attempt == retries:
+                    raise
+                print(f"Transaction deadlocked ({e}). Retrying.")
+                time.sleep(0.1 * 2**attempt)
+
+    def _tables_changed(self):
+        """
+        Drops the results assess.query has memoized in query_cache and the models trained in
+        address.model_registry from this database, which would otherwise outlive changes to its
+        tables. Nothing can be memoized before those modules are imported, so they aren't
+        imported here.
+        """
+        assess = sys.modules.get(f"{__package__}.assess")
+        if assess is not None:
+            assess.query_cache.clear(self)
+        address = sys.modules.get(f"{__package__}.address")
+        if address is not None:
+            address.model_registry.clear(self)
+
     def list_existing_databases(self):
         """
         List existing databases
@@ -49,27 +911,94 @@ class Database:
         """
         Use database called db_name
         """
-        self.execute(f"USE {db_name};")
+        self.execute(f"USE {quote_identifier(db_name)};")
+        self.database = db_name
+        # Pooled connections must all point at the new database
+        self.pool.reset()
 
-    def execute(self, sql, verbose=False):
+    def execute(self, sql, verbose=False, args=None):
         """
-        Executes provided sql query and returns rows
+        Executes provided sql query, with %s placeholders bound to args, and returns rows
         """
-        cur = self.conn.cursor()
         if verbose:
             print(f"Execute: {sql}")
-        cur.execute(sql)
-        return cur.fetchall()
+        return self._run(sql, lambda cur: cur.fetchall(), args)
+
+    def execute_to_df(self, sql, args=None):
+        """
+        Executes provided sql query, with %s placeholders bound to args, and returns result as
+        a DataFrame
+        """
+        return self._run(sql, _fetch_df, args)
+
+    def executemany(self, sql, args_seq):
+        """
+        Executes provided sql statement once per tuple of args_seq on one connection. Inserts
+        are sent as multi-row statements. Returns the number of affected rows.
+        """
+        with self.cursor() as cur:
+            return cur.executemany(sql, list(args_seq))
+
+    def execute_many_to_df(self, sql, args_seq):
+        """
+        Runs the same sql query for every tuple of args_seq on one connection and returns all
+        the results as one DataFrame
+        """
+        dfs = []
+        with self.cursor() as cur:
+            for args in args_seq:
+                cur.execute(sql, args)
+                dfs.append(_fetch_df(cur))
+        return pd.concat(dfs, ignore_index=True) if dfs else pd.DataFrame()
+
+    def select_in(self, table, column, values, columns=None, batch_size=1000):
+        """
+        Returns the rows of table whose column is one of values, looked up in batches of
+        batch_size values per IN (...) query. No values gives an empty frame with the columns.
+        """
+        values = list(dict.fromkeys(values))
+        select = ", ".join(map(quote_identifier, columns)) if columns else "*"
+        sqls = []
+        for i in range(0, len(values), batch_size):
+            condition, args = in_clause(quote_identifier(column), values[i : i + batch_size])
+            sqls.append(
+                (f"SELECT {select} FROM {quote_identifier(table)} WHERE {condition}", args)
+            )
+        if not sqls:
+            sql = f"SELECT {select} FROM {quote_identifier(table)} WHERE 1 = 0"
+            return next(self.execute_iter_df(sql))
+        return pd.concat(self.map_queries(sqls), ignore_index=True)
 
-    def execute_to_df(self, sql):
+    def execute_iter_df(self, sql, chunksize=100000, args=None):
         """
-        Executes provided sql query and returns result as a DataFrame
+        Executes provided sql query on a server-side cursor and yields the result as typed
+        DataFrames of at most chunksize rows, so memory use doesn't grow with the result size.
+        An empty result yields a single empty DataFrame carrying the columns.
         """
-        cur = self.conn.cursor()
-        cur.execute(sql)
-        rows = cur.fetchall()
-        cols = [i[0] for i in cur.description]
-        return pd.DataFrame(rows, columns=cols)
+        with self.cursor(pymysql.cursors.SSCursor) as cur:
+            cur.execute(sql, args)
+            dtypes = column_dtypes(cur.description)
+            rows = cur.fetchmany(chunksize)
+            yield typed_frame(rows, dtypes)
+            while rows:
+                rows = cur.fetchmany(chunksize)
+                if rows:
+                    yield typed_frame(rows, dtypes)
+
+    def map_queries(self, sqls, max_workers=None):
+        """
+        Executes independent sql queries concurrently across pooled connections and returns
+        their results as a list of DataFrames, in the same order as sqls. Each query is either
+        sql text or a (sql, args) pair.
+        """
+
+        def run(query):
+            if isinstance(query, str):
+                return self.execute_to_df(query)
+            return self.execute_to_df(*query)
+
+        with ThreadPoolExecutor(max_workers=max_workers or self.pool.size) as executor:
+            return list(executor.map(run, sqls))
 
     def get_processlist(self):
         """
@@ -81,7 +1010,7 @@ class Database:
         """
         Kills process with process_num
         """
-        self.execute(f"KILL {process_num}")
+        self.execute("KILL %s", args=(int(process_num),))
 
     def create_database(self, db_name="property_prices"):
         """
@@ -92,15 +1021,15 @@ class Database:
 SET SQL_MODE = "NO_AUTO_VALUE_ON_ZERO";
 SET time_zone = "+00:00";
 CREATE DATABASE IF NOT EXISTS `{db_name}` DEFAULT CHARACTER SET utf8 COLLATE utf8_bin;
-USE `{db_name}`;               
 """
         )
+        self.use_database(db_name)
 
     def show_indexes(self, table_name):
         """
         Returns the indexs for table_name
         """
-        return self.execute_to_df(f"SHOW INDEXES FROM {table_name};")
+        return self.execute_to_df(f"SHOW INDEXES FROM {quote_identifier(table_name)};")
 
     def create_index(self, table_name, columns, index_name=None):
         """
@@ -117,18 +1046,46 @@ USE `{db_name}`;
                 True,
             )
 
-    def create_table(self, table_name, create_table_cmd, csv_files, index_columns=[]):
+    def create_table(
+        self,
+        table_name,
+        create_table_cmd,
+        csv_files,
+        index_columns=[],
+        index_name=None,
+        bulk=False,
+    ):
         """
         Creates a table within the database
+
+        With bulk, the table is (re)created without asking for confirmation and loaded with
+        bulk_load.
         """
-        if input(
+        if not bulk and input(
             f"Are you sure you want to (re)create table {table_name}? This will overwrite any existing tables with the same name and may take a long time."
         ).lower() not in ["y", "yes"]:
             print("Did not create table.")
             return
 
+        self.execute(f"DROP TABLE IF EXISTS `{table_name}`;")
+        self._tables_changed()
+        self._create_table_with_key(table_name, create_table_cmd)
+
+        if bulk:
+            self.bulk_load(table_name, csv_files)
+        else:
+            for file in csv_files:
+                self.upload_file(table=table_name, file_name=file)
+
+        if len(index_columns) > 0:
+            self.create_index(table_name, index_columns, index_name)
+
+    def _create_table_with_key(self, table_name, create_table_cmd):
+        """
+        Runs create_table_cmd and adds the auto incrementing db_id primary key
+        """
         sql = f"""
-DROP TABLE IF EXISTS `{table_name}`; {create_table_cmd}
+{create_table_cmd}
 ALTER TABLE `{table_name}`
 ADD PRIMARY KEY (`db_id`);
 
@@ -137,13 +1094,69 @@ MODIFY db_id bigint(20) unsigned NOT NULL AUTO_INCREMENT, AUTO_INCREMENT=1;
 """
         self.execute(sql)
 
-        for file in csv_files:
-            self.upload_file(table=table_name, file_name=file)
+    def bulk_load(self, table, csv_files, max_workers=None):
+        """
+        Loads csv files into table over several pooled connections at once, with non-unique
+        index maintenance disabled until the end (on MyISAM and Aria; InnoDB ignores DISABLE
+        KEYS) and per-session checks turned off.
+
+        The loads only overlap on InnoDB with innodb_autoinc_lock_mode = 2. At the default of 1,
+        each LOAD DATA into a table with an AUTO_INCREMENT key, as every table made by
+        create_table has, holds the table's AUTO-INC lock until it finishes, so the files load
+        one after another; a warning is printed when that is the case.
 
-        if len(index_columns) > 0:
-            self.create_index(table_name, index_columns)
+        Prints rows/sec per file and checks each file's loaded row count against its line
+        count. Returns a DataFrame reporting both for every file.
+        """
+        max_workers = max_workers or self.pool.size
+        if max_workers > 1 and len(csv_files) > 1:
+            (lock_mode,) = self.execute("SELECT @@innodb_autoinc_lock_mode")[0]
+            if int(lock_mode) != 2:
+                print(
+                    f"WARNING: innodb_autoinc_lock_mode is {lock_mode}, so loads into `{table}` will run one at a time. Set it to 2 to load files in parallel."
+                )
+        self.execute(f"ALTER TABLE `{table}` DISABLE KEYS;")
+        start = time.perf_counter()
+        try:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                reports = list(
+                    executor.map(
+                        lambda file: self._bulk_load_file(table, file), csv_files
+                    )
+                )
+        finally:
+            self.execute(f"ALTER TABLE `{table}` ENABLE KEYS;")
+        elapsed = time.perf_counter() - start
+
+        report = pd.DataFrame(
+            reports, columns=["file", "lines", "rows", "seconds", "rows_per_sec"]
+        )
+        mismatched = report[report["lines"] != report["rows"]]
+        for row in mismatched.itertuples():
+            print(
+                f"WARNING: loaded {row.rows} rows from {row.file}, which has {row.lines} lines."
+            )
+        print(
+            f"Loaded {report['rows'].sum()} rows into `{table}` in {elapsed:.1f} s ({report['rows'].sum() / max(elapsed, 1e-9):.0f} rows/s)."
+        )
+        return report
 
-    def create_pp_data(self):
+    def _bulk_load_file(self, table, file_name):
+        lines = count_lines(file_name)
+        start = time.perf_counter()
+        with self.cursor() as cur:
+            cur.execute("SET SESSION unique_checks = 0, foreign_key_checks = 0;")
+            try:
+                rows = cur.execute(*load_data_sql(table, file_name))
+            finally:
+                # The connection goes back to the pool, so restore its defaults
+                cur.execute("SET SESSION unique_checks = 1, foreign_key_checks = 1;")
+        seconds = time.perf_counter() - start
+        rows_per_sec = rows / max(seconds, 1e-9)
+        print(f"Loaded {rows} rows from {file_name} in {seconds:.1f} s ({rows_per_sec:.0f} rows/s).")
+        return file_name, lines, rows, seconds, rows_per_sec
+
+    def create_pp_data(self, bulk=False):
         create_table_cmd = """
 CREATE TABLE IF NOT EXISTS `pp_data` (
   `transaction_unique_identifier` tinytext COLLATE utf8_bin NOT NULL,
@@ -171,9 +1184,10 @@ CREATE TABLE IF NOT EXISTS `pp_data` (
             create_table_cmd=create_table_cmd,
             csv_files=csv_files,
             index_columns=["postcode", "date_of_transfer"],
+            bulk=bulk,
         )
 
-    def create_postcode_data(self):
+    def create_postcode_data(self, bulk=False):
         create_table_cmd = """
 CREATE TABLE IF NOT EXISTS `postcode_data` (
   `postcode` varchar(8) COLLATE utf8_bin NOT NULL,
@@ -204,70 +1218,486 @@ CREATE TABLE IF NOT EXISTS `postcode_data` (
             create_table_cmd=create_table_cmd,
             csv_files=csv_files,
             index_columns=["postcode", "latitude", "longitude"],
+            bulk=bulk,
         )
 
-    def create_prices_coordinates_data(self):
-        create_table_cmd = """
-CREATE TABLE IF NOT EXISTS `prices_coordinates_data` (
-    `price` int(10) unsigned NOT NULL,
-    `date_of_transfer` date NOT NULL,
-    `postcode` varchar(8) COLLATE utf8_bin NOT NULL,
-    `property_type` varchar(1) COLLATE utf8_bin NOT NULL,
-    `new_build_flag` varchar(1) COLLATE utf8_bin NOT NULL,
-    `tenure_type` varchar(1) COLLATE utf8_bin NOT NULL,
-    `locality` tinytext COLLATE utf8_bin NOT NULL,
-    `town_city` tinytext COLLATE utf8_bin NOT NULL,
-    `district` tinytext COLLATE utf8_bin NOT NULL,
-    `county` tinytext COLLATE utf8_bin NOT NULL,
-    `country` enum('England', 'Wales', 'Scotland', 'Northern Ireland', 'Channel Islands', 'Isle of Man') NOT NULL,
-    `latitude` decimal(11,8) NOT NULL,
-    `longitude` decimal(10,8) NOT NULL,
-    `db_id` bigint(20) unsigned NOT NULL
-  ) DEFAULT CHARSET=utf8 COLLATE=utf8_bin AUTO_INCREMENT=1 ;
-"""
+    def create_prices_coordinates_data(self, bulk=False):
+        create_table_cmd = PRICES_COORDINATES_TABLE
+        missing_years = []
         for year in range(1995, 2023):
             filepath = f"data/prices_coordinates_data_{year}.csv"
             if not os.path.exists(filepath):
-                print(f"Joining table for rows in {year}.")
-                df = self.execute_to_df(
-                    f"""
-                SELECT
-                price, date_of_transfer, pp_data.postcode, property_type, new_build_flag, tenure_type, locality, town_city, district, county, country, latitude, longitude
-                FROM pp_data
-                INNER JOIN postcode_data
-                ON pp_data.postcode = postcode_data.postcode          
-                WHERE 
-                    date_of_transfer >= '{year}-01-01' AND
-                    date_of_transfer < '{year+1}-01-01'
-                """
-                )
-                df.to_csv(filepath, header=False, index=False)
-                print(f"Joined successfully, stored to: {filepath}")
+                missing_years.append(year)
             else:
                 print(f"{filepath} exists. Skipping.")
 
+        with ThreadPoolExecutor(max_workers=self.pool.size) as executor:
+            list(executor.map(self._join_prices_coordinates_year, missing_years))
+
         self.create_table(
             table_name="prices_coordinates_data",
             create_table_cmd=create_table_cmd,
-            csv_files=[],
+            csv_files=[
+                f"data/prices_coordinates_data_{year}.csv" for year in range(1995, 2023)
+            ],
+            index_columns=["date_of_transfer", "latitude", "longitude"],
+            index_name="pcd_date_lat_long_index",
+            bulk=bulk,
         )
 
-        for year in range(1995, 2023):
-            self.upload_file(
-                "prices_coordinates_data", f"data/prices_coordinates_data_{year}.csv"
+    def build_prices_coordinates_data(
+        self, years=range(1995, 2023), rebuild=False, max_workers=None
+    ):
+        """
+        Builds prices_coordinates_data on the server, without the csv round trip of
+        create_prices_coordinates_data, by running the join for each year as an INSERT ... SELECT.
+
+        Years are joined in parallel on pooled connections, each in its own transaction along
+        with a row in build_checkpoints marking it done. Years already marked done are skipped,
+        so the build can be resumed after an interruption, and joining a new year of data only
+        appends that year. With rebuild, the table and its checkpoints are dropped first.
+        """
+        self.execute(
+            """
+CREATE TABLE IF NOT EXISTS `build_checkpoints` (
+  `table_name` varchar(64) COLLATE utf8_bin NOT NULL,
+  `part` varchar(32) COLLATE utf8_bin NOT NULL,
+  `row_count` bigint(20) unsigned NOT NULL,
+  `completed_at` datetime NOT NULL,
+  PRIMARY KEY (`table_name`, `part`)
+) DEFAULT CHARSET=utf8 COLLATE=utf8_bin;
+"""
+        )
+        if rebuild:
+            self.execute("DROP TABLE IF EXISTS `prices_coordinates_data`;")
+            self.execute(
+                "DELETE FROM `build_checkpoints` WHERE table_name = %s",
+                args=("prices_coordinates_data",),
+            )
+        if not self.execute("SHOW TABLES LIKE %s", args=("prices_coordinates_data",)):
+            self._create_table_with_key("prices_coordinates_data", PRICES_COORDINATES_TABLE)
+            self.create_index(
+                "prices_coordinates_data",
+                ["date_of_transfer", "latitude", "longitude"],
+                "pcd_date_lat_long_index",
+            )
+
+        done = {
+            int(part)
+            for (part,) in self.execute(
+                "SELECT part FROM `build_checkpoints` WHERE table_name = %s",
+                args=("prices_coordinates_data",),
+            )
+        }
+        todo = [year for year in years if year not in done]
+        for year in sorted(done.intersection(years)):
+            print(f"Rows for {year} already joined. Skipping.")
+
+        try:
+            with ThreadPoolExecutor(max_workers=max_workers or self.pool.size) as executor:
+                list(executor.map(self._insert_prices_coordinates_year, todo))
+        finally:
+            self._tables_changed()
+
+    def _insert_prices_coordinates_year(self, year):
+        """
+        Replaces the rows for one year of prices_coordinates_data with the server side join and
+        checkpoints it, in one transaction. Years run in parallel, so the transaction runs at
+        READ COMMITTED and is retried if it deadlocks.
+        """
+        print(f"Joining table for rows in {year}.")
+        start = time.perf_counter()
+
+        def insert(cur):
+            # Clear rows not covered by a checkpoint, such as those loaded from the csv files
+            # by create_prices_coordinates_data
+            cur.execute(
+                """
+                DELETE FROM prices_coordinates_data
+                WHERE
+                    date_of_transfer >= %s AND
+                    date_of_transfer < %s
+                """,
+                year_range(year),
+            )
+            join_sql, join_args = prices_coordinates_join_sql(year)
+            rows = cur.execute(
+                f"""
+                INSERT INTO prices_coordinates_data
+                (price, date_of_transfer, postcode, property_type, new_build_flag, tenure_type, locality, town_city, district, county, country, latitude, longitude)
+                {join_sql}
+                """,
+                join_args,
+            )
+            cur.execute(
+                """
+                REPLACE INTO build_checkpoints (table_name, part, row_count, completed_at)
+                VALUES (%s, %s, %s, NOW())
+                """,
+                ("prices_coordinates_data", str(year), rows),
+            )
+            return rows
+
+        rows = self._run_transaction(insert, read_committed=True)
+        print(
+            f"Joined {rows} rows for {year} in {time.perf_counter() - start:.1f} s."
+        )
+
+    def _join_prices_coordinates_year(self, year):
+        """
+        Streams the pp_data and postcode_data join for one year into its csv file. The file only
+        appears under its final name once complete.
+        """
+        filepath = f"data/prices_coordinates_data_{year}.csv"
+        print(f"Joining table for rows in {year}.")
+        join_sql, join_args = prices_coordinates_join_sql(year)
+        chunks = self.execute_iter_df(join_sql, args=join_args)
+        with open(f"{filepath}.part", "w") as out_file:
+            for chunk in chunks:
+                chunk.to_csv(out_file, header=False, index=False, date_format="%Y-%m-%d")
+        os.replace(f"{filepath}.part", filepath)
+        print(f"Joined successfully, stored to: {filepath}")
+
+    def update_pp_data(self, file_path=None, batch_size=10000):
+        """
+        Applies a Land Registry monthly change file to pp_data and prices_coordinates_data.
+
+        The latest change file is downloaded unless file_path is given (the Land Registry only
+        publishes the latest one, so earlier months have to be applied from saved files). It is
+        streamed in batches of batch_size rows. Each batch deletes the rows whose
+        transaction_unique_identifier appears in it, then inserts the rows with record_status A
+        (add) or C (change), so deletes (D) and changes replace what was there. For every
+        pp_data row removed, one prices_coordinates_data row with its values is removed, and
+        the added rows are joined in, in the same transaction.
+
+        Applied files are recorded by sha256 in ingest_watermarks and skipped on later runs.
+        Applying a file twice is also harmless, since every batch is an upsert.
+        """
+        if file_path is None:
+            # Saved under the day it was fetched, as the url serves whichever file is latest
+            file_path = f"data/pp-monthly-update-{datetime.date.today().isoformat()}.csv"
+            self.get_file_from_url(
+                file_path,
+                "http://prod.publicdata.landregistry.gov.uk.s3-website-eu-west-1.amazonaws.com/pp-monthly-update-new-version.csv",
+            )
+
+        self.execute(
+            """
+CREATE TABLE IF NOT EXISTS `ingest_watermarks` (
+  `source` varchar(255) COLLATE utf8_bin NOT NULL,
+  `sha256` char(64) COLLATE utf8_bin NOT NULL,
+  `row_count` bigint(20) unsigned NOT NULL,
+  `applied_at` datetime NOT NULL,
+  PRIMARY KEY (`sha256`)
+) DEFAULT CHARSET=utf8 COLLATE=utf8_bin;
+"""
+        )
+        sha256 = file_sha256(file_path)
+        if self.execute("SELECT 1 FROM ingest_watermarks WHERE sha256 = %s", args=(sha256,)):
+            print(f"{file_path} has already been applied. Skipping.")
+            return
+
+        if "pp_data_transaction_index" not in set(self.show_indexes("pp_data")["Key_name"]):
+            # Identifiers are fixed width GUIDs, so a prefix index covers them
+            self.execute(
+                "CREATE INDEX pp_data_transaction_index ON `pp_data` (transaction_unique_identifier(38));",
+                True,
             )
 
-        self.create_index(
-            "prices_coordinates_data",
-            ["date_of_transfer", "latitude", "longitude"],
-            "pcd_date_lat_long_index",
+        start = time.perf_counter()
+        total = 0
+        try:
+            for batch in pd.read_csv(
+                file_path,
+                header=None,
+                names=PP_COLUMNS,
+                dtype=str,
+                keep_default_na=False,
+                chunksize=batch_size,
+            ):
+                batch["date_of_transfer"] = batch["date_of_transfer"].str[:10]
+                self._apply_pp_batch(batch)
+                total += len(batch)
+                print(f"Applied {total} changes from {file_path}.")
+        finally:
+            # Batches already applied stay committed even if a later one fails
+            self._tables_changed()
+
+        self.execute(
+            """
+        INSERT INTO ingest_watermarks (source, sha256, row_count, applied_at)
+        VALUES (%s, %s, %s, NOW())
+        """,
+            args=(os.path.basename(file_path), sha256, total),
+        )
+        print(f"Applied {file_path} in {time.perf_counter() - start:.1f} s.")
+
+    def _apply_pp_batch(self, batch):
+        """
+        Upserts one batch of a change file into pp_data and prices_coordinates_data, in one
+        transaction
+        """
+        ids, id_args = in_clause(
+            "pp_data.transaction_unique_identifier", batch["transaction_unique_identifier"]
         )
+        upserts = batch[batch["record_status"].isin(["A", "C"])]
+        upsert_ids, upsert_args = in_clause(
+            "pp_data.transaction_unique_identifier", upserts["transaction_unique_identifier"]
+        )
+
+        columns = ", ".join(f"pp_data.{column}" for column in PP_PRICES_COORDINATES_COLUMNS)
+        on = " AND ".join(
+            f"pcd.{column} = pp_data.{column}" for column in PP_PRICES_COORDINATES_COLUMNS
+        )
+        with self.cursor() as cur:
+            cur.execute("START TRANSACTION;")
+            try:
+                # prices_coordinates_data has no transaction identifier, so each pp_data row
+                # being replaced takes one row with the same values with it. Rows with equal
+                # values can't be told apart, so it doesn't matter which one goes, but other
+                # transactions with those values must keep theirs.
+                cur.execute(f"SELECT {columns} FROM pp_data WHERE {ids}", id_args)
+                removed = collections.Counter(cur.fetchall())
+                if removed:
+                    cur.execute(
+                        f"""
+                SELECT DISTINCT pcd.db_id, {columns}
+                FROM prices_coordinates_data AS pcd
+                INNER JOIN pp_data
+                ON {on}
+                WHERE {ids}
+                """,
+                        id_args,
+                    )
+                    matches = collections.defaultdict(list)
+                    for db_id, *values in sorted(cur.fetchall()):
+                        matches[tuple(values)].append(db_id)
+                    stale = [
+                        db_id
+                        for values, db_ids in matches.items()
+                        for db_id in db_ids[: removed[values]]
+                    ]
+                    if stale:
+                        stale_ids, stale_args = in_clause("db_id", stale)
+                        cur.execute(
+                            f"DELETE FROM prices_coordinates_data WHERE {stale_ids}", stale_args
+                        )
+                cur.execute(f"DELETE FROM pp_data WHERE {ids}", id_args)
+                if len(upserts):
+                    cur.executemany(
+                        f"""
+                INSERT INTO pp_data ({', '.join(PP_COLUMNS)})
+                VALUES ({', '.join(['%s'] * len(PP_COLUMNS))})
+                """,
+                        list(upserts[PP_COLUMNS].itertuples(index=False, name=None)),
+                    )
+                    cur.execute(
+                        f"""
+                INSERT INTO prices_coordinates_data
+                (price, date_of_transfer, postcode, property_type, new_build_flag, tenure_type, locality, town_city, district, county, country, latitude, longitude)
+                SELECT
+                price, date_of_transfer, pp_data.postcode, property_type, new_build_flag, tenure_type, locality, town_city, district, county, country, latitude, longitude
+                FROM pp_data
+                INNER JOIN postcode_data
+                ON pp_data.postcode = postcode_data.postcode
+                WHERE {upsert_ids}
+                """,
+                        upsert_args,
+                    )
+                cur.execute("COMMIT;")
+            except Exception:
+                cur.execute("ROLLBACK;")
+                raise
+
+    def build_price_cube(self, rebuild=False, max_workers=None):
+        """
+        Builds or refreshes the price cube: summary tables of prices_coordinates_data by postcode
+        sector, month and property type, for price_cube_query in assess.
+
+        price_cube holds the count, sum, min and max of price for each cell, and
+        price_cube_histogram the counts of log price in buckets of 1 / PRICE_CUBE_RESOLUTION,
+        from which approximate quantiles are read. Sectors, districts and areas come from
+        postcode_data.
+
+        Each month's row count and price sum are recorded in price_cube_months, and later calls
+        only rebuild months whose count or sum has changed, such as those touched by
+        update_pp_data. Months are rebuilt in parallel on pooled connections, each in its own
+        transaction. With rebuild, every month is rebuilt.
+        """
+        self.execute(
+            """
+CREATE TABLE IF NOT EXISTS `price_cube` (
+  `postcode_area` varchar(2) COLLATE utf8_bin NOT NULL,
+  `postcode_district` varchar(4) COLLATE utf8_bin NOT NULL,
+  `postcode_sector` varchar(6) COLLATE utf8_bin NOT NULL,
+  `month` date NOT NULL,
+  `property_type` varchar(1) COLLATE utf8_bin NOT NULL,
+  `row_count` bigint(20) unsigned NOT NULL,
+  `price_sum` decimal(20,0) NOT NULL,
+  `price_min` int(10) unsigned NOT NULL,
+  `price_max` int(10) unsigned NOT NULL,
+  PRIMARY KEY (`month`, `postcode_sector`, `property_type`),
+  KEY `price_cube_district_index` (`postcode_district`, `month`)
+) DEFAULT CHARSET=utf8 COLLATE=utf8_bin;
+"""
+        )
+        self.execute(
+            """
+CREATE TABLE IF NOT EXISTS `price_cube_histogram` (
+  `postcode_area` varchar(2) COLLATE utf8_bin NOT NULL,
+  `postcode_district` varchar(4) COLLATE utf8_bin NOT NULL,
+  `postcode_sector` varchar(6) COLLATE utf8_bin NOT NULL,
+  `month` date NOT NULL,
+  `property_type` varchar(1) COLLATE utf8_bin NOT NULL,
+  `bucket` smallint NOT NULL,
+  `row_count` bigint(20) unsigned NOT NULL,
+  PRIMARY KEY (`month`, `postcode_sector`, `property_type`, `bucket`),
+  KEY `price_cube_histogram_district_index` (`postcode_district`, `month`)
+) DEFAULT CHARSET=utf8 COLLATE=utf8_bin;
+"""
+        )
+        self.execute(
+            """
+CREATE TABLE IF NOT EXISTS `price_cube_months` (
+  `month` date NOT NULL,
+  `row_count` bigint(20) unsigned NOT NULL,
+  `price_sum` decimal(20,0) NOT NULL,
+  `refreshed_at` datetime NOT NULL,
+  PRIMARY KEY (`month`)
+) DEFAULT CHARSET=utf8 COLLATE=utf8_bin;
+"""
+        )
+
+        counts = self.execute(
+            """
+        SELECT YEAR(date_of_transfer), MONTH(date_of_transfer), COUNT(*), SUM(price)
+        FROM prices_coordinates_data
+        GROUP BY YEAR(date_of_transfer), MONTH(date_of_transfer)
+        """
+        )
+        current = {
+            datetime.date(int(year), int(month), 1): (int(n), int(total))
+            for year, month, n, total in counts
+        }
+        refreshed = {
+            month: (int(n), int(total))
+            for month, n, total in self.execute(
+                "SELECT month, row_count, price_sum FROM price_cube_months"
+            )
+        }
+        stale = sorted(
+            month
+            for month in set(current) | set(refreshed)
+            if rebuild or current.get(month) != refreshed.get(month)
+        )
+        print(f"{len(stale)} of {len(current)} months of the price cube to refresh.")
+
+        def refresh(month):
+            return self._refresh_price_cube_month(month, *current.get(month, (0, 0)))
+
+        with ThreadPoolExecutor(max_workers=max_workers or self.pool.size) as executor:
+            list(executor.map(refresh, stale))
+
+    def _refresh_price_cube_month(self, month, row_count, price_sum):
+        """
+        Replaces the price cube rows for one month and records its row count and price sum, in
+        one transaction. Months run in parallel, so the transaction runs at READ COMMITTED and
+        is retried if it deadlocks.
+        """
+        start = time.perf_counter()
+        month_args = month_range(month)
+
+        def refresh(cur):
+            for table in ("price_cube", "price_cube_histogram"):
+                cur.execute(f"DELETE FROM {table} WHERE month = %s", (month,))
+            cur.execute("DELETE FROM price_cube_months WHERE month = %s", (month,))
+            if row_count:
+                cur.execute(
+                    """
+            INSERT INTO price_cube
+            (postcode_area, postcode_district, postcode_sector, month, property_type, row_count, price_sum, price_min, price_max)
+            SELECT
+            postcode_data.postcode_area, postcode_data.postcode_district, postcode_data.postcode_sector, %s, pcd.property_type, COUNT(*), SUM(pcd.price), MIN(pcd.price), MAX(pcd.price)
+            FROM prices_coordinates_data AS pcd
+            INNER JOIN postcode_data
+            ON pcd.postcode = postcode_data.postcode
+            WHERE
+                pcd.date_of_transfer >= %s AND
+                pcd.date_of_transfer < %s
+            GROUP BY postcode_data.postcode_area, postcode_data.postcode_district, postcode_data.postcode_sector, pcd.property_type
+            """,
+                    [month] + month_args,
+                )
+                cur.execute(
+                    f"""
+            INSERT INTO price_cube_histogram
+            (postcode_area, postcode_district, postcode_sector, month, property_type, bucket, row_count)
+            SELECT
+            postcode_data.postcode_area, postcode_data.postcode_district, postcode_data.postcode_sector, %s, pcd.property_type, FLOOR(LN(GREATEST(pcd.price, 1)) * {PRICE_CUBE_RESOLUTION}) AS bucket, COUNT(*)
+            FROM prices_coordinates_data AS pcd
+            INNER JOIN postcode_data
+            ON pcd.postcode = postcode_data.postcode
+            WHERE
+                pcd.date_of_transfer >= %s AND
+                pcd.date_of_transfer < %s
+            GROUP BY postcode_data.postcode_area, postcode_data.postcode_district, postcode_data.postcode_sector, pcd.property_type, bucket
+            """,
+                    [month] + month_args,
+                )
+                cur.execute(
+                    """
+            INSERT INTO price_cube_months (month, row_count, price_sum, refreshed_at)
+            VALUES (%s, %s, %s, NOW())
+            """,
+                    (month, row_count, price_sum),
+                )
+
+        self._run_transaction(refresh, read_committed=True)
+        print(
+            f"Refreshed the price cube for {month:%Y-%m} in {time.perf_counter() - start:.1f} s."
+        )
+
+    def create_grid_index(self, table="prices_coordinates_data"):
+        """
+        Adds a grid_cell column, computed by the server from latitude and longitude, and an
+        index over (grid_cell, date_of_transfer), so bbox queries can look up the cells covering
+        the box rather than scanning every row in their date range. Rows inserted later get their
+        cell automatically.
+
+        Tables reloaded from csv files with create_table don't have the column, so this needs
+        rerunning after a rebuild.
+        """
+        if "grid_cell" not in self.get_columns(table):
+            self.execute(
+                f"ALTER TABLE `{table}` ADD COLUMN grid_cell int AS ({GRID_CELL_SQL}) STORED;",
+                True,
+            )
+        if not self.has_grid_index(table):
+            self.create_index(
+                table, ["grid_cell", "date_of_transfer"], f"{table}_grid_date_index"
+            )
+        # Memoized rows were selected without the new column
+        self._tables_changed()
+
+    def query_plan(self, sql, args=None):
+        """
+        Returns the index used (key), the access type and the estimated number of rows examined
+        for the first table in the plan of sql, as a dict
+        """
+        plan = self.execute_to_df(f"EXPLAIN {sql}", args).iloc[0]
+        return {"key": plan["key"], "type": plan["type"], "rows": plan["rows"]}
+
+    def has_grid_index(self, table="prices_coordinates_data"):
+        """
+        Returns whether create_grid_index has been run on table
+        """
+        return f"{table}_grid_date_index" in set(self.show_indexes(table)["Key_name"])
 
     def get_columns(self, table):
         """
         Returns column names of table
         """
-        cols = self.execute(f"SHOW COLUMNS FROM {table}")
+        cols = self.execute(f"SHOW COLUMNS FROM {quote_identifier(table)}")
         col_names = [c[0] for c in cols]
         return col_names
 
@@ -275,28 +1705,139 @@ CREATE TABLE IF NOT EXISTS `prices_coordinates_data` (
         """
         Gets n random samples from a table
         """
-        rows = []
-        m = self.execute(f"SELECT MAX(db_id) FROM {table}")[0][0]
-        return self.execute_to_df(
-            f"""
-            SELECT DISTINCT *
-            FROM {table} as t1
-            JOIN (
-                SELECT ROUND(RAND({seed if seed else ''}) * {m}) as id
-                FROM {table}
-                LIMIT {int(n * 1.1)} 
-            ) AS t2
-            ON
-            t1.db_id = t2.id
-            LIMIT {n}
-            """
+        return self.sample(table, n, seed)
+
+    def sample(self, table, n, seed=None, batch_size=10000):
+        """
+        Uniformly samples exactly n rows of table (or all of them, if it has fewer) without
+        replacement.
+
+        Candidate db_ids are drawn with NumPy and fetched by primary key in batches of
+        batch_size. Ids that fall in gaps are never drawn again, and more ids are drawn until n
+        rows have been found.
+        """
+        rng = np.random.default_rng(seed)
+        lo, hi = self.execute(f"SELECT MIN(db_id), MAX(db_id) FROM {quote_identifier(table)}")[0]
+        if lo is None or n <= 0:
+            return self.select_in(table, "db_id", [])
+        lo, hi = int(lo), int(hi)
+
+        tried = np.empty(0, dtype=np.int64)
+        frames = []
+        found = 0
+        while found < n and len(tried) < hi - lo + 1:
+            # Draw enough new ids to cover the shortfall at the hit rate seen so far
+            hit_rate = found / len(tried) if len(tried) else 1.0
+            draw = int((n - found) / max(hit_rate, 0.01) * 1.1) + 10
+            ids = np.unique(rng.integers(lo, hi + 1, draw))
+            ids = np.setdiff1d(ids, tried, assume_unique=True)
+            tried = np.union1d(tried, ids)
+            rows = self.select_in(table, "db_id", ids.tolist(), batch_size=batch_size)
+            frames.append(rows)
+            found += len(rows)
+
+        rows = pd.concat(frames, ignore_index=True)
+        if len(rows) > n:
+            # Rows come back in key order, so trim the surplus at random
+            rows = rows.iloc[np.sort(rng.choice(len(rows), n, replace=False))]
+        return rows.reset_index(drop=True)
+
+    def reservoir_sample(self, sql, n, args=None, seed=None, by=None, chunksize=100000):
+        """
+        Uniformly samples n rows of the result of sql in one pass over a streaming cursor,
+        holding at most n rows in memory.
+
+        With by, n is a dict from each value of column by to the sample size for that value,
+        and a separate reservoir is kept for each.
+        """
+        rng = np.random.default_rng(seed)
+        reservoirs = {}
+        seen = {}
+        empty = None
+        for chunk in self.execute_iter_df(sql, chunksize, args):
+            if empty is None:
+                empty = chunk.iloc[:0]
+            groups = chunk.groupby(by, observed=True, sort=False) if by else [(None, chunk)]
+            for key, rows in groups:
+                size = n.get(key, 0) if by else n
+                if size == 0:
+                    continue
+                # Reservoirs are indexed by slot, 0 to size - 1
+                reservoir = reservoirs.get(key, chunk.iloc[:0])
+                count = seen.get(key, 0)
+                fill = min(size - len(reservoir), len(rows))
+                if fill:
+                    head = rows.iloc[:fill].set_axis(range(len(reservoir), len(reservoir) + fill))
+                    reservoir = pd.concat([reservoir, head])
+                    rows = rows.iloc[fill:]
+                    count += fill
+                if len(rows):
+                    slots = rng.integers(0, count + np.arange(len(rows)) + 1)
+                    accepted = np.flatnonzero(slots < size)
+                    # A later row replaces an earlier one in the same slot, as it would one at a time
+                    winners = pd.Series(accepted, index=slots[accepted]).groupby(level=0).last()
+                    reservoir = pd.concat(
+                        [
+                            reservoir.drop(index=winners.index),
+                            rows.iloc[winners.to_numpy()].set_axis(winners.index),
+                        ]
+                    )
+                    count += len(rows)
+                reservoirs[key] = reservoir
+                seen[key] = count
+
+        if not reservoirs:
+            return empty
+        return pd.concat(reservoirs.values()).reset_index(drop=True)
+
+    def stratified_sample(self, table, n, by, seed=None, allocation="proportional"):
+        """
+        Samples n rows of table stratified by by, which is a column or "year" for the year of
+        date_of_transfer. With proportional allocation each stratum gets a share of n in
+        proportion to its size; with "equal" each stratum gets the same share (up to its size).
+
+        Ids are chosen with one streaming pass over (db_id, stratum) and the rows are then
+        fetched by primary key.
+        """
+        expr = STRATA.get(by, quote_identifier(by))
+        table_name = quote_identifier(table)
+        counts = self.execute_to_df(
+            f"SELECT {expr} AS stratum, COUNT(*) AS row_count FROM {table_name} GROUP BY {expr}"
+        )
+        counts = pd.Series(
+            counts["row_count"].astype(int).to_numpy(), index=counts["stratum"]
+        )
+        if allocation == "proportional":
+            quotas = counts * n / counts.sum()
+        elif allocation == "equal":
+            quotas = pd.Series(n / len(counts), index=counts.index)
+        else:
+            raise ValueError(f"Unknown allocation {allocation}")
+        quotas = quotas.clip(upper=counts)
+        # Hand out the remainder left by rounding down to the largest fractional parts
+        sizes = np.floor(quotas).astype(int)
+        spare = min(n, int(counts.sum())) - sizes.sum()
+        room = (quotas - sizes).where(sizes < counts, -1)
+        for stratum in room.sort_values(ascending=False).index[: max(spare, 0)]:
+            sizes[stratum] += 1
+
+        ids = self.reservoir_sample(
+            f"SELECT db_id, {expr} AS stratum FROM {table_name}",
+            sizes.to_dict(),
+            seed=seed,
+            by="stratum",
         )
+        if ids.empty:
+            return self.select_in(table, "db_id", [])
+        return self.select_in(table, "db_id", ids["db_id"].astype(int).tolist())
 
     def select_top(self, table, n):
         """
         Query n first rows of the table
         """
-        return self.execute(f"SELECT * FROM {table} LIMIT {n};")
+        return self.execute(
+            f"SELECT * FROM {quote_identifier(table)} LIMIT %s;", args=(int(n),)
+        )
 
     def head(self, table, n=5):
         rows = self.select_top(table, n)
@@ -308,28 +1849,15 @@ CREATE TABLE IF NOT EXISTS `prices_coordinates_data` (
         Upload a file to the table
         """
         print(f"Uploading {file_name} to {table}")
-        cur = self.conn.cursor()
-        sql = f"""
-LOAD DATA LOCAL INFILE '{file_name}'
-INTO TABLE `{table}`
-FIELDS TERMINATED BY ',' OPTIONALLY ENCLOSED by '"'
-LINES STARTING BY '' TERMINATED BY '\n';
-"""
-        cur.execute(sql)
+        sql, args = load_data_sql(table, file_name)
+        self.execute(sql, args=args)
         print(f"Data loaded successfully into table `{table}` from '{file_name}'.")
 
     def get_file_from_url(self, file_path, url, verbose=False):
         """
         Downloads a file specified by its url
         """
-        if not os.path.exists(file_path):
-            with open(file_path, "wb") as out_file:
-                print(f"Downloading file {file_path} from {url}")
-                content = requests.get(url, stream=True).content
-                out_file.write(content)
-        else:
-            if verbose:
-                print(f"File {file_path} exists. Skipping download.")
+        self.downloader.download(url, file_path, verbose=verbose)
 
     def get_pp_data(self):
         files = []
@@ -339,9 +1867,8 @@ LINES STARTING BY '' TERMINATED BY '\n';
                 file_name = f"pp-{year}-part{part}.csv"
                 file_path = f"data/{file_name}"
                 url = f"http://prod.publicdata.landregistry.gov.uk.s3-website-eu-west-1.amazonaws.com/{file_name}"
-                self.get_file_from_url(file_path, url)
-                files.append(file_path)
-        return files
+                files.append((url, file_path))
+        return self.downloader.download_many(files)
 
     def get_postcode_data(self):
         self.get_file_from_url(
@@ -350,7 +1877,467 @@ LINES STARTING BY '' TERMINATED BY '\n';
         )
 
         if not os.path.exists("data/open_postcode_geo.csv"):
-            with zipfile.ZipFile("postcode_data.zip", "r") as zip_ref:
-                zip_ref.extractall("./")
+            with zipfile.ZipFile("data/open_postcode_geo.csv.zip", "r") as zip_ref:
+                zip_ref.extractall("data/")
 
         return ["data/open_postcode_geo.csv"]
+
+    def build_postcode_index(self, index=None):
+        """
+        Builds the in-process postcode index (by default postcode_index) from the postcode data
+        files, for geocoding postcodes without querying postcode_data
+        """
+        if index is None:
+            index = postcode_index
+        index.build(self.get_postcode_data())
+        return index
+
+
+def _sqlite_create_table(sql):
+    """
+    Translates a MariaDB CREATE TABLE statement into SQLite ones: column types keep their names
+    (SQLite only uses them for affinity), enums become TEXT, MariaDB-only attributes and table
+    options are dropped, and KEY clauses become separate CREATE INDEX statements.
+    """
+    table = re.search(r"TABLE\s+(?:IF NOT EXISTS\s+)?(`[^`]+`|\w+)", sql, re.I).group(1)
+    body, _, _ = sql.rpartition(")")
+    indexes = []
+    lines = []
+    for line in body.splitlines():
+        key = re.match(r"\s*KEY\s+(`[^`]+`|\w+)\s*(\(.*\))", line, re.I)
+        if key:
+            indexes.append(
+                f"CREATE INDEX IF NOT EXISTS {key.group(1)} ON {table} {key.group(2)}"
+            )
+            continue
+        line = re.sub(r"\benum\s*\([^)]*\)", "TEXT", line, flags=re.I)
+        line = re.sub(r"\s+COLLATE\s+\w+", "", line, flags=re.I)
+        line = re.sub(r"\s+unsigned\b", "", line, flags=re.I)
+        lines.append(line)
+    body = re.sub(r",\s*$", "", "\n".join(lines).rstrip())
+    return [body + "\n)"] + indexes
+
+
+@functools.lru_cache(maxsize=256)
+def sqlite_statements(sql):
+    """
+    Translates sql written for MariaDB, as used throughout Database, into a tuple of SQLite
+    statements. Session settings and key toggles have no SQLite equivalent and are dropped.
+    """
+    statements = []
+    for statement in re.split(r";\s*(?:\n|$)", sql):
+        statement = statement.strip()
+        words = statement.split(None, 3)
+        head = " ".join(words[:2]).upper()
+        if not statement or head.startswith("SET "):
+            continue
+        if head == "START TRANSACTION":
+            # Take the write lock up front so concurrent writers wait for it rather than fail
+            statements.append("BEGIN IMMEDIATE")
+        elif head == "CREATE TABLE":
+            statements += _sqlite_create_table(statement)
+        elif head == "CREATE INDEX":
+            # SQLite has no prefix indexes, so index the whole column
+            statements.append(re.sub(r"(\w+)\(\d+\)", r"\1", statement))
+        elif head == "SHOW TABLES":
+            statements.append(
+                "SELECT name FROM sqlite_master WHERE type = 'table' AND name "
+                + statement.split(None, 2)[2]
+            )
+        elif head == "ALTER TABLE" and re.search(r"\b(DISABLE|ENABLE) KEYS\b", statement, re.I):
+            continue
+        elif head == "ALTER TABLE":
+            # Generated columns can only be added as VIRTUAL, which SQLite can still index
+            statements.append(re.sub(r"\bSTORED\b", "VIRTUAL", statement, flags=re.I))
+        else:
+            # Multi-table DELETE alias FROM table AS alias JOIN ... becomes a rowid subquery
+            delete = re.match(
+                r"DELETE\s+(\w+)\s+FROM\s+(\w+)\s+AS\s+\1\b(.*)", statement, re.I | re.S
+            )
+            if delete:
+                alias, table, rest = delete.groups()
+                statement = f"DELETE FROM {table} WHERE rowid IN (SELECT {alias}.rowid FROM {table} AS {alias}{rest})"
+            statements.append(statement)
+    return tuple(statements)
+
+
+def _sqlite_value(value):
+    """
+    Converts a bound argument to a type SQLite stores the way MariaDB would compare it
+    """
+    if isinstance(value, datetime.datetime):
+        if value.time() == datetime.time():
+            return value.date().isoformat()
+        return value.isoformat(" ")
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    return value
+
+
+# pymysql type codes of SQLite declared type names, matched by prefix in order
+SQLITE_TYPE_CODES = [
+    ("datetime", FIELD_TYPE.DATETIME),
+    ("date", FIELD_TYPE.DATE),
+    ("decimal", FIELD_TYPE.NEWDECIMAL),
+    ("bigint", FIELD_TYPE.LONGLONG),
+    ("smallint", FIELD_TYPE.SHORT),
+    ("tinyint", FIELD_TYPE.TINY),
+    ("int", FIELD_TYPE.LONG),
+]
+
+
+def _sqlite_type_code(type_name):
+    type_name = type_name.lower()
+    for prefix, type_code in SQLITE_TYPE_CODES:
+        if type_name.startswith(prefix):
+            return type_code
+    return None
+
+
+class LocalCursor:
+    """
+    Cursor over an SQLite connection that takes the same MariaDB sql and %s placeholders as a
+    pymysql cursor, and like it returns the number of affected rows from execute
+    """
+
+    def __init__(self, cur, connection=None):
+        self._cur = cur
+        self._connection = connection
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def description(self):
+        """
+        The result columns in pymysql's layout. SQLite doesn't type result columns, so each
+        takes the type code and nullability of the table columns declared with its name, and
+        None for names that no table, or tables disagreeing on their type, declares.
+        """
+        description = self._cur.description
+        if description is None or self._connection is None:
+            return description
+        declared = self._connection.declared_columns()
+        columns = []
+        for column in description:
+            type_code, null_ok = declared.get(column[0], (None, True))
+            columns.append((column[0], type_code, None, None, None, None, null_ok))
+        return columns
+
+    def _bind(self, statement, args):
+        if args is None:
+            return statement, ()
+        statement = statement.replace("%s", "?").replace("%%", "%")
+        return statement, [_sqlite_value(value) for value in args]
+
+    def execute(self, sql, args=None):
+        rows = 0
+        for statement in sqlite_statements(sql):
+            self._cur.execute(*self._bind(statement, args))
+            rows = max(self._cur.rowcount, 0)
+        return rows
+
+    def executemany(self, sql, args_seq):
+        (statement,) = sqlite_statements(sql)
+        statement = statement.replace("%s", "?").replace("%%", "%")
+        self._cur.executemany(
+            statement, ([_sqlite_value(value) for value in args] for args in args_seq)
+        )
+        return max(self._cur.rowcount, 0)
+
+    def fetchall(self):
+        return self._cur.fetchall()
+
+    def fetchmany(self, size):
+        return self._cur.fetchmany(size)
+
+    def close(self):
+        self._cur.close()
+
+
+class LocalConnection:
+    """
+    SQLite connection with the parts of the pymysql connection interface used by
+    ConnectionPool and Database
+    """
+
+    def __init__(self, conn):
+        self._conn = conn
+        self._declared = (None, {})
+
+    def cursor(self, cursor_class=None):
+        # Every SQLite cursor steps through its result, so there is no separate streaming class
+        return LocalCursor(self._conn.cursor(), self)
+
+    def declared_columns(self):
+        """
+        Returns the pymysql type code and nullability of every column name declared in the
+        database's tables, rereading them only when the schema has changed
+        """
+        (version,) = self._conn.execute("PRAGMA schema_version").fetchone()
+        if self._declared[0] != version:
+            declared = {}
+            conflicting = set()
+            tables = self._conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+            for (table,) in tables.fetchall():
+                columns = self._conn.execute(
+                    'SELECT name, type, "notnull", pk FROM pragma_table_xinfo(?)', (table,)
+                )
+                for name, type_name, notnull, pk in columns.fetchall():
+                    type_code = _sqlite_type_code(type_name)
+                    if name in declared and declared[name][0] != type_code:
+                        conflicting.add(name)
+                    # An INTEGER PRIMARY KEY is the rowid, which is never null
+                    null_ok = not (notnull or pk) or declared.get(name, (None, False))[1]
+                    declared[name] = (type_code, null_ok)
+            for name in conflicting:
+                declared[name] = (None, True)
+            self._declared = (version, declared)
+        return self._declared[1]
+
+    def ping(self, reconnect=True):
+        pass
+
+    def close(self):
+        self._conn.close()
+
+
+def _sqlite_crc32(value):
+    if value is None:
+        return None
+    return zlib.crc32(str(value).encode())
+
+
+def _sqlite_concat_ws(separator, *values):
+    return separator.join(str(value) for value in values if value is not None)
+
+
+def _sqlite_date_part(index):
+    def date_part(value):
+        if value is None:
+            return None
+        return int(str(value)[:10].split("-")[index])
+
+    return date_part
+
+
+# Return date and datetime columns as the same types pymysql does
+sqlite3.register_converter(
+    "date", lambda value: datetime.date.fromisoformat(value.decode()[:10])
+)
+sqlite3.register_converter(
+    "datetime", lambda value: datetime.datetime.fromisoformat(value.decode())
+)
+
+
+class LocalDatabase(Database):
+    """
+    Database backed by an embedded SQLite file at path instead of a MariaDB server.
+
+    It takes the same sql as Database, translated by sqlite_statements, so the table builds,
+    indexes and queries, and everything in assess that takes a Database, run against it
+    unchanged and in process. The MariaDB functions used by the package (YEAR, MONTH, NOW,
+    GREATEST, CRC32, BIN, CONCAT_WS) are provided as SQLite functions. Csv files are loaded with batched
+    inserts, one file at a time, as SQLite has a single writer.
+    """
+
+    def __init__(self, path="data/property_prices.db", pool_size=4):
+        self.username = None
+        self.password = None
+        self.path = path
+        self.url = os.path.abspath(path) if path != ":memory:" else f"memory-{id(self)}"
+        self.port = None
+        self.database = "main"
+        self._downloader = None
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.pool = ConnectionPool(self._new_connection, size=pool_size)
+        # An in-memory database lives as long as one of its connections is open
+        self._keep_alive = self._new_connection() if path == ":memory:" else None
+
+    def _new_connection(self):
+        if self.path == ":memory:":
+            conn = sqlite3.connect(
+                f"file:{self.url}?mode=memory&cache=shared",
+                uri=True,
+                **self._connect_args(),
+            )
+        else:
+            conn = sqlite3.connect(self.path, **self._connect_args())
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("PRAGMA synchronous = NORMAL")
+        conn.create_function("YEAR", 1, _sqlite_date_part(0), deterministic=True)
+        conn.create_function("MONTH", 1, _sqlite_date_part(1), deterministic=True)
+        conn.create_function("CRC32", 1, _sqlite_crc32, deterministic=True)
+        conn.create_function(
+            "BIN", 1, lambda n: None if n is None else bin(int(n))[2:], deterministic=True
+        )
+        conn.create_function("GREATEST", -1, max, deterministic=True)
+        conn.create_function(
+            "NOW", 0, lambda: datetime.datetime.now().isoformat(" ", "seconds")
+        )
+        try:
+            conn.execute("SELECT LN(1), FLOOR(1)")
+        except sqlite3.OperationalError:
+            # SQLite builds without the math functions
+            conn.create_function("LN", 1, math.log, deterministic=True)
+            conn.create_function("FLOOR", 1, math.floor, deterministic=True)
+        try:
+            conn.execute("SELECT CONCAT_WS('|', 1)")
+        except sqlite3.OperationalError:
+            # Older than SQLite 3.44
+            conn.create_function("CONCAT_WS", -1, _sqlite_concat_ws, deterministic=True)
+        return LocalConnection(conn)
+
+    @staticmethod
+    def _connect_args():
+        return {
+            "isolation_level": None,
+            "check_same_thread": False,
+            "timeout": 600,
+            "detect_types": sqlite3.PARSE_DECLTYPES,
+        }
+
+    def connect(self):
+        """
+        Opens a connection to the SQLite database
+        """
+        return self._new_connection()
+
+    def list_existing_databases(self):
+        """
+        List existing databases
+        """
+        return self.execute("SELECT name FROM pragma_database_list")
+
+    def use_database(self, db_name):
+        """
+        The SQLite file is the database, so this only records db_name
+        """
+        self.database = db_name
+
+    def create_database(self, db_name="property_prices"):
+        """
+        The SQLite file is the database, so this only records db_name
+        """
+        self.use_database(db_name)
+
+    def get_processlist(self):
+        """
+        Returns an empty process list, as an embedded database has no server processes
+        """
+        return pd.DataFrame(columns=["Id", "User", "Command", "Time", "State", "Info"])
+
+    def kill_process(self, process_num):
+        print(f"WARNING: no process {process_num} to kill in an embedded database.")
+
+    def show_indexes(self, table_name):
+        """
+        Returns the indexes for table_name, with the columns of MariaDB's SHOW INDEXES
+        """
+        rows = []
+        for _, index_name, unique, _, _ in self.execute(
+            "SELECT * FROM pragma_index_list(%s)", args=(table_name,)
+        ):
+            for seq, _, column in self.execute(
+                "SELECT * FROM pragma_index_info(%s)", args=(index_name,)
+            ):
+                rows.append((table_name, int(not unique), index_name, seq + 1, column))
+        return pd.DataFrame(
+            rows, columns=["Table", "Non_unique", "Key_name", "Seq_in_index", "Column_name"]
+        )
+
+    def query_plan(self, sql, args=None):
+        """
+        Returns the index used (key) and the access type (SEARCH or SCAN) for the first table
+        in the plan of sql, as a dict. SQLite's EXPLAIN QUERY PLAN gives no row estimates, so
+        rows is None.
+        """
+        for *_, detail in self.execute(f"EXPLAIN QUERY PLAN {sql}", args=args):
+            step = re.match(
+                r"(SEARCH|SCAN)\s+(?:TABLE\s+)?\S+(?:.*?\bUSING (?:COVERING )?INDEX (\S+))?",
+                detail,
+            )
+            if step:
+                return {"key": step.group(2), "type": step.group(1), "rows": None}
+        return {"key": None, "type": None, "rows": None}
+
+    def get_columns(self, table):
+        """
+        Returns column names of table
+        """
+        # table_xinfo also lists generated columns, which table_info leaves out
+        cols = self.execute("SELECT name, hidden FROM pragma_table_xinfo(%s)", args=(table,))
+        return [name for name, hidden in cols if hidden != 1]
+
+    def _create_table_with_key(self, table_name, create_table_cmd):
+        """
+        Runs create_table_cmd with db_id as the auto incrementing primary key
+        """
+        sql = re.sub(
+            r"`db_id`\s+bigint\(20\)\s+unsigned\s+NOT NULL",
+            "`db_id` INTEGER PRIMARY KEY",
+            create_table_cmd,
+            flags=re.I,
+        )
+        self.execute(sql)
+
+    def bulk_load(self, table, csv_files, max_workers=None):
+        # Writers would only queue for SQLite's write lock, so load one file at a time
+        return super().bulk_load(table, csv_files, max_workers=1)
+
+    def _bulk_load_file(self, table, file_name, batch_size=50000):
+        lines = count_lines(file_name)
+        start = time.perf_counter()
+        info = self.execute("SELECT name, type FROM pragma_table_info(%s)", args=(table,))
+        columns = [(name, type_name.lower()) for name, type_name in info if name != "db_id"]
+        # Convert fields as LOAD DATA would: dates lose their time, empty numbers become NULL
+        converters = []
+        for _, type_name in columns:
+            if type_name.startswith("date") and not type_name.startswith("datetime"):
+                converters.append(lambda v: v[:10])
+            elif type_name.startswith(("int", "bigint", "smallint", "decimal")):
+                converters.append(lambda v: v if v != "" else None)
+            else:
+                converters.append(None)
+        sql = f"INSERT INTO {quote_identifier(table)} ({', '.join(map(quote_identifier, [name for name, _ in columns]))}) VALUES ({', '.join(['%s'] * len(columns))})"
+
+        rows = 0
+        with open(file_name, newline="") as file, self.cursor() as cur:
+            cur.execute("START TRANSACTION;")
+            try:
+                reader = csv.reader(file)
+                while True:
+                    batch = [
+                        [
+                            value if convert is None else convert(value)
+                            for value, convert in zip(row, converters)
+                        ]
+                        for row in itertools.islice(reader, batch_size)
+                    ]
+                    if not batch:
+                        break
+                    rows += cur.executemany(sql, batch)
+                cur.execute("COMMIT;")
+            except Exception:
+                cur.execute("ROLLBACK;")
+                raise
+        seconds = time.perf_counter() - start
+        rows_per_sec = rows / max(seconds, 1e-9)
+        print(f"Loaded {rows} rows from {file_name} in {seconds:.1f} s ({rows_per_sec:.0f} rows/s).")
+        return file_name, lines, rows, seconds, rows_per_sec
+
+    def upload_file(self, table, file_name):
+        """
+        Upload a file to the table
+        """
+        print(f"Uploading {file_name} to {table}")
+        self._bulk_load_file(table, file_name)
+        print(f"Data loaded successfully into table `{table}` from '{file_name}'.")
@@ -1,32 +1,111 @@
 # This file contains code for suporting addressing questions in the data
 
 from . import assess
+from . import instrument
+from .assess import km_to_degrees
 
 """Address a particular question that arises from the data"""
 
-import matplotlib.pyplot as plt
-import statsmodels.api as sm
 from datetime import timedelta
-from sklearn.model_selection import train_test_split
+from collections import namedtuple, OrderedDict
 import pandas as pd
-from sklearn.metrics import mean_squared_error, r2_score
 import math
-import geopandas as 
-from shapely.geometry import Point
+import numpy as np
+import os
+import json
+import time
+import hashlib
+import threading
+from .lazy import lazy_module
 
+# Heavy dependencies are imported the first time they are used
+plt = lazy_module("matplotlib.pyplot")
+sm = lazy_module("statsmodels.api")
+model_selection = lazy_module("sklearn.model_selection")
+metrics = lazy_module("sklearn.metrics")
+stats = lazy_module("scipy.stats")
 
-def km_to_degrees(km):
+
+FEATURES = [
+    "local_median_price",
+    "property_type",
+    "dist_to_nearest_school",
+    "dist_to_nearest_place_of_worship",
+    "dist_to_nearest_park",
+]
+
+
+def design_matrix(df, columns=None):
+    """
+    Builds the regression design matrix from a labelled DataFrame, one-hot encoding property_type.
+    If columns is given, the matrix is aligned to them and missing dummies are filled with 0.
+    """
+    X = pd.get_dummies(df[FEATURES], columns=["property_type"], dtype=int)
+    X = sm.add_constant(X, has_constant="add")
+    if columns is not None:
+        X = X.reindex(columns=columns, fill_value=0)
+    return X
+
+
+# Result of estimate_price. params and cov_params are the fitted coefficients and their
+# covariance, y_test, y_pred and residuals are arrays over the held out validation rows, and
+# prediction is the one row summary frame (mean, confidence and prediction intervals) at the
+# requested point.
+PricePrediction = namedtuple(
+    "PricePrediction",
+    [
+        "params",
+        "cov_params",
+        "rmse",
+        "r2",
+        "y_test",
+        "y_pred",
+        "residuals",
+        "prediction",
+        "n_train",
+    ],
+)
+
+
+@instrument.stage("address.train_price_model")
+def train_price_model(df, test_size=0.2, random_state=42):
     """
-    Approximately converts km to degrees
+    Fits the OLS price model on a labelled DataFrame, holding out test_size of the rows.
+    Returns the fitted results along with the held out design matrix and prices.
     """
-    # Circumference of the Earth is ~40,000
-    # 1 degree is around 40,000/360=111km
-    return km / (40000 / 360)
+    X = design_matrix(df)
+    y = df["price"]
+    X_train, X_test, y_train, y_test = model_selection.train_test_split(
+        X, y, test_size=test_size, random_state=random_state
+    )
+    with instrument.stage("address.ols_fit"):
+        results = sm.OLS(y_train, X_train).fit()
+    return results, X_test, y_test
 
 
-def predict_price(db, latitude, longitude, date, property_type, bbox_length_km=15):
-    """Price prediction for UK housing"""
+@instrument.stage("address.validate_price_model")
+def validate_price_model(results, X_test, y_test):
+    """
+    Scores a fitted price model on held out rows, returning the RMSE, R-squared, predicted
+    prices and residuals
+    """
+    y_test = np.asarray(y_test, dtype=float)
+    y_pred = np.asarray(results.predict(X_test), dtype=float)
+    rmse = math.sqrt(metrics.mean_squared_error(y_test, y_pred))
+    r2 = metrics.r2_score(y_test, y_pred)
+    return rmse, r2, y_pred, y_test - y_pred
+
 
+@instrument.stage("address.estimate_price")
+def estimate_price(
+    db, latitude, longitude, date, property_type, bbox_length_km=15, alpha=0.05
+):
+    """
+    Trains, validates and applies the price model for one property without plotting or printing.
+    Returns a PricePrediction. POIs missing from the cache are fetched with osmnx, which imports
+    matplotlib, selecting the non-interactive Agg backend unless one was chosen already; with a
+    warm cache nothing here imports a plotting library.
+    """
     # Select bounding box around the housing location
     bbox_length = km_to_degrees(bbox_length_km)
 
@@ -43,84 +122,577 @@ def predict_price(db, latitude, longitude, date, property_type, bbox_length_km=1
         start_date=start_date,
         end_date=end_date,
     )
-    df = assess.labelled(data, latitude, longitude, bbox_length)
-
-    # Train a linear model
-    X = df[
-        [
-            "local_median_price",
-            "property_type",
-            "dist_to_nearest_school",
-            "dist_to_nearest_place_of_worship",
-            "dist_to_nearest_park",
-        ]
-    ]
-    X = pd.get_dummies(X, columns=["property_type"])
-    y = df["price"]
-    cols = [c for c in X.columns if c.startswith("property_type")]
-    X[cols] = X[cols].astype(int)
-    X = sm.add_constant(X)
+    pois = assess.get_pois_from_bbox(
+        *assess.get_bbox_around(latitude, longitude, bbox_length)
+    )
+    engine = assess.NearestPOIEngine(pois)
+    df = assess.labelled(data, latitude, longitude, bbox_length, engine=engine)
+
+    # Train and validate a linear model
+    results, X_test, y_test = train_price_model(df)
+    rmse, r2, y_pred, residuals = validate_price_model(results, X_test, y_test)
+
+    # Provide prediction
+    point = pd.DataFrame(
+        {
+            "property_type": [property_type],
+            "latitude": [latitude],
+            "longitude": [longitude],
+        }
+    )
+    point = assess.label_osm_features(assess.convert_df_to_gdf(point), engine)
+    point["local_median_price"] = assess.local_median_price_at(df, point)
+    X_new = design_matrix(point, columns=results.params.index)
+    prediction = results.get_prediction(X_new).summary_frame(alpha)
 
-    X_train, X_test, y_train, y_test = train_test_split(
-        X, y, test_size=0.2, random_state=42
+    return PricePrediction(
+        params=results.params,
+        cov_params=results.cov_params(),
+        rmse=rmse,
+        r2=r2,
+        y_test=np.asarray(y_test, dtype=float),
+        y_pred=y_pred,
+        residuals=residuals,
+        prediction=prediction,
+        n_train=int(results.nobs),
     )
-    model = sm.OLS(y_train, X_train)
-    results = model.fit()
 
-    # Validate quality of model
-    y_pred = results.get_prediction(X_test).summary_frame(0.05)
 
-    plt.scatter(y_test, y_pred["mean"])
+def plot_predicted_vs_actual(result):
+    """
+    Scatters the predicted against the actual validation prices of a PricePrediction
+    """
+    plt.scatter(result.y_test, result.y_pred)
     plt.xlabel("Actual Prices")
     plt.ylabel("Predicted Prices")
     plt.title("Actual Prices vs. Predicted Prices")
     plt.show()
 
-    residuals = y_test - y_pred["mean"]
-    plt.scatter(y_test, residuals)
+
+def plot_residuals(result):
+    """
+    Scatters the validation residuals of a PricePrediction against the actual prices
+    """
+    plt.scatter(result.y_test, result.residuals)
     plt.axhline(y=0, color="red", linestyle="--")
     plt.xlabel("Actual Prices")
     plt.ylabel("Residuals")
     plt.title("Residual Plot")
     plt.show()
 
-    # Calculate Mean Squared Error
-    rmse = math.sqrt(mean_squared_error(y_test, y_pred["mean"]))
 
-    # Calculate R-squared
-    r2 = r2_score(y_test, y_pred["mean"])
+@instrument.stage("address.predict_price")
+def predict_price(
+    db,
+    latitude,
+    longitude,
+    date,
+    property_type,
+    bbox_length_km=15,
+    plot=False,
+    verbose=False,
+    registry=None,
+    tile_km=5,
+    window_days=90,
+):
+    """Price prediction for UK housing.
 
-    print(f"Root Mean Squared Error: {rmse}")
-    print(f"R-squared: {r2}")
+    Returns the predicted mean price. The regional model covering the request (see
+    predict_prices) is taken from model_registry, or fitted and stored there on a miss, unless
+    another ModelRegistry is given as registry.
+
+    With plot, or registry=False, a model centred on the request is fitted and validated on a
+    held out split instead, and its validation plots and scores are shown with plot and verbose;
+    use estimate_price for the full result.
+    """
+    if plot or registry is False:
+        result = estimate_price(
+            db, latitude, longitude, date, property_type, bbox_length_km=bbox_length_km
+        )
+
+        if plot:
+            plot_predicted_vs_actual(result)
+            plot_residuals(result)
+
+        if verbose:
+            print(f"Root Mean Squared Error: {result.rmse}")
+            print(f"R-squared: {result.r2}")
+
+        # Warning if poor qality
+        if result.r2 < 0.5:
+            print(f"WARNING: Low R-squared, likely poor quality model.")
+
+        return result.prediction["mean"]
+
+    if registry is None:
+        registry = model_registry
+    key = model_key(db, latitude, longitude, date, bbox_length_km, tile_km, window_days)
+    model = registry.model(db, key)
+    if model is None:
+        return pd.Series([np.nan], name="mean")
+
+    if verbose:
+        print(f"R-squared: {model.rsquared}")
 
     # Warning if poor qality
-    if r2 < 0.5:
+    if model.rsquared < 0.5:
         print(f"WARNING: Low R-squared, likely poor quality model.")
 
-    # Provide prediction
+    point = pd.DataFrame(
+        {
+            "property_type": [property_type],
+            "latitude": [latitude],
+            "longitude": [longitude],
+        }
+    )
+    point = assess.label_osm_features(assess.convert_df_to_gdf(point), registry.engine(key))
+    return model.predict(point)["mean"]
+
+
+class PriceModel:
+    """
+    A fitted regional price model, keeping only what is needed to predict from it: the
+    coefficients, their covariance, the residual variance and degrees of freedom, and the
+    locations and prices of the training rows for the local median price feature. The BallTree
+    over the training rows is built on the first prediction and kept with the model.
+    """
+
+    def __init__(self, params, cov_params, scale, df_resid, rsquared, train, created=None):
+        self.params = params
+        self.cov_params = cov_params
+        self.scale = scale
+        self.df_resid = df_resid
+        self.rsquared = rsquared
+        self.train = train
+        self.created = time.time() if created is None else created
+        self._median_engine = None
+
+    @classmethod
+    def from_results(cls, results, train_gdf):
+        """
+        Keeps a statsmodels OLS fit along with the latitude, longitude and price of train_gdf
+        """
+        train = pd.DataFrame(
+            {
+                "latitude": train_gdf.geometry.y.to_numpy(),
+                "longitude": train_gdf.geometry.x.to_numpy(),
+                "price": train_gdf["price"].to_numpy(dtype=float),
+            }
+        )
+        return cls(
+            results.params,
+            results.cov_params(),
+            float(results.scale),
+            float(results.df_resid),
+            float(results.rsquared),
+            train,
+        )
+
+    @property
+    def n_train(self):
+        return len(self.train)
+
+    @property
+    def median_engine(self):
+        if self._median_engine is None:
+            self._median_engine = assess.LocalMedianPriceEngine(
+                self.train["latitude"], self.train["longitude"], self.train["price"]
+            )
+        return self._median_engine
+
+    @instrument.stage("address.price_model_predict")
+    def predict(self, points_gdf, alpha=0.05):
+        """
+        Predicts prices for points labelled with the POI distance features, returning the same
+        columns as statsmodels' summary_frame
+        """
+        points_gdf = points_gdf.copy()
+        points_gdf["local_median_price"] = self.median_engine.at(points_gdf)
+        X = design_matrix(points_gdf, columns=self.params.index).to_numpy(dtype=float)
+        cov = self.cov_params.to_numpy()
+        mean = X @ self.params.to_numpy()
+        mean_se = np.sqrt(np.einsum("ij,jk,ik->i", X, cov, X))
+        obs_se = np.sqrt(mean_se**2 + self.scale)
+        q = stats.t.ppf(1 - alpha / 2, self.df_resid)
+        return pd.DataFrame(
+            {
+                "mean": mean,
+                "mean_se": mean_se,
+                "mean_ci_lower": mean - q * mean_se,
+                "mean_ci_upper": mean + q * mean_se,
+                "obs_ci_lower": mean - q * obs_se,
+                "obs_ci_upper": mean + q * obs_se,
+            },
+            index=points_gdf.index,
+        )
+
+    def save(self, path):
+        """
+        Writes the model to path as an npz file, replacing any existing file atomically
+        """
+        def write(part_path):
+            with open(part_path, "wb") as file:
+                np.savez(
+                    file,
+                    columns=np.array(self.params.index, dtype=str),
+                    params=self.params.to_numpy(),
+                    cov_params=self.cov_params.to_numpy(),
+                    stats=np.array([self.scale, self.df_resid, self.rsquared, self.created]),
+                    train=self.train[["latitude", "longitude", "price"]].to_numpy(),
+                )
+
+        assess.write_atomically(path, write)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            columns = list(data["columns"])
+            scale, df_resid, rsquared, created = data["stats"]
+            return cls(
+                pd.Series(data["params"], index=columns),
+                pd.DataFrame(data["cov_params"], index=columns, columns=columns),
+                scale,
+                df_resid,
+                rsquared,
+                pd.DataFrame(data["train"], columns=["latitude", "longitude", "price"]),
+                created=created,
+            )
+
+
+def model_key(db, latitude, longitude, date, bbox_length_km=15, tile_km=5, window_days=90):
+    """
+    Returns the registry key of the regional model covering a request: the tile of side tile_km
+    and the window of window_days it falls in, along with the database and feature set
+    """
+    tile = km_to_degrees(tile_km)
+    window = (pd.Timestamp(date) - pd.Timestamp("1995-01-01")).days // window_days
+    return (
+        getattr(db, "url", None),
+        getattr(db, "database", None),
+        bbox_length_km,
+        tile_km,
+        window_days,
+        int(np.floor(latitude / tile)),
+        int(np.floor(longitude / tile)),
+        int(window),
+        list(FEATURES),
+    )
 
-    X_new_data = {
-        "property_type": property_type,
-        "latitude": [latitude],
-        "longitude": [longitude],
-        "geometry": Point(longitude, latitude),
-    }
-    data.loc[0] = X_new_data
-    X_new_data_labelled = assess.labelled(data, latitude, longitude, bbox_length)
-    # Train a linear model
-    X_new = X_new_data_labelled[
-        [
-            "local_median_price",
-            "property_type",
-            "dist_to_nearest_school",
-            "dist_to_nearest_place_of_worship",
-            "dist_to_nearest_park",
-        ]
+
+def model_region(key):
+    """
+    Returns the (latitude, longitude, bbox_length, start_date, end_date) of the training data
+    for a model key. The region reaches bbox_length_km / 2 beyond the furthest point of the tile
+    and 300 days either side of the window.
+    """
+    bbox_length_km, tile_km, window_days, lat_tile, lon_tile, window = key[2:8]
+    tile = km_to_degrees(tile_km)
+    window_start = pd.Timestamp("1995-01-01") + timedelta(window * window_days)
+    return (
+        (lat_tile + 0.5) * tile,
+        (lon_tile + 0.5) * tile,
+        km_to_degrees(bbox_length_km + tile_km),
+        (window_start - timedelta(300)).date(),
+        (window_start + timedelta(window_days + 300)).date(),
+    )
+
+
+@instrument.stage("address.fit_regional_model")
+def fit_regional_model(db, key, min_training_rows=20, engine=None):
+    """
+    Fits the price model on the region of key, returning a PriceModel, or None if there are
+    fewer than min_training_rows training rows, or than model parameters, once rows missing a
+    feature are dropped. engine is the region's NearestPOIEngine, built
+    with region_engine if not given.
+    """
+    latitude, longitude, bbox_length, start_date, end_date = model_region(key)
+    data = assess.query(
+        db,
+        latitude,
+        longitude,
+        bbox_length=bbox_length,
+        start_date=start_date,
+        end_date=end_date,
+    )
+    if len(data) < min_training_rows:
+        print(
+            f"Only {len(data)} training rows around ({latitude:.3f}, {longitude:.3f}) from {start_date} to {end_date}."
+        )
+        return None
+
+    if engine is None:
+        engine = region_engine(key)
+    train = assess.labelled(data, latitude, longitude, bbox_length, engine=engine)
+    train = train.dropna(subset=FEATURES + ["price"])
+    X = design_matrix(train)
+    if len(train) < max(min_training_rows, X.shape[1]):
+        print(
+            f"Only {len(train)} training rows with every feature around ({latitude:.3f}, {longitude:.3f}) from {start_date} to {end_date}."
+        )
+        return None
+    with instrument.stage("address.ols_fit"):
+        results = sm.OLS(train["price"], X).fit()
+    return PriceModel.from_results(results, train)
+
+
+def region_engine(key):
+    """
+    Returns a NearestPOIEngine over the POIs of the region of key
+    """
+    latitude, longitude, bbox_length = model_region(key)[:3]
+    pois = assess.get_pois_from_bbox(
+        *assess.get_bbox_around(latitude, longitude, bbox_length)
+    )
+    return assess.NearestPOIEngine(pois)
+
+
+class ModelRegistry:
+    """
+    Store of fitted regional price models, keyed by model_key.
+
+    Models are kept in memory, up to max_entries and evicting the least recently used, and with
+    cache_dir are also written there as npz files. Models older than max_age seconds are refitted,
+    and once the directory is over max_bytes the least recently used files are removed. The
+    models trained on a database are dropped whenever its tables change.
+
+    The NearestPOIEngine of each region is kept in memory too (see engine), so that a warm
+    prediction neither reloads and projects the region's POIs nor rebuilds their KD-trees.
+    """
+
+    def __init__(
+        self,
+        cache_dir="data/model_registry",
+        max_entries=64,
+        max_age=30 * 24 * 3600,
+        max_bytes=256 << 20,
+    ):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._engines = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def _source_prefix(self, source):
+        return hashlib.sha1(json.dumps(list(source)).encode()).hexdigest()[:12]
+
+    def path(self, key):
+        # Prefixed by the database, so that clear can find the files of one database
+        name = hashlib.sha1(json.dumps(key).encode()).hexdigest()
+        return os.path.join(self.cache_dir, f"{self._source_prefix(key[:2])}-{name}.npz")
+
+    def _is_fresh(self, model):
+        return time.time() - model.created < self.max_age
+
+    def get(self, key):
+        """
+        Returns the model for key, or None if there is none or it has expired
+        """
+        name = json.dumps(key)
+        with self._lock:
+            model = self._entries.get(name)
+            if model is not None and self._is_fresh(model):
+                self._entries.move_to_end(name)
+                self.hits += 1
+                return model
+
+        if self.cache_dir:
+            path = self.path(key)
+            if os.path.exists(path):
+                model = PriceModel.load(path)
+                if self._is_fresh(model):
+                    # Record the use in the access time, keeping the fit time in the modified time
+                    os.utime(path, (time.time(), os.path.getmtime(path)))
+                    self._remember(name, model)
+                    with self._lock:
+                        self.disk_hits += 1
+                    return model
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, model):
+        """
+        Stores the model for key
+        """
+        self._remember(json.dumps(key), model)
+        if self.cache_dir:
+            path = self.path(key)
+            os.makedirs(self.cache_dir, exist_ok=True)
+            model.save(path)
+            self.evict(keep=[path])
+
+    def model(self, db, key, min_training_rows=20):
+        """
+        Returns the model for key, fitting and storing it if there is none
+        """
+        model = self.get(key)
+        if model is None:
+            model = fit_regional_model(
+                db, key, min_training_rows=min_training_rows, engine=self.engine(key)
+            )
+            if model is not None:
+                self.put(key, model)
+        return model
+
+    def engine(self, key):
+        """
+        Returns the NearestPOIEngine over the POIs of the region of key, building it with
+        region_engine if it isn't in memory or is older than max_age
+        """
+        name = json.dumps(key)
+        with self._lock:
+            entry = self._engines.get(name)
+            if entry is not None and time.time() - entry[0] < self.max_age:
+                self._engines.move_to_end(name)
+                return entry[1]
+        engine = region_engine(key)
+        with self._lock:
+            self._engines[name] = (time.time(), engine)
+            self._engines.move_to_end(name)
+            while len(self._engines) > self.max_entries:
+                self._engines.popitem(last=False)
+        return engine
+
+    def _remember(self, name, model):
+        with self._lock:
+            self._entries[name] = model
+            self._entries.move_to_end(name)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def evict(self, keep=()):
+        """
+        Removes expired model files, then least recently used ones other than those in keep
+        until the directory is within max_bytes
+        """
+        if not os.path.isdir(self.cache_dir):
+            return
+        now = time.time()
+        files = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".npz"):
+                path = os.path.join(self.cache_dir, name)
+                stat = os.stat(path)
+                if now - stat.st_mtime >= self.max_age and path not in keep:
+                    os.remove(path)
+                else:
+                    files.append((stat.st_atime, stat.st_size, path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            if path in keep:
+                continue
+            os.remove(path)
+            total -= size
+
+    def stats(self):
+        """
+        Returns hit and miss counts and the overall hit rate
+        """
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (lookups - self.misses) / lookups if lookups else 0.0,
+            "entries": len(self._entries),
+            "engines": len(self._engines),
+        }
+
+    def clear(self, db=None):
+        """
+        Empties the registry, including its files, or with db only the models trained on db.
+        Engines only depend on the POIs, so they are kept when db is given.
+        """
+        with self._lock:
+            if db is None:
+                prefix = ""
+                self._entries.clear()
+                self._engines.clear()
+            else:
+                source = [getattr(db, "url", None), getattr(db, "database", None)]
+                prefix = f"{self._source_prefix(source)}-"
+                for name in list(self._entries):
+                    if json.loads(name)[:2] == source:
+                        del self._entries[name]
+        if self.cache_dir and os.path.isdir(self.cache_dir):
+            for name in os.listdir(self.cache_dir):
+                if name.endswith(".npz") and name.startswith(prefix):
+                    os.remove(os.path.join(self.cache_dir, name))
+
+
+model_registry = ModelRegistry()
+
+
+@instrument.stage("address.predict_prices")
+def predict_prices(
+    db,
+    requests_df,
+    bbox_length_km=15,
+    tile_km=5,
+    window_days=90,
+    min_training_rows=20,
+    alpha=0.05,
+    registry=None,
+):
+    """
+    Batch price prediction for many requests at once, without plotting.
+
+    requests_df needs latitude, longitude, date and property_type columns. Requests are grouped
+    into tiles of side tile_km and date windows of window_days; each group is scored in one go by
+    a model trained on a region wide enough to cover a bbox_length_km box (and +/- 300 days)
+    around every request in it. Models are taken from model_registry, or fitted and stored there
+    on a miss, unless another ModelRegistry is given as registry, or registry is False.
+
+    Returns a DataFrame indexed like requests_df with the predicted mean, the confidence and
+    prediction intervals at level alpha, and the number of training rows used. Groups with fewer
+    than min_training_rows training rows get NaN predictions.
+    """
+    if registry is None:
+        registry = model_registry
+
+    keys = [
+        json.dumps(model_key(db, lat, lon, date, bbox_length_km, tile_km, window_days))
+        for lat, lon, date in zip(
+            requests_df["latitude"], requests_df["longitude"], requests_df["date"]
+        )
     ]
-    X_new = pd.get_dummies(X_new, columns=["property_type"])
-    cols = [c for c in X_new.columns if c.startswith("property_type")]
-    X_new[cols] = X_new[cols].astype(int)
-    X_new = sm.add_constant(X_new)[0:1]
 
-    prediction = results.get_prediction(X_new).summary_frame(0.05)["mean"]
-    return prediction
+    predictions = []
+    for name, group in requests_df.groupby(pd.Series(keys, index=requests_df.index)):
+        key = json.loads(name)
+        if registry is False:
+            engine = region_engine(key)
+            model = fit_regional_model(
+                db, key, min_training_rows=min_training_rows, engine=engine
+            )
+        else:
+            model = registry.model(db, key, min_training_rows=min_training_rows)
+            engine = registry.engine(key)
+        if model is None or model.n_train < min_training_rows:
+            print(f"Skipping {len(group)} requests.")
+            predictions.append(pd.DataFrame(index=group.index))
+            continue
+
+        points = assess.label_osm_features(assess.convert_df_to_gdf(group), engine)
+        summary = model.predict(points, alpha)
+        summary["n_train"] = model.n_train
+        predictions.append(summary)
+
+    columns = [
+        "mean",
+        "mean_se",
+        "mean_ci_lower",
+        "mean_ci_upper",
+        "obs_ci_lower",
+        "obs_ci_upper",
+        "n_train",
+    ]
+    return pd.concat(predictions).reindex(index=requests_df.index, columns=columns)
@@ -1,19 +1,45 @@
 from .config import *
 
 from . import access
+from . import instrument
 
-import osmnx as ox
 import pandas as pd
-import geopandas as gpd
-import matplotlib.pyplot as plt
-import seaborn as sns
 import numpy as np
-from sklearn.neighbors import BallTree
+import os
+import sys
+import json
+import time
+import hashlib
+import tempfile
+import weakref
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from .lazy import lazy_module
+
+# Heavy dependencies are imported the first time they are used
+ox = lazy_module("osmnx")
+gpd = lazy_module("geopandas")
+plt = lazy_module("matplotlib.pyplot")
+sns = lazy_module("seaborn")
+pa = lazy_module("pyarrow")
+ds = lazy_module("pyarrow.dataset")
+pq = lazy_module("pyarrow.parquet")
+neighbors = lazy_module("sklearn.neighbors")
 
 
 """Place commands in this file to assess the data you have downloaded. How are missing values encoded, how are outliers encoded? What do columns represent, makes rure they are correctly labeled. How is the data indexed. Crete visualisation routines to assess the data (e.g. in bokeh). Ensure that date formats are correct and correctly timezoned."""
 
 
+def km_to_degrees(km):
+    """
+    Approximately converts km to degrees
+    """
+    # Circumference of the Earth is ~40,000
+    # 1 degree is around 40,000/360=111km
+    return km / (40000 / 360)
+
+
 def get_bbox_around(latitude, longitude, bbox_length):
     """
     Returns the bounding box centred at (latitude, longitude) with side length bbox_length
@@ -29,17 +55,165 @@ def get_pcd_nulls_df(db: access.Database):
     """
     Generates and returns the null counts for each column as a DataFrame
     """
-    cols = db.get_columns("prices_coordinates_data")
-    dfs = []
-    for c in cols:
-        dfs.append(
-            db.execute_to_df(
-                f"SELECT COUNT({c}) as {c} FROM prices_coordinates_data WHERE {c} = '';"
-            )
+    profile = profile_table(db, "prices_coordinates_data")
+    return profile[["empty"]].T.reset_index(drop=True)
+
+
+# Number of HyperLogLog registers kept per column for distinct count estimates
+HLL_REGISTERS = 64
+
+
+def _profile_sql(table, columns, where=""):
+    """
+    Builds one query that computes row count and, per column, NULL and empty counts, min, max
+    and HyperLogLog registers of the CRC32 hash. Any arguments are those of the where clause.
+    """
+    bits = HLL_REGISTERS.bit_length() - 1
+    exprs = ["COUNT(*) AS row_count"]
+    for i, c in enumerate(columns):
+        c = access.quote_identifier(c)
+        exprs += [
+            f"SUM(CASE WHEN {c} IS NULL THEN 1 ELSE 0 END) AS nulls_{i}",
+            f"SUM(CASE WHEN {c} = '' THEN 1 ELSE 0 END) AS empty_{i}",
+            f"MIN({c}) AS min_{i}",
+            f"MAX({c}) AS max_{i}",
+        ]
+        # Register j holds the largest position of the first set bit among hashes in bucket j
+        exprs += [
+            f"MAX(CASE WHEN CRC32({c}) & {HLL_REGISTERS - 1} = {j} THEN {33 - bits} - LENGTH(BIN(CRC32({c}) >> {bits})) ELSE 0 END) AS hll_{i}_{j}"
+            for j in range(HLL_REGISTERS)
+        ]
+    return f"SELECT {', '.join(exprs)} FROM {access.quote_identifier(table)} {where}"
+
+
+def _to_json_value(value):
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    if value is None or isinstance(value, (int, str)):
+        return value
+    return float(value)
+
+
+def _parse_profile_row(row, columns):
+    row = row.iloc[0]
+    return {
+        "row_count": int(row["row_count"]),
+        "columns": {
+            c: {
+                "nulls": int(row[f"nulls_{i}"] or 0),
+                "empty": int(row[f"empty_{i}"] or 0),
+                "min": _to_json_value(row[f"min_{i}"]),
+                "max": _to_json_value(row[f"max_{i}"]),
+                "hll": [int(row[f"hll_{i}_{j}"] or 0) for j in range(HLL_REGISTERS)],
+            }
+            for i, c in enumerate(columns)
+        },
+    }
+
+
+def hll_estimate(registers):
+    """
+    Estimates a distinct count from HyperLogLog registers
+    """
+    registers = np.asarray(registers, dtype=float)
+    m = len(registers)
+    alpha = 0.7213 / (1 + 1.079 / m)
+    estimate = alpha * m**2 / np.sum(2.0**-registers)
+    zeros = np.count_nonzero(registers == 0)
+    if estimate <= 2.5 * m and zeros:
+        # Linear counting is more accurate for small cardinalities
+        estimate = m * np.log(m / zeros)
+    return estimate
+
+
+def merge_profiles(partitions, columns):
+    """
+    Combines per-partition profiles into a DataFrame with one row per column
+    """
+    rows = {}
+    for c in columns:
+        stats = [p["columns"][c] for p in partitions if p["row_count"]]
+        mins = [s["min"] for s in stats if s["min"] is not None]
+        maxs = [s["max"] for s in stats if s["max"] is not None]
+        registers = np.max([s["hll"] for s in stats], axis=0) if stats else [0]
+        rows[c] = {
+            "nulls": sum(s["nulls"] for s in stats),
+            "empty": sum(s["empty"] for s in stats),
+            "distinct_estimate": int(round(hll_estimate(registers))) if stats else 0,
+            "min": min(mins) if mins else None,
+            "max": max(maxs) if maxs else None,
+        }
+    profile = pd.DataFrame.from_dict(rows, orient="index")
+    profile.attrs["row_count"] = sum(p["row_count"] for p in partitions)
+    return profile
+
+
+@instrument.stage("assess.profile_table")
+def profile_table(
+    db: access.Database,
+    table="prices_coordinates_data",
+    date_column="date_of_transfer",
+    profile_path=None,
+    refresh=False,
+    max_workers=None,
+):
+    """
+    Profiles every column of table in one scan per year of date_column: NULL and empty counts,
+    distinct count estimates, min and max. Years are scanned in parallel on the connection pool.
+
+    Per-year profiles are saved to profile_path (data/{table}_profile.json by default), and
+    later calls only rescan years whose row count or checksum has changed, unless refresh is
+    set. The checksum is the sum of the CRC32 of every row's profiled columns, so rows changed in
+    place are noticed too. Returns a DataFrame indexed by column; the total row count is in its
+    attrs.
+    """
+    profile_path = profile_path or f"data/{table}_profile.json"
+    columns = db.get_columns(table)
+
+    saved = {}
+    if not refresh and os.path.exists(profile_path):
+        with open(profile_path) as file:
+            saved = json.load(file)
+        if saved.get("columns") != columns:
+            saved = {}
+    partitions = saved.get("partitions", {})
+
+    date_column = access.quote_identifier(date_column)
+    row_text = f"CONCAT_WS('|', {', '.join(map(access.quote_identifier, columns))})"
+    counts = db.execute_to_df(
+        f"SELECT YEAR({date_column}) AS year, COUNT(*) AS row_count, SUM(CRC32({row_text})) AS checksum FROM {access.quote_identifier(table)} GROUP BY YEAR({date_column})"
+    )
+    checksums = {
+        str(int(year)): int(checksum) for year, checksum in zip(counts["year"], counts["checksum"])
+    }
+    counts = {str(int(year)): int(n) for year, n in zip(counts["year"], counts["row_count"])}
+    stale = [
+        year
+        for year, n in counts.items()
+        if year not in partitions
+        or partitions[year]["row_count"] != n
+        or partitions[year].get("checksum") != checksums[year]
+    ]
+
+    sqls = [
+        (
+            _profile_sql(
+                table, columns, f"WHERE {date_column} >= %s AND {date_column} < %s"
+            ),
+            access.year_range(int(year)),
         )
-        print(f"Counted null values for column {c}.")
-    null_dfs = pd.concat(dfs, axis=1)
-    return null_dfs
+        for year in stale
+    ]
+    for year, row in zip(stale, db.map_queries(sqls, max_workers=max_workers)):
+        partitions[year] = {**_parse_profile_row(row, columns), "checksum": checksums[year]}
+        print(f"Profiled {table} for {year}.")
+    partitions = {year: partitions[year] for year in counts}
+
+    os.makedirs(os.path.dirname(profile_path) or ".", exist_ok=True)
+    with open(profile_path, "w") as file:
+        json.dump({"columns": columns, "partitions": partitions}, file)
+
+    return merge_profiles(list(partitions.values()), columns)
 
 
 def get_top_n_least_nulls(df: pd.DataFrame, n=10):
@@ -51,46 +225,686 @@ def get_top_n_least_nulls(df: pd.DataFrame, n=10):
     return null_proportions_df.sort_values("Null Proportion").head(n)
 
 
-def get_pois_from_bbox(north, south, east, west, tags=None):
+DEFAULT_TAGS = {
+    "amenity": True,
+    "buildings": True,
+    "historic": True,
+    "leisure": True,
+    "shop": True,
+    "tourism": True,
+}
+
+
+@instrument.stage("assess.get_pois_from_bbox")
+def get_pois_from_bbox(north, south, east, west, tags=None, cache=None):
     """
     Returns POIs within the provided bounding box.
+
+    POIs come from the on-disk poi_cache unless another POICache is given as cache, or cache
+    is False to always fetch from OpenStreetMap.
     """
     if tags == None:
-        tags = {
-            "amenity": True,
-            "buildings": True,
-            "historic": True,
-            "leisure": True,
-            "shop": True,
-            "tourism": True,
+        tags = DEFAULT_TAGS
+
+    if cache is False:
+        return _headless_osmnx().features_from_bbox(north, south, east, west, tags)
+    return (cache or poi_cache).get(north, south, east, west, tags)
+
+
+def _headless_osmnx():
+    """
+    Returns osmnx for fetching POIs. osmnx imports matplotlib.pyplot itself, so unless pyplot is
+    already imported or MPLBACKEND chooses a backend, the non-interactive Agg backend is selected
+    first and fetches never open a display.
+    """
+    if "matplotlib.pyplot" not in sys.modules and "MPLBACKEND" not in os.environ:
+        import matplotlib
+
+        matplotlib.use("Agg")
+    return ox
+
+
+def fetch_pois(north, south, east, west, tags):
+    """
+    Fetches POIs from OpenStreetMap, returning an empty GeoDataFrame if there are none. This
+    imports osmnx, and with it matplotlib on the Agg backend (see _headless_osmnx).
+    """
+    ox = _headless_osmnx()
+    try:
+        return ox.features_from_bbox(north, south, east, west, tags)
+    except ox._errors.InsufficientResponseError:
+        return gpd.GeoDataFrame(geometry=[], crs=4326)
+
+
+def write_atomically(path, write):
+    """
+    Calls write with a temporary path unique to this call, in the directory of path, and then
+    renames the file into place, so concurrent writers of the same path never see each other's
+    partial files and the last complete one wins
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    fd, part_path = tempfile.mkstemp(
+        dir=os.path.dirname(path) or ".", prefix=os.path.basename(path), suffix=".part"
+    )
+    os.close(fd)
+    try:
+        write(part_path)
+        os.replace(part_path, path)
+    except BaseException:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise
+
+
+class POICache:
+    """
+    On-disk cache of OSM POIs, stored as one GeoParquet file per grid tile and set of tags.
+
+    A bbox is snapped to the tiles of side tile_size degrees covering it. Missing or expired
+    (older than ttl seconds) tiles are fetched together in one call to fetch, which has the
+    signature of fetch_pois; the rest are loaded from disk. The result is clipped to the bbox.
+    Once the cache is over max_bytes, the least recently used tiles are evicted.
+
+    Concurrent calls in one process fetch each missing tile once: a tile's lock is held while it
+    is fetched, and later callers find it fresh. Other processes may fetch a tile again, but
+    every write goes through a temporary file of its own.
+    """
+
+    def __init__(
+        self,
+        cache_dir="data/poi_cache",
+        tile_size=0.05,
+        ttl=30 * 24 * 3600,
+        max_bytes=1 << 30,
+        fetch=None,
+    ):
+        self.cache_dir = cache_dir
+        self.tile_size = tile_size
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.fetch = fetch or fetch_pois
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+
+    def _tile_lock(self, path):
+        with self._locks_lock:
+            if path not in self._locks:
+                self._locks[path] = threading.Lock()
+            return self._locks[path]
+
+    def tiles(self, north, south, east, west):
+        """
+        Returns the (row, column) indices of the tiles covering the bbox
+        """
+        rows = range(
+            int(np.floor(south / self.tile_size)), int(np.floor(north / self.tile_size)) + 1
+        )
+        cols = range(
+            int(np.floor(west / self.tile_size)), int(np.floor(east / self.tile_size)) + 1
+        )
+        return [(row, col) for row in rows for col in cols]
+
+    def tile_bbox(self, tile):
+        """
+        Returns (north, south, east, west) of a tile
+        """
+        row, col = tile
+        return (
+            (row + 1) * self.tile_size,
+            row * self.tile_size,
+            (col + 1) * self.tile_size,
+            col * self.tile_size,
+        )
+
+    def tile_path(self, tile, tags):
+        tags_key = hashlib.sha1(
+            json.dumps(tags, sort_keys=True).encode()
+        ).hexdigest()[:12]
+        return os.path.join(
+            self.cache_dir, tags_key, f"{self.tile_size}_{tile[0]}_{tile[1]}.parquet"
+        )
+
+    def _is_fresh(self, path, now):
+        return os.path.exists(path) and now - os.path.getmtime(path) < self.ttl
+
+    def get(self, north, south, east, west, tags=None):
+        """
+        Returns POIs within the bbox, fetching only tiles that aren't cached
+        """
+        if tags is None:
+            tags = DEFAULT_TAGS
+        now = time.time()
+        tiles = self.tiles(north, south, east, west)
+        missing = [t for t in tiles if not self._is_fresh(self.tile_path(t, tags), now)]
+
+        if missing:
+            # Locks are taken in path order so that overlapping calls can't deadlock
+            paths = sorted(self.tile_path(t, tags) for t in missing)
+            locks = [self._tile_lock(path) for path in paths]
+            for lock in locks:
+                lock.acquire()
+            try:
+                # Another call may have fetched some of the tiles while this one waited
+                missing = [t for t in missing if not self._is_fresh(self.tile_path(t, tags), now)]
+                if missing:
+                    self._fetch_tiles(missing, tags)
+            finally:
+                for lock in locks:
+                    lock.release()
+
+        paths = [self.tile_path(tile, tags) for tile in tiles]
+        tables = []
+        for path in paths:
+            tables.append(pq.read_table(path))
+            # Record the use in the access time, keeping the fetch time in the modified time
+            os.utime(path, (now, os.path.getmtime(path)))
+        if missing:
+            self.evict(keep=paths)
+
+        # Tiles can have different tag columns, so combine them before converting once. Empty
+        # tiles are left out as they don't carry the index layout of the fetched POIs.
+        tables = [table for table in tables if table.num_rows] or tables[:1]
+        df = pa.concat_tables(tables, promote_options="permissive").to_pandas()
+        pois = gpd.GeoDataFrame(
+            df.drop(columns="geometry"),
+            geometry=gpd.GeoSeries.from_wkb(df["geometry"], index=df.index),
+            crs=4326,
+        )
+        # Features crossing tile edges are stored in every tile they touch
+        pois = pois[~pois.index.duplicated()]
+        return pois.cx[west:east, south:north]
+
+    def _fetch_tiles(self, tiles, tags):
+        bboxes = np.array([self.tile_bbox(t) for t in tiles])
+        pois = self.fetch(
+            bboxes[:, 0].max(), bboxes[:, 1].min(), bboxes[:, 2].max(), bboxes[:, 3].min(), tags
+        )
+        for tile, (n, s, e, w) in zip(tiles, bboxes):
+            write_atomically(self.tile_path(tile, tags), pois.cx[w:e, s:n].to_parquet)
+
+    def evict(self, keep=()):
+        """
+        Removes least recently used tiles, other than those in keep, until the cache is within
+        max_bytes
+        """
+        files = []
+        for root, _, names in os.walk(self.cache_dir):
+            for name in names:
+                if name.endswith(".parquet"):
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        # Evicted by a concurrent call
+                        continue
+                    files.append((stat.st_atime, stat.st_size, path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            if path in keep:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+poi_cache = POICache()
+
+
+@instrument.stage("assess.query")
+def query(
+    db: access.Database,
+    latitude,
+    longitude,
+    bbox_length,
+    start_date,
+    end_date,
+    chunksize=None,
+    spatial=False,
+    cache=None,
+):
+    """Request user input for some aspect of the data.
+
+    If chunksize is given the rows are streamed from the server in typed chunks of that size
+    rather than fetched all at once. With spatial, the query looks up the grid cells covering
+    the bbox, which needs Database.create_grid_index to have been run.
+
+    Results are memoized in query_cache unless another QueryCache is given as cache, or cache
+    is False.
+    """
+    north, south, east, west = get_bbox_around(latitude, longitude, bbox_length)
+    if cache is None:
+        cache = query_cache
+
+    gdf = None
+    if cache:
+        key = cache.key(db, north, south, east, west, start_date, end_date, typed=bool(chunksize))
+        gdf = cache.get(key)
+    if gdf is None:
+        sql, args = bbox_query_sql(north, south, east, west, start_date, end_date, spatial)
+        if chunksize:
+            df = pd.concat(db.execute_iter_df(sql, chunksize, args), ignore_index=True)
+        else:
+            df = db.execute_to_df(sql, args)
+        gdf = convert_df_to_gdf(df)
+        if cache:
+            cache.put(key, gdf)
+
+    q_hi = gdf["price"].quantile(0.99)
+    gdf = gdf[(gdf["price"] < q_hi)]
+    return gdf
+
+
+class QueryCache:
+    """
+    Memoizes the rows returned by query, keyed on the database and the normalized bbox and
+    date range.
+
+    Streamed results have the typed columns of Database.execute_iter_df and are cached apart
+    from those fetched at once, so a result comes back with the same dtypes as a miss would.
+
+    A query whose bbox and date range fall inside those of a cached result is answered by
+    filtering that result locally. Up to max_entries results, taking up to max_bytes in all by
+    DataFrame.memory_usage, are kept in memory, evicting the least recently used; a result over
+    max_bytes by itself isn't kept in memory. With cache_dir, results are also written there as
+    GeoParquet and looked up when memory misses. The Database methods that change prices_coordinates_data
+    clear their results from query_cache; other caches need clear calling after the table
+    changes.
+    """
+
+    def __init__(self, max_entries=32, cache_dir=None, max_bytes=512 << 20):
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._sizes = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.subsumed_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(db, north, south, east, west, start_date, end_date, typed=False):
+        return (
+            getattr(db, "url", None),
+            getattr(db, "database", None),
+            round(north, 6),
+            round(south, 6),
+            round(east, 6),
+            round(west, 6),
+            pd.Timestamp(start_date).date().isoformat(),
+            pd.Timestamp(end_date).date().isoformat(),
+            typed,
+        )
+
+    @staticmethod
+    def _covers(outer, inner):
+        return (
+            len(outer) == len(inner)
+            and outer[:2] == inner[:2]
+            and outer[8:] == inner[8:]
+            and outer[2] >= inner[2]
+            and outer[3] <= inner[3]
+            and outer[4] >= inner[4]
+            and outer[5] <= inner[5]
+            and outer[6] <= inner[6]
+            and outer[7] >= inner[7]
+        )
+
+    @staticmethod
+    def _subset(gdf, key):
+        north, south, east, west, start_date, end_date = key[2:8]
+        dates = pd.to_datetime(gdf["date_of_transfer"])
+        return gdf[
+            gdf.geometry.y.between(south, north)
+            & gdf.geometry.x.between(west, east)
+            & (dates >= start_date)
+            & (dates < end_date)
+        ]
+
+    def get(self, key):
+        """
+        Returns the cached rows for key, or None if no cached result covers it
+        """
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            for cached_key, gdf in reversed(self._entries.items()):
+                if self._covers(cached_key, key):
+                    self._entries.move_to_end(cached_key)
+                    self.subsumed_hits += 1
+                    return self._subset(gdf, key)
+
+        if self.cache_dir:
+            for cached_key, path in self._disk_index().items():
+                if self._covers(cached_key, key) and os.path.exists(path):
+                    gdf = gpd.read_parquet(path)
+                    self._remember(cached_key, gdf)
+                    with self._lock:
+                        self.disk_hits += 1
+                    return gdf if cached_key == key else self._subset(gdf, key)
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, gdf):
+        """
+        Caches the rows for key
+        """
+        self._remember(key, gdf)
+        if self.cache_dir:
+            name = hashlib.sha1(json.dumps(key).encode()).hexdigest()
+            write_atomically(os.path.join(self.cache_dir, f"{name}.parquet"), gdf.to_parquet)
+
+            def write_key(part_path):
+                with open(part_path, "w") as file:
+                    json.dump(key, file)
+
+            # Written second, so the index never lists a result that isn't there yet
+            write_atomically(os.path.join(self.cache_dir, f"{name}.json"), write_key)
+
+    def _remember(self, key, gdf):
+        size = int(gdf.memory_usage(deep=True).sum())
+        with self._lock:
+            self._forget(key)
+            if size > self.max_bytes:
+                return
+            self._entries[key] = gdf
+            self._sizes[key] = size
+            self._bytes += size
+            while self._entries and (
+                len(self._entries) > self.max_entries or self._bytes > self.max_bytes
+            ):
+                self._forget(next(iter(self._entries)))
+
+    def _forget(self, key):
+        if key in self._entries:
+            del self._entries[key]
+            self._bytes -= self._sizes.pop(key)
+
+    def _disk_index(self):
+        index = {}
+        if os.path.isdir(self.cache_dir):
+            for name in os.listdir(self.cache_dir):
+                if name.endswith(".json"):
+                    with open(os.path.join(self.cache_dir, name)) as file:
+                        key = tuple(json.load(file))
+                    index[key] = os.path.join(self.cache_dir, f"{name[:-5]}.parquet")
+        return index
+
+    def stats(self):
+        """
+        Returns hit and miss counts and the overall hit rate
+        """
+        lookups = self.hits + self.subsumed_hits + self.disk_hits + self.misses
+        return {
+            "hits": self.hits,
+            "subsumed_hits": self.subsumed_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (lookups - self.misses) / lookups if lookups else 0.0,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
         }
 
-    return ox.features_from_bbox(north, south, east, west, tags)
+    def clear(self, db=None):
+        """
+        Empties the cache, including its on-disk tier, or with db only the results from db
+        """
+        source = None
+        if db is not None:
+            source = [getattr(db, "url", None), getattr(db, "database", None)]
+        with self._lock:
+            for key in list(self._entries):
+                if source is None or list(key[:2]) == source:
+                    self._forget(key)
+        if self.cache_dir and os.path.isdir(self.cache_dir):
+            for key, path in self._disk_index().items():
+                if source is None or list(key[:2]) == source:
+                    for stale in (path, f"{path[: -len('.parquet')]}.json"):
+                        if os.path.exists(stale):
+                            os.remove(stale)
 
 
-def query(db: access.Database, latitude, longitude, bbox_length, start_date, end_date):
-    """Request user input for some aspect of the data."""
-    north = latitude + bbox_length / 2
-    south = latitude - bbox_length / 2
-    east = longitude + bbox_length / 2
-    west = longitude - bbox_length / 2
+query_cache = QueryCache()
 
-    df = db.execute_to_df(
-        f"""
+
+def bbox_query_sql(north, south, east, west, start_date, end_date, spatial=False):
+    """
+    Returns the sql and arguments of the query for prices_coordinates_data rows in a bbox and
+    date range. With spatial, it also restricts grid_cell to the cells covering the bbox so the
+    grid index can be used.
+    """
+    cells, args = "", []
+    if spatial:
+        cells, args = access.in_clause("grid_cell", grid_cells(north, south, east, west))
+        cells += " AND"
+    sql = f"""
         SELECT * FROM prices_coordinates_data
         WHERE
-        date_of_transfer >= '{start_date}' AND
-        date_of_transfer < '{end_date}' AND
-        (latitude BETWEEN {south} AND {north}) AND
-        (longitude BETWEEN {west} AND {east})
+        {cells}
+        date_of_transfer >= %s AND
+        date_of_transfer < %s AND
+        (latitude BETWEEN %s AND %s) AND
+        (longitude BETWEEN %s AND %s)
+    """
+    args += [
+        pd.Timestamp(start_date).date(),
+        pd.Timestamp(end_date).date(),
+        float(south),
+        float(north),
+        float(west),
+        float(east),
+    ]
+    return sql, args
+
+
+def grid_cells(north, south, east, west, cell_size=access.GRID_CELL_SIZE):
+    """
+    Returns the ids of the grid cells covering the bbox, matching access.GRID_CELL_SQL
     """
+    # Widen slightly so float rounding never loses a cell the server would compute
+    eps = 1e-9
+    rows = np.arange(
+        np.floor((south - eps + 90) / cell_size), np.floor((north + eps + 90) / cell_size) + 1
     )
+    cols = np.arange(
+        np.floor((west - eps + 180) / cell_size), np.floor((east + eps + 180) / cell_size) + 1
+    )
+    return (rows[:, None] * 100000 + cols[None, :]).astype(np.int64).ravel().tolist()
+
+
+def benchmark_spatial_index(
+    db: access.Database,
+    latitude,
+    longitude,
+    start_date,
+    end_date,
+    sizes_km=(1, 2, 5, 10, 20),
+    run=False,
+):
+    """
+    Compares the query plans of bbox queries with and without the grid index, for boxes of
+    each size in sizes_km around (latitude, longitude). With run, the queries are also executed
+    and timed. Returns a DataFrame with one row per size.
+    """
+    results = []
+    for size in sizes_km:
+        bbox = get_bbox_around(latitude, longitude, km_to_degrees(size))
+        result = {"size_km": size}
+        for name, spatial in [("plain", False), ("grid", True)]:
+            sql, args = bbox_query_sql(*bbox, start_date, end_date, spatial)
+            plan = db.query_plan(sql, args)
+            result[f"{name}_key"] = plan["key"]
+            result[f"{name}_type"] = plan["type"]
+            result[f"{name}_rows"] = plan["rows"]
+            if run:
+                start = time.perf_counter()
+                result[f"{name}_returned"] = len(db.execute(sql, args=args))
+                result[f"{name}_seconds"] = time.perf_counter() - start
+        results.append(result)
+    return pd.DataFrame(results)
+
+
+@instrument.stage("assess.query_store")
+def query_store(
+    latitude,
+    longitude,
+    bbox_length,
+    start_date,
+    end_date,
+    columns=None,
+    store_path="data/prices_coordinates_parquet",
+):
+    """
+    Answers the same query as query from the local Parquet store built by
+    access.create_prices_coordinates_store, so no database connection is needed.
+
+    Only the given columns are read (all by default; price, latitude and longitude are always
+    included). Year partitions and row groups outside the date range or bbox are skipped using
+    their min/max statistics.
+    """
+    north, south, east, west = get_bbox_around(latitude, longitude, bbox_length)
+    start_date = pd.Timestamp(start_date).date()
+    end_date = pd.Timestamp(end_date).date()
+
+    if columns is None:
+        columns = [name for name, _ in access.PRICES_COORDINATES_COLUMNS]
+    columns = list(dict.fromkeys(list(columns) + ["price", "latitude", "longitude"]))
+
+    date = ds.field("date_of_transfer")
+    predicate = (
+        (ds.field("year") >= start_date.year)
+        & (ds.field("year") <= end_date.year)
+        & (date >= pa.scalar(start_date, pa.date32()))
+        & (date < pa.scalar(end_date, pa.date32()))
+        & (ds.field("latitude") >= south)
+        & (ds.field("latitude") <= north)
+        & (ds.field("longitude") >= west)
+        & (ds.field("longitude") <= east)
+    )
+    dataset = ds.dataset(store_path, format="parquet", partitioning="hive")
+    df = dataset.to_table(columns=columns, filter=predicate).to_pandas()
 
     gdf = convert_df_to_gdf(df)
+    return filter_outliers_df(gdf)
 
-    q_hi = gdf["price"].quantile(0.99)
-    gdf = gdf[(gdf["price"] < q_hi)]
-    return gdf
+
+# Roll-up levels of price_cube_query and the price cube columns or expressions behind them
+CUBE_LEVELS = {
+    "area": "postcode_area",
+    "district": "postcode_district",
+    "sector": "postcode_sector",
+}
+CUBE_PERIODS = {"month": "month", "year": "YEAR(month)"}
+
+
+@instrument.stage("assess.price_cube_query")
+def price_cube_query(
+    db: access.Database,
+    level="district",
+    period="month",
+    by_property_type=True,
+    areas=None,
+    start_date=None,
+    end_date=None,
+    property_types=None,
+    quantiles=(0.25, 0.5, 0.75),
+):
+    """
+    Answers price statistics from the price cube built by Database.build_price_cube instead of
+    the raw rows.
+
+    Rows are rolled up to level ("area", "district", "sector" or None for all), period
+    ("month", "year" or None) and, with by_property_type, property type. areas restricts the
+    values of level and property_types the types. start_date and end_date keep the whole
+    months that overlap [start_date, end_date): the month of start_date is included from its
+    first day, and the month of end_date is included unless end_date is its first day.
+
+    Returns a DataFrame with the group columns, the count, mean, min and max of price, and a
+    p{100 * q} column for each of quantiles. Quantiles are interpolated from the log price
+    histogram, so are within about 2.5% of the exact value.
+    """
+    groups = []
+    if level is not None:
+        groups.append((CUBE_LEVELS[level], level))
+    if period is not None:
+        groups.append((CUBE_PERIODS[period], period))
+    if by_property_type:
+        groups.append(("property_type", "property_type"))
+    group_names = [name for _, name in groups]
+
+    conditions, args = [], []
+    if areas is not None:
+        sql, values = access.in_clause(CUBE_LEVELS[level or "area"], areas)
+        conditions.append(sql)
+        args += values
+    if start_date is not None:
+        conditions.append("month >= %s")
+        args.append(pd.Timestamp(start_date).date().replace(day=1))
+    if end_date is not None:
+        conditions.append("month < %s")
+        args.append(pd.Timestamp(end_date).date())
+    if property_types is not None:
+        sql, values = access.in_clause("property_type", property_types)
+        conditions.append(sql)
+        args += values
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    select = "".join(f"{expr} AS {name}, " for expr, name in groups)
+    group_by = ", ".join(expr for expr, _ in groups)
+
+    stats = db.execute_to_df(
+        f"""
+        SELECT {select}SUM(row_count) AS count, 1.0 * SUM(price_sum) / SUM(row_count) AS mean, MIN(price_min) AS min, MAX(price_max) AS max
+        FROM price_cube
+        {where}
+        {f"GROUP BY {group_by}" if groups else ""}
+        """,
+        args=args,
+    )
+    if not quantiles or stats.empty:
+        return stats
+
+    histogram = db.execute_to_df(
+        f"""
+        SELECT {select}bucket, SUM(row_count) AS row_count
+        FROM price_cube_histogram
+        {where}
+        GROUP BY {group_by + ", " if groups else ""}bucket
+        """,
+        args=args,
+    )
+    histogram = histogram.sort_values(group_names + ["bucket"], ignore_index=True)
+    keys = [histogram[name] for name in group_names] or np.zeros(len(histogram))
+    cum = histogram.groupby(keys, sort=False)["row_count"].cumsum().to_numpy(dtype=float)
+    count = histogram["row_count"].to_numpy(dtype=float)
+    total = histogram.groupby(keys, sort=False)["row_count"].transform("sum").to_numpy(dtype=float)
+    first = cum == count
+    bucket = histogram["bucket"].to_numpy(dtype=float)
+
+    for q in quantiles:
+        # Each group's quantile falls in the one bucket where the cumulative count reaches it,
+        # and is interpolated linearly in log price within that bucket
+        target = q * total
+        mask = (cum >= target) & ((cum - count < target) | first)
+        fraction = (target - (cum - count)) / count
+        log_price = (bucket + np.clip(fraction, 0, 1)) / access.PRICE_CUBE_RESOLUTION
+        column = f"p{q * 100:g}"
+        values = histogram.loc[mask, group_names].assign(**{column: np.exp(log_price[mask])})
+        if group_names:
+            stats = stats.merge(values, on=group_names, how="left")
+        else:
+            stats[column] = values[column].to_numpy()
+        stats[column] = stats[column].clip(stats["min"], stats["max"])
+    return stats
 
 
 def filter_outliers_df(df):
@@ -101,6 +915,7 @@ def filter_outliers_df(df):
     return df[(df["price"] < q_hi)]
 
 
+@instrument.stage("assess.convert_df_to_gdf")
 def convert_df_to_gdf(df):
     """
     Converts a DataFrame with longitude and latitude columns to a GeoDataFrame
@@ -109,23 +924,81 @@ def convert_df_to_gdf(df):
     return gpd.GeoDataFrame(df, geometry=geometry, crs=4326)
 
 
+@instrument.stage("assess.get_osm_features_df")
 def get_osm_features_df(gdf, pois, poi_key, poi_values):
     """
     Adds on osm features to gdf
     """
-    df = gdf.copy()
+    return NearestPOIEngine(pois).add_features(gdf, {poi_key: poi_values})
 
-    for place in poi_values:
-        var = f"dist_to_nearest_{place}"
-        joined_gdf = gpd.sjoin_nearest(
-            gdf.to_crs(crs=3857),
-            pois[pois[poi_key] == place].to_crs(crs=3857),
-            how="left",
-            distance_col=var,
-        )
-        df = df.join(joined_gdf[var])
 
-    return df
+class NearestPOIEngine:
+    """
+    Computes dist_to_nearest_* features for property points against one set of POIs.
+
+    The POI centroids are projected to EPSG:3857 once, and a KD-tree is built per POI category
+    the first time that category is asked for. The projected coordinates of the last points
+    passed in are also kept, so further calls with new categories only build the missing trees.
+    Distances are in EPSG:3857 metres to the nearest POI centroid.
+    """
+
+    def __init__(self, pois, crs=3857):
+        self.pois = pois
+        self.crs = crs
+        centroids = pois.geometry.to_crs(crs=crs).centroid
+        self.poi_xy = np.column_stack([centroids.x, centroids.y])
+        self._trees = {}
+        self._points = None
+
+    def tree(self, poi_key, poi_value):
+        """
+        Returns the KD-tree over POIs with poi_key == poi_value, or None if there are none
+        """
+        if (poi_key, poi_value) not in self._trees:
+            tree = None
+            if poi_key in self.pois.columns:
+                mask = (self.pois[poi_key] == poi_value).to_numpy(dtype=bool)
+                if mask.any():
+                    tree = neighbors.KDTree(self.poi_xy[mask])
+            self._trees[(poi_key, poi_value)] = tree
+        return self._trees[(poi_key, poi_value)]
+
+    def project(self, gdf):
+        """
+        Returns the projected x, y coordinates of gdf's geometry, reusing them for the same gdf
+        """
+        if self._points is not None:
+            ref, xy = self._points
+            if ref() is gdf and xy.shape[0] == len(gdf):
+                return xy
+        projected = gdf.geometry.to_crs(crs=self.crs)
+        xy = np.column_stack([projected.x, projected.y])
+        self._points = (weakref.ref(gdf), xy)
+        return xy
+
+    @instrument.stage("assess.nearest_poi_distances")
+    def distances(self, gdf, features):
+        """
+        Returns a DataFrame indexed like gdf with a dist_to_nearest_{value} column for every
+        value in features, a dict from POI key to list of values
+        """
+        xy = self.project(gdf)
+        columns = {}
+        for poi_key, poi_values in features.items():
+            for poi_value in poi_values:
+                tree = self.tree(poi_key, poi_value)
+                if tree is None or xy.shape[0] == 0:
+                    dist = np.full(xy.shape[0], np.nan)
+                else:
+                    dist = tree.query(xy, k=1)[0][:, 0]
+                columns[f"dist_to_nearest_{poi_value}"] = dist
+        return pd.DataFrame(columns, index=gdf.index)
+
+    def add_features(self, gdf, features):
+        """
+        Returns a copy of gdf with the dist_to_nearest_* columns for features added
+        """
+        return gdf.assign(**self.distances(gdf, features))
 
 
 def get_dist_nearest_corr_matrix(gdf, pois, poi_key, poi_values):
@@ -208,40 +1081,255 @@ def visualise_categorial_features(df):
             categorical_feature_price_relation_violinplot(df, var)
 
 
-def labelled(data_gdf, latitude, longitude, bbox_length):
-    """Provide a labelled set of data ready for supervised learning."""
-    bbox = get_bbox_around(latitude, longitude, bbox_length)
-    pois = get_pois_from_bbox(*bbox)
-    data_gdf = get_osm_features_df(
-        data_gdf, pois, "amenity", ["school", "place_of_worship"]
-    )
-    data_gdf = get_osm_features_df(data_gdf, pois, "leisure", ["park"])
+# POI categories used to label data for supervised learning
+LABEL_FEATURES = {"amenity": ["school", "place_of_worship"], "leisure": ["park"]}
+
+
+@instrument.stage("assess.labelled")
+def labelled(
+    data_gdf, latitude, longitude, bbox_length, pois=None, engine=None, features=None
+):
+    """Provide a labelled set of data ready for supervised learning.
+
+    POI distances are joined from the postcode_features table when it has been built, unless
+    another PostcodeFeatures is given as features, or features is False. Rows whose postcode
+    isn't in the table are labelled from POIs fetched for the bbox, unless pois, or a
+    NearestPOIEngine over them, is given.
+    """
+    if features is None:
+        features = postcode_features
+    if features and features.exists() and "postcode" in data_gdf.columns:
+        data_gdf, missing = features.join(data_gdf)
+    else:
+        missing = np.ones(len(data_gdf), dtype=bool)
+
+    if missing.any():
+        if engine is None:
+            if pois is None:
+                bbox = get_bbox_around(latitude, longitude, bbox_length)
+                pois = get_pois_from_bbox(*bbox)
+            engine = NearestPOIEngine(pois)
+        if missing.all():
+            data_gdf = label_osm_features(data_gdf, engine)
+        else:
+            distances = engine.distances(data_gdf[missing], LABEL_FEATURES)
+            data_gdf.loc[missing, distances.columns] = distances.to_numpy()
+    else:
+        # With no rows nothing is labelled, but callers still select the feature columns
+        columns = [f"dist_to_nearest_{v}" for values in LABEL_FEATURES.values() for v in values]
+        data_gdf = data_gdf.assign(**{c: np.nan for c in columns if c not in data_gdf.columns})
     data_gdf["local_median_price"] = calculate_local_median_price(data_gdf)
     return data_gdf
 
 
-def calculate_local_median_price(gdf, k=10):
+def label_osm_features(gdf, engine):
+    """
+    Adds the distance to nearest school, place of worship and park used by labelled
+    """
+    return engine.add_features(gdf, LABEL_FEATURES)
+
+
+class PostcodeFeatures:
+    """
+    Precomputed dist_to_nearest_* features for LABEL_FEATURES, one row per postcode, stored as a
+    Parquet file at path by build_postcode_features. The table is read on first use and again
+    whenever the file changes.
+    """
+
+    def __init__(self, path="data/postcode_features.parquet"):
+        self.path = path
+        self._table = None
+        self._mtime = None
+        self._lock = threading.Lock()
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def table(self):
+        """
+        Returns the feature table indexed by postcode
+        """
+        mtime = os.path.getmtime(self.path)
+        with self._lock:
+            if self._table is None or self._mtime != mtime:
+                self._table = pd.read_parquet(self.path).set_index("postcode")
+                self._mtime = mtime
+            return self._table
+
+    def join(self, gdf):
+        """
+        Returns a copy of gdf with the features of its postcodes, along with a boolean array
+        marking the rows whose postcode isn't in the table
+        """
+        table = self.table()
+        positions = table.index.get_indexer(gdf["postcode"])
+        missing = positions < 0
+        values = table.to_numpy(dtype=float)[np.where(missing, 0, positions)]
+        values[missing] = np.nan
+        return gdf.assign(**dict(zip(table.columns, values.T))), missing
+
+
+postcode_features = PostcodeFeatures()
+
+
+def _postcode_chunk_features(chunk, bounds, margin, tags):
+    north, south, east, west = bounds
+    pois = get_pois_from_bbox(
+        north + margin, south - margin, east + margin, west - margin, tags=tags
+    )
+    engine = NearestPOIEngine(pois)
+    distances = engine.distances(convert_df_to_gdf(chunk), LABEL_FEATURES)
+    distances.insert(0, "postcode", chunk["postcode"].to_numpy())
+    return distances
+
+
+@instrument.stage("assess.build_postcode_features")
+def build_postcode_features(
+    db: access.Database,
+    path="data/postcode_features.parquet",
+    chunk_size=0.2,
+    margin=0.05,
+    max_workers=4,
+    tags=None,
+):
+    """
+    Batch job computing the dist_to_nearest_* features of every postcode in postcode_data, as
+    they depend only on location, and writing them to path for labelled to join.
+
+    Postcodes are split into square chunks of side chunk_size degrees, processed in parallel by
+    max_workers threads. Each chunk is labelled against the POIs of its bbox widened by margin
+    degrees, so that points near its edge see POIs in the neighbouring chunks. The local median
+    price depends on the training window, so it is still computed by labelled.
+    """
+    postcodes = db.execute_to_df(
+        "SELECT postcode, latitude, longitude FROM postcode_data"
+    )
+    postcodes["latitude"] = postcodes["latitude"].astype(float)
+    postcodes["longitude"] = postcodes["longitude"].astype(float)
+    rows = np.floor(postcodes["latitude"] / chunk_size).astype(int)
+    cols = np.floor(postcodes["longitude"] / chunk_size).astype(int)
+
+    jobs = []
+    for (row, col), chunk in postcodes.groupby([rows, cols]):
+        bounds = (
+            (row + 1) * chunk_size,
+            row * chunk_size,
+            (col + 1) * chunk_size,
+            col * chunk_size,
+        )
+        jobs.append((chunk, bounds))
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(_postcode_chunk_features, chunk, bounds, margin, tags)
+            for chunk, bounds in jobs
+        ]
+        tables = []
+        for i, future in enumerate(futures, 1):
+            tables.append(future.result())
+            if i % 100 == 0 or i == len(futures):
+                print(f"Labelled {i}/{len(futures)} postcode chunks.")
+
+    table = pd.concat(tables, ignore_index=True).sort_values("postcode")
+    write_atomically(path, lambda part_path: table.to_parquet(part_path, index=False))
+    print(f"Wrote features of {len(table)} postcodes to {path} in {time.time() - start:.1f} s.")
+    return table
+
+
+@instrument.stage("assess.calculate_local_median_price")
+def calculate_local_median_price(gdf, k=10, exclude_self=False, chunk_size=None):
     """
-    Calculates the median of the nearest k properties
+    Calculates the median price of the nearest k properties to each property. By default the
+    property itself is one of its k + 1 neighbours; with exclude_self it is left out and the
+    median is over k others.
+
+    Points are queried in chunks of chunk_size (all at once by default) to bound the memory used
+    by the neighbour index matrix.
     """
-    k = min(k, gdf.shape[0])
-    # Convert geometries to radians for BallTree
-    gdf["geometry_radians"] = gdf["geometry"].apply(
-        lambda geom: [np.radians(geom.y), np.radians(geom.x)]
+    coords = np.radians(np.column_stack([gdf.geometry.y, gdf.geometry.x]))
+    return _local_median_price(
+        coords,
+        coords,
+        gdf["price"].to_numpy(dtype=float),
+        k if exclude_self else k + 1,
+        exclude_self=exclude_self,
+        chunk_size=chunk_size,
     )
 
-    # Create a BallTree for efficient spatial queries
-    ball_tree = BallTree(np.vstack(gdf["geometry_radians"]), metric="haversine")
 
-    # Query the BallTree for each point to find k nearest neighbors
-    distances, indices = ball_tree.query(
-        np.vstack(gdf["geometry_radians"]), k=k + 1
-    )  # +1 because the point itself is included
+@instrument.stage("assess.local_median_price_at")
+def local_median_price_at(gdf, points_gdf, k=10, chunk_size=None):
+    """
+    Calculates, for each point in points_gdf, the median price of the nearest k properties in gdf
+    """
+    engine = LocalMedianPriceEngine(gdf.geometry.y, gdf.geometry.x, gdf["price"])
+    return engine.at(points_gdf, k=k, chunk_size=chunk_size)
 
-    # Calculate median price for each set of neighbors
-    local_median_prices = []
-    for index_array in indices:
-        prices = gdf.iloc[index_array]["price"]
-        local_median_prices.append(prices.median())
 
-    return local_median_prices
+class LocalMedianPriceEngine:
+    """
+    Computes local median prices at property points against one set of priced properties. The
+    haversine BallTree over their locations is built once, so it can be kept and reused for every
+    later set of points.
+    """
+
+    def __init__(self, latitude, longitude, prices):
+        self.coords = np.radians(
+            np.column_stack(
+                [np.asarray(latitude, dtype=float), np.asarray(longitude, dtype=float)]
+            )
+        )
+        self.prices = np.asarray(prices, dtype=float)
+        self.ball_tree = (
+            neighbors.BallTree(self.coords, metric="haversine") if len(self.prices) else None
+        )
+
+    def at(self, points_gdf, k=10, chunk_size=None):
+        """
+        Returns the median price of the nearest k properties to each point in points_gdf
+        """
+        return _local_median_price(
+            self.coords,
+            np.radians(np.column_stack([points_gdf.geometry.y, points_gdf.geometry.x])),
+            self.prices,
+            k,
+            chunk_size=chunk_size,
+            ball_tree=self.ball_tree,
+        )
+
+
+def _local_median_price(
+    coords, query_coords, prices, k, exclude_self=False, chunk_size=None, ball_tree=None
+):
+    """
+    Median of prices over the k nearest coords (in radians) to each of query_coords. With
+    exclude_self, query_coords must be coords and each point's own price is left out. ball_tree,
+    if given, is a haversine BallTree already built over coords.
+    """
+    n = coords.shape[0]
+    k = min(k, n)
+    if exclude_self:
+        k = min(k, n - 1)
+    if k < 1:
+        return np.full(query_coords.shape[0], np.nan)
+
+    if ball_tree is None:
+        ball_tree = neighbors.BallTree(coords, metric="haversine")
+    # Rows added for prediction have no price, which pandas' median used to skip
+    median = np.nanmedian if np.isnan(prices).any() else np.median
+    chunk_size = chunk_size or max(query_coords.shape[0], 1)
+
+    medians = np.empty(query_coords.shape[0])
+    for start in range(0, query_coords.shape[0], chunk_size):
+        chunk = query_coords[start : start + chunk_size]
+        if exclude_self:
+            _, indices = ball_tree.query(chunk, k=k + 1)
+            rows = np.arange(start, start + chunk.shape[0])[:, None]
+            # Move the point itself (if found among ties) to the end, then drop the last column
+            order = np.argsort(indices == rows, axis=1, kind="stable")
+            indices = np.take_along_axis(indices, order, axis=1)[:, :k]
+        else:
+            _, indices = ball_tree.query(chunk, k=k)
+        medians[start : start + chunk.shape[0]] = median(prices[indices], axis=1)
+    return medians
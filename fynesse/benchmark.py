@@ -0,0 +1,559 @@
+# This file benchmarks the package. Run it with python -m fynesse.benchmark
+
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+# Modules that must not be imported just by importing the package. pyarrow is left out as
+# pandas imports it itself.
+HEAVY_MODULES = [
+    "matplotlib",
+    "seaborn",
+    "osmnx",
+    "geopandas",
+    "statsmodels",
+    "sklearn",
+    "shapely",
+    "requests",
+    "yaml",
+]
+
+IMPORT_MODULES = ["fynesse", "fynesse.access", "fynesse.assess", "fynesse.address"]
+
+_IMPORT_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{"seconds": elapsed, "loaded": [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+# Modules that must not be imported by training and predicting with POIs from the cache. Only
+# fetching POIs from OpenStreetMap imports osmnx, which imports matplotlib itself, on the Agg
+# backend.
+COMPUTE_EXCLUDED_MODULES = ["matplotlib", "seaborn", "osmnx"]
+
+_COMPUTE_SCRIPT = """
+import datetime, json, sys, tempfile
+from fynesse import address, benchmark
+with tempfile.TemporaryDirectory() as data_dir:
+    db, towns = benchmark.synthetic_database(
+        data_dir, rows=2000, n_towns=2, years=range(2019, 2021)
+    )
+    latitude, longitude = float(towns["latitude"][0]), float(towns["longitude"][0])
+    args = (latitude, longitude, datetime.date(2019, 6, 1), "F")
+    with benchmark.offline(data_dir, benchmark.synthetic_pois(500, towns)):
+        address.estimate_price(db, *args)
+        address.predict_price(db, *args)
+print(json.dumps({{"loaded": [m for m in {excluded!r} if m in sys.modules]}}))
+"""
+
+# Format version of the results written by run, bumped when fields change meaning
+RESULTS_VERSION = 1
+
+
+def import_time(module, repeat=3):
+    """
+    Returns the best wall time in seconds of importing module in a fresh interpreter over
+    repeat runs, along with the heavy modules that the import pulled in
+    """
+    best = None
+    for _ in range(repeat):
+        script = _IMPORT_SCRIPT.format(module=module, heavy=HEAVY_MODULES)
+        output = subprocess.run(
+            [sys.executable, "-c", script], capture_output=True, text=True, check=True
+        ).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        if best is None or result["seconds"] < best["seconds"]:
+            best = result
+    return {"module": module, **best}
+
+
+def check_imports(modules=IMPORT_MODULES, budget=2.0, repeat=3, verbose=True):
+    """
+    Times importing each of modules and returns the results along with whether all of them
+    stayed within budget seconds without importing any of HEAVY_MODULES
+    """
+    results = []
+    ok = True
+    for module in modules:
+        result = import_time(module, repeat=repeat)
+        result["within_budget"] = result["seconds"] <= budget and not result["loaded"]
+        ok = ok and result["within_budget"]
+        results.append(result)
+        if verbose:
+            print(f"{module}: {result['seconds'] * 1000:.0f} ms")
+            if result["loaded"]:
+                print(f"WARNING: importing {module} loaded {', '.join(result['loaded'])}")
+            elif result["seconds"] > budget:
+                print(f"WARNING: importing {module} took longer than {budget} s")
+    return results, ok
+
+
+def check_compute_imports(excluded=COMPUTE_EXCLUDED_MODULES, verbose=True):
+    """
+    Runs estimate_price and predict_price on a small synthetic database with stubbed POI
+    fetches in a fresh interpreter. Returns the excluded modules that were imported along with
+    whether there were none.
+    """
+    script = _COMPUTE_SCRIPT.format(excluded=excluded)
+    output = subprocess.run(
+        [sys.executable, "-c", script], capture_output=True, text=True, check=True
+    ).stdout
+    loaded = json.loads(output.strip().splitlines()[-1])["loaded"]
+    if verbose and loaded:
+        print(f"WARNING: estimating a price loaded {', '.join(loaded)}")
+    return loaded, not loaded
+
+
+def synthetic_towns(n_towns=20, seed=0):
+    """
+    Returns the centres, two letter postcode areas and price levels of n_towns synthetic towns
+    spread over England
+    """
+    rng = np.random.default_rng(seed)
+    letters = np.array(list("ABCDEFGHIJKLMNOPRSTUWYZ"))
+    return pd.DataFrame(
+        {
+            "latitude": rng.uniform(50.8, 54.5, n_towns),
+            "longitude": rng.uniform(-3.0, 1.2, n_towns),
+            "postcode_area": [
+                letters[i // len(letters) % len(letters)] + letters[i % len(letters)]
+                for i in range(n_towns)
+            ],
+            "price_level": rng.normal(12.4, 0.3, n_towns),
+        }
+    )
+
+
+def synthetic_postcodes(n, towns, seed=0):
+    """
+    Returns n postcodes with the columns of postcode_data (other than db_id), scattered around
+    the towns
+    """
+    rng = np.random.default_rng(seed)
+    town = np.arange(n) % len(towns)
+    rank = np.arange(n) // len(towns)
+    district = rank // 2000 + 1
+    sector = rank // 400 % 5
+    unit = rank % 400
+    letters = np.array(list("ABDEFGHJLNPQRSTUWXYZ"))
+    outcode = towns["postcode_area"].to_numpy()[town] + district.astype(str)
+    incode = sector.astype(str) + letters[unit // 20] + letters[unit % 20]
+    postcode = pd.Series(outcode) + " " + pd.Series(incode)
+    return pd.DataFrame(
+        {
+            "postcode": postcode,
+            "status": np.where(rng.random(n) < 0.9, "live", "terminated"),
+            "usertype": "small",
+            "easting": rng.integers(100000, 600000, n),
+            "northing": rng.integers(100000, 600000, n),
+            "positional_quality_indicator": 1,
+            "country": "England",
+            "latitude": towns["latitude"].to_numpy()[town] + rng.normal(0, 0.04, n),
+            "longitude": towns["longitude"].to_numpy()[town] + rng.normal(0, 0.06, n),
+            "postcode_no_space": postcode.str.replace(" ", ""),
+            "postcode_fixed_width_seven": postcode,
+            "postcode_fixed_width_eight": postcode,
+            "postcode_area": towns["postcode_area"].to_numpy()[town],
+            "postcode_district": outcode,
+            "postcode_sector": pd.Series(outcode) + " " + sector.astype(str),
+            "outcode": outcode,
+            "incode": incode,
+        }
+    )
+
+
+def synthetic_pp_data(n, postcodes, towns, years=range(2015, 2023), seed=0):
+    """
+    Returns n transactions with the columns of pp_data (other than db_id) at random postcodes
+    and dates in years. Prices depend on the town, property type and distance from the town
+    centre, so the price model has something to find.
+    """
+    from .access import PP_COLUMNS
+
+    rng = np.random.default_rng(seed)
+    index = rng.integers(0, len(postcodes), n)
+    town = index % len(towns)
+    property_type = rng.choice(list("DSTFO"), n, p=[0.25, 0.3, 0.3, 0.13, 0.02])
+    type_effect = pd.Series(property_type).map(
+        {"D": 0.35, "S": 0.1, "T": 0.0, "F": -0.2, "O": 0.0}
+    )
+    distance = np.hypot(
+        postcodes["latitude"].to_numpy()[index] - towns["latitude"].to_numpy()[town],
+        postcodes["longitude"].to_numpy()[index] - towns["longitude"].to_numpy()[town],
+    )
+    log_price = (
+        towns["price_level"].to_numpy()[town]
+        + type_effect.to_numpy()
+        - 2 * distance
+        + rng.normal(0, 0.35, n)
+    )
+    start = np.datetime64(f"{min(years)}-01-01")
+    days = (np.datetime64(f"{max(years) + 1}-01-01") - start).astype(int)
+    dates = start + rng.integers(0, days, n).astype("timedelta64[D]")
+    df = pd.DataFrame(
+        {
+            "transaction_unique_identifier": [
+                f"{{{i:08X}-0000-0000-0000-000000000000}}" for i in range(n)
+            ],
+            "price": np.exp(log_price).astype(np.int64),
+            "date_of_transfer": pd.Series(dates).dt.strftime("%Y-%m-%d 00:00"),
+            "postcode": postcodes["postcode"].to_numpy()[index],
+            "property_type": property_type,
+            "new_build_flag": np.where(rng.random(n) < 0.1, "Y", "N"),
+            "tenure_type": np.where(property_type == "F", "L", "F"),
+            "primary_addressable_object_name": (rng.integers(1, 200, n)).astype(str),
+            "secondary_addressable_object_name": "",
+            "street": "HIGH STREET",
+            "locality": "",
+            "town_city": towns["postcode_area"].to_numpy()[town],
+            "district": towns["postcode_area"].to_numpy()[town],
+            "county": "SYNTHETIC",
+            "ppd_category_type": "A",
+            "record_status": "A",
+        }
+    )
+    return df[PP_COLUMNS]
+
+
+def synthetic_pois(n, towns, seed=0):
+    """
+    Returns n POIs around the towns, shaped like an osmnx features GeoDataFrame
+    """
+    import geopandas as gpd
+
+    rng = np.random.default_rng(seed)
+    town = np.arange(n) % len(towns)
+    kind = rng.choice(["school", "place_of_worship", "cafe", "park"], n)
+    index = pd.MultiIndex.from_arrays(
+        [np.full(n, "node"), np.arange(1, n + 1)], names=["element_type", "osmid"]
+    )
+    return gpd.GeoDataFrame(
+        {
+            "amenity": np.where(kind == "park", None, kind),
+            "leisure": np.where(kind == "park", "park", None),
+        },
+        geometry=gpd.points_from_xy(
+            towns["longitude"].to_numpy()[town] + rng.normal(0, 0.08, n),
+            towns["latitude"].to_numpy()[town] + rng.normal(0, 0.05, n),
+        ),
+        crs=4326,
+        index=index,
+    )
+
+
+def stub_fetch_pois(pois):
+    """
+    Returns a function with the signature of assess.fetch_pois that answers from pois instead
+    of OpenStreetMap
+    """
+
+    def fetch(north, south, east, west, tags):
+        return pois.cx[west:east, south:north]
+
+    return fetch
+
+
+def _write_csv(df, path):
+    df.to_csv(path, header=False, index=False, quoting=1)
+
+
+def _synthetic_database_class():
+    from .access import LocalDatabase
+
+    class SyntheticDatabase(LocalDatabase):
+        """
+        LocalDatabase whose pp_data and postcode_data csv files are synthetic ones in data_dir
+        rather than downloads
+        """
+
+        def __init__(self, data_dir, pool_size=4):
+            self.data_dir = data_dir
+            super().__init__(os.path.join(data_dir, "property_prices.db"), pool_size)
+
+        def get_pp_data(self):
+            return [os.path.join(self.data_dir, "pp-synthetic.csv")]
+
+        def get_postcode_data(self):
+            return [os.path.join(self.data_dir, "open_postcode_geo.csv")]
+
+    return SyntheticDatabase
+
+
+def synthetic_database(
+    data_dir, rows=100000, postcodes=None, n_towns=20, years=range(2015, 2023), seed=0
+):
+    """
+    Writes synthetic pp_data and postcode_data csv files to data_dir and loads them into a local
+    database with the same table builds as the real data. Returns the database and the towns.
+    """
+    postcodes = postcodes or max(rows // 20, n_towns)
+    towns = synthetic_towns(n_towns, seed)
+    postcode_df = synthetic_postcodes(postcodes, towns, seed + 1)
+    _write_csv(postcode_df, os.path.join(data_dir, "open_postcode_geo.csv"))
+    _write_csv(
+        synthetic_pp_data(rows, postcode_df, towns, years, seed + 2),
+        os.path.join(data_dir, "pp-synthetic.csv"),
+    )
+
+    db = _synthetic_database_class()(data_dir)
+    db.create_pp_data(bulk=True)
+    db.create_postcode_data(bulk=True)
+    db.build_prices_coordinates_data(years=years)
+    return db, towns
+
+
+@contextlib.contextmanager
+def offline(data_dir, pois):
+    """
+    Points the package's default caches at fresh ones in data_dir for the duration of the with
+    block, with POIs fetched from pois instead of OpenStreetMap
+    """
+    from . import assess, address
+
+    saved = (
+        assess.poi_cache,
+        assess.query_cache,
+        assess.postcode_features,
+        address.model_registry,
+    )
+    assess.poi_cache = assess.POICache(
+        cache_dir=os.path.join(data_dir, "poi_cache"), fetch=stub_fetch_pois(pois)
+    )
+    assess.query_cache = assess.QueryCache()
+    assess.postcode_features = assess.PostcodeFeatures(
+        os.path.join(data_dir, "postcode_features.parquet")
+    )
+    address.model_registry = address.ModelRegistry(os.path.join(data_dir, "model_registry"))
+    try:
+        yield
+    finally:
+        (
+            assess.poi_cache,
+            assess.query_cache,
+            assess.postcode_features,
+            address.model_registry,
+        ) = saved
+
+
+def time_stage(stage, func, repeat=3, rows=None, warmup=True):
+    """
+    Runs func repeat times and returns its last result along with a record of the wall times.
+    rows, if given, is a function of the result giving the number of rows it covers. With
+    warmup, func is first run once untimed so that lazy imports aren't counted.
+    """
+    if warmup:
+        func()
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        seconds.append(time.perf_counter() - start)
+    record = {
+        "stage": stage,
+        "rows": rows(result) if rows else None,
+        "seconds": seconds,
+        "min": min(seconds),
+        "median": float(np.median(seconds)),
+    }
+    print(f"{stage}: {record['median'] * 1000:.1f} ms (min {record['min'] * 1000:.1f} ms)")
+    return result, record
+
+
+def run_pipeline(db, towns, bbox_km=15, repeat=3, date=datetime.date(2019, 6, 1)):
+    """
+    Times each stage of the prediction pipeline for the first town. Returns the stage records.
+    """
+    from . import assess, address
+
+    latitude = float(towns["latitude"].iloc[0])
+    longitude = float(towns["longitude"].iloc[0])
+    bbox_length = assess.km_to_degrees(bbox_km)
+    start_date = date - datetime.timedelta(300)
+    end_date = date + datetime.timedelta(300)
+    bbox = assess.get_bbox_around(latitude, longitude, bbox_length)
+    records = []
+
+    data, record = time_stage(
+        "query",
+        lambda: assess.query(
+            db, latitude, longitude, bbox_length, start_date, end_date, cache=False
+        ),
+        repeat,
+        len,
+    )
+    records.append(record)
+    df = pd.DataFrame(data.drop(columns="geometry"))
+    gdf, record = time_stage("convert_df_to_gdf", lambda: assess.convert_df_to_gdf(df), repeat, len)
+    records.append(record)
+    pois = assess.get_pois_from_bbox(*bbox)
+    _, record = time_stage(
+        "get_osm_features_df",
+        lambda: assess.get_osm_features_df(gdf, pois, "amenity", ["school", "place_of_worship"]),
+        repeat,
+        len,
+    )
+    records.append(record)
+    _, record = time_stage(
+        "calculate_local_median_price",
+        lambda: assess.calculate_local_median_price(gdf),
+        repeat,
+        len,
+    )
+    records.append(record)
+    _, record = time_stage(
+        "labelled",
+        lambda: assess.labelled(gdf, latitude, longitude, bbox_length, features=False),
+        repeat,
+        len,
+    )
+    records.append(record)
+    _, record = time_stage(
+        "predict_price",
+        lambda: address.predict_price(
+            db, latitude, longitude, date, "D", bbox_length_km=bbox_km, registry=False
+        ),
+        repeat,
+    )
+    records.append(record)
+    # The first call fits and stores the regional model, later ones reuse it
+    _, record = time_stage(
+        "predict_price_cold",
+        lambda: address.predict_price(db, latitude, longitude, date, "D", bbox_length_km=bbox_km),
+        1,
+        warmup=False,
+    )
+    records.append(record)
+    _, record = time_stage(
+        "predict_price_warm",
+        lambda: address.predict_price(db, latitude, longitude, date, "D", bbox_length_km=bbox_km),
+        repeat,
+    )
+    records.append(record)
+    return records
+
+
+def _commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(rows=100000, postcodes=None, pois=5000, n_towns=20, seed=0, repeat=3, bbox_km=15):
+    """
+    Builds a synthetic local database of rows transactions and times the pipeline on it, all
+    offline. Returns the results as a dict ready to be written as JSON.
+    """
+    with tempfile.TemporaryDirectory() as data_dir:
+        start = time.perf_counter()
+        db, towns = synthetic_database(data_dir, rows, postcodes, n_towns, seed=seed)
+        load_seconds = time.perf_counter() - start
+        print(f"Built a synthetic database of {rows} rows in {load_seconds:.1f} s.")
+        with offline(data_dir, synthetic_pois(pois, towns, seed + 3)):
+            stages = run_pipeline(db, towns, bbox_km=bbox_km, repeat=repeat)
+
+    return {
+        "version": RESULTS_VERSION,
+        "commit": _commit(),
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": {
+            "rows": rows,
+            "postcodes": postcodes,
+            "pois": pois,
+            "towns": n_towns,
+            "seed": seed,
+            "repeat": repeat,
+            "bbox_km": bbox_km,
+        },
+        "load_seconds": load_seconds,
+        "stages": stages,
+    }
+
+
+def compare(baseline, results, tolerance=0.2):
+    """
+    Compares the median stage times of two sets of results. Returns a DataFrame with one row per
+    stage and whether it is slower than the baseline by more than tolerance.
+    """
+    before = {record["stage"]: record["median"] for record in baseline["stages"]}
+    after = {record["stage"]: record["median"] for record in results["stages"]}
+    df = pd.DataFrame(
+        [
+            (stage, before[stage], after[stage])
+            for stage in after
+            if stage in before
+        ],
+        columns=["stage", "baseline", "current"],
+    )
+    df["ratio"] = df["current"] / df["baseline"]
+    df["regressed"] = df["ratio"] > 1 + tolerance
+    return df
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the fynesse package")
+    parser.add_argument("--budget", type=float, default=2.0, help="import time budget in seconds")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--json", dest="json_path", help="write the results to this file")
+    parser.add_argument(
+        "--rows", type=int, default=0, help="also time the pipeline on this many synthetic rows"
+    )
+    parser.add_argument("--postcodes", type=int)
+    parser.add_argument("--pois", type=int, default=5000)
+    parser.add_argument("--towns", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--compare", help="baseline results to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    imports, ok = check_imports(budget=args.budget, repeat=args.repeat)
+    compute_imports, compute_ok = check_compute_imports()
+    ok = ok and compute_ok
+    results = {"imports": imports, "compute_imports": compute_imports}
+    if args.rows:
+        results.update(
+            run(
+                rows=args.rows,
+                postcodes=args.postcodes,
+                pois=args.pois,
+                n_towns=args.towns,
+                seed=args.seed,
+                repeat=args.repeat,
+            )
+        )
+    if args.json_path:
+        with open(args.json_path, "w") as file:
+            json.dump(results, file, indent=2)
+
+    if args.compare and "stages" in results:
+        with open(args.compare) as file:
+            comparison = compare(json.load(file), results, args.tolerance)
+        print(comparison.to_string(index=False))
+        for stage in comparison.loc[comparison["regressed"], "stage"]:
+            print(f"WARNING: {stage} is more than {args.tolerance:.0%} slower than the baseline")
+        ok = ok and not comparison["regressed"].any()
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,35 +1,75 @@
 import os
-import yaml
+from collections.abc import MutableMapping
 
 default_file = os.path.join(os.path.dirname(__file__), "defaults.yml")
 local_file = os.path.abspath(os.path.join(os.path.dirname(__file__), "machine.yml"))
 user_file = '_config.yml'
 
-config = {}
-
-if os.path.exists(default_file):
-    with open(default_file) as file:
-        config.update(yaml.load(file, Loader=yaml.FullLoader))
-
-if os.path.exists(local_file):
-    with open(local_file) as file:
-        config.update(yaml.load(file, Loader=yaml.FullLoader))
-
-if os.path.exists(user_file):
-    with open(user_file) as file:
-        config.update(yaml.load(file, Loader=yaml.FullLoader))
-
-if config=={}:
-    raise ValueError(
-        "No configuration file found at either "
-        + user_file
-        + " or "
-        + local_file
-        + " or "
-        + default_file
-        + "."
-    )
-
-for key, item in config.items():
-    if item is str:
-        config[key] = os.path.expandvars(item)
+
+class Config(MutableMapping):
+    """
+    Configuration read from the default, machine and user yml files, in increasing order of
+    precedence. The files are only read (and yaml imported) the first time a value is used.
+    """
+
+    def __init__(self):
+        self._data = None
+
+    def _load(self):
+        if self._data is not None:
+            return self._data
+
+        import yaml
+
+        config = {}
+
+        if os.path.exists(default_file):
+            with open(default_file) as file:
+                config.update(yaml.load(file, Loader=yaml.FullLoader))
+
+        if os.path.exists(local_file):
+            with open(local_file) as file:
+                config.update(yaml.load(file, Loader=yaml.FullLoader))
+
+        if os.path.exists(user_file):
+            with open(user_file) as file:
+                config.update(yaml.load(file, Loader=yaml.FullLoader))
+
+        if config=={}:
+            raise ValueError(
+                "No configuration file found at either "
+                + user_file
+                + " or "
+                + local_file
+                + " or "
+                + default_file
+                + "."
+            )
+
+        for key, item in config.items():
+            if isinstance(item, str):
+                config[key] = os.path.expandvars(item)
+
+        self._data = config
+        return config
+
+    def __getitem__(self, key):
+        return self._load()[key]
+
+    def __setitem__(self, key, value):
+        self._load()[key] = value
+
+    def __delitem__(self, key):
+        del self._load()[key]
+
+    def __iter__(self):
+        return iter(self._load())
+
+    def __len__(self):
+        return len(self._load())
+
+    def __repr__(self):
+        return repr(self._load())
+
+
+config = Config()
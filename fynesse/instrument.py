@@ -0,0 +1,376 @@
+# This file records timings of sql statements and pipeline stages
+
+import functools
+import json
+import os
+import re
+import threading
+import time
+
+# Upper bounds in seconds of the latency histogram buckets, as in Prometheus' defaults widened
+# for long running statements
+LATENCY_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+    120.0,
+    float("inf"),
+)
+
+
+class Histogram:
+    """
+    Counts of observations in fixed buckets, with their total
+    """
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * len(bounds)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.bounds):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """
+        Estimates quantile q by interpolating within the bucket it falls in
+        """
+        if not self.count:
+            return None
+        target = q * self.count
+        seen = 0
+        lower = 0.0
+        for bound, count in zip(self.bounds, self.counts):
+            if count and seen + count >= target:
+                if bound == float("inf"):
+                    return lower
+                return lower + (bound - lower) * (target - seen) / count
+            seen += count
+            lower = bound
+        return lower
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "buckets": [
+                ["+Inf" if bound == float("inf") else bound, count]
+                for bound, count in zip(self.bounds, self.counts)
+            ],
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+        }
+
+
+@functools.lru_cache(maxsize=1024)
+def fingerprint(sql):
+    """
+    Normalizes sql to a fingerprint shared by statements that differ only in their values:
+    literals and placeholders become ?, IN lists collapse to IN (...) and whitespace is squeezed
+    """
+    sql = re.sub(r"'(?:[^'\\]|\\.)*'", "?", sql)
+    sql = re.sub(r"%s|\b\d+(?:\.\d+)?\b", "?", sql)
+    sql = re.sub(r"\bIN\s*\(\s*\?(?:\s*,\s*\?)*\s*\)", "IN (...)", sql, flags=re.I)
+    return " ".join(sql.split())
+
+
+def result_size(result):
+    """
+    Returns the number of rows and approximate bytes of a fetched result: a DataFrame or a
+    sequence of row tuples
+    """
+    if result is None:
+        return 0, 0
+    if hasattr(result, "memory_usage"):
+        return len(result), int(result.memory_usage(index=False, deep=True).sum())
+    rows = 0
+    size = 0
+    for row in result:
+        rows += 1
+        size += sum(len(value) if isinstance(value, (str, bytes)) else 8 for value in row)
+    return rows, size
+
+
+class Recorder:
+    """
+    Aggregates wall times into a latency histogram per pipeline stage and per sql statement
+    fingerprint, along with the rows and bytes fetched by each fingerprint.
+
+    Nothing is recorded unless enabled is set, so disabled instrumentation costs a single
+    attribute check per call.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.exporters = []
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.stages = {}
+            self.statements = {}
+
+    def observe_stage(self, name, seconds):
+        with self._lock:
+            if name not in self.stages:
+                self.stages[name] = Histogram()
+            self.stages[name].observe(seconds)
+
+    def observe_statement(self, sql, seconds, rows=0, size=0):
+        key = fingerprint(sql)
+        with self._lock:
+            if key not in self.statements:
+                self.statements[key] = {"seconds": Histogram(), "rows": 0, "bytes": 0}
+            statement = self.statements[key]
+            statement["seconds"].observe(seconds)
+            statement["rows"] += rows
+            statement["bytes"] += size
+
+    def snapshot(self):
+        """
+        Returns the recorded histograms and totals as a dict
+        """
+        with self._lock:
+            return {
+                "timestamp": time.time(),
+                "stages": {name: h.to_dict() for name, h in self.stages.items()},
+                "statements": {
+                    key: {
+                        "rows": s["rows"],
+                        "bytes": s["bytes"],
+                        **s["seconds"].to_dict(),
+                    }
+                    for key, s in self.statements.items()
+                },
+            }
+
+    def export(self):
+        """
+        Passes a snapshot to every exporter
+        """
+        snapshot = self.snapshot()
+        for exporter in self.exporters:
+            exporter.export(snapshot)
+
+
+recorder = Recorder()
+
+
+def enable(exporters=()):
+    """
+    Starts recording, with exporters as those used by export
+    """
+    recorder.exporters = list(exporters)
+    recorder.enabled = True
+
+
+def disable():
+    recorder.enabled = False
+
+
+def export():
+    recorder.export()
+
+
+class stage:
+    """
+    Records the wall time of a pipeline stage under name, used either as a decorator or, with a
+    fresh instance per block, as a context manager
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._start = None
+
+    def __enter__(self):
+        if recorder.enabled:
+            self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if self._start is not None:
+            recorder.observe_stage(self.name, time.perf_counter() - self._start)
+            self._start = None
+
+    def __call__(self, func):
+        name = self.name
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not recorder.enabled:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                recorder.observe_stage(name, time.perf_counter() - start)
+
+        return wrapper
+
+
+class InstrumentedCursor:
+    """
+    Wraps a database cursor to record every statement executed on it with the recorder: the wall
+    time of executing it and fetching its rows, and the rows and approximate bytes fetched (or
+    the affected row count, for statements that fetch nothing)
+    """
+
+    def __init__(self, cur):
+        self._cur = cur
+        self._sql = None
+
+    def __getattr__(self, name):
+        return getattr(self._cur, name)
+
+    def finish(self):
+        """
+        Records the statement in progress, if any
+        """
+        if self._sql is not None:
+            rows = self._fetched if self._fetches else self._affected
+            recorder.observe_statement(self._sql, self._seconds, rows or 0, self._bytes)
+            self._sql = None
+
+    def _timed(self, sql, run):
+        self.finish()
+        start = time.perf_counter()
+        result = run()
+        self._sql = sql
+        self._seconds = time.perf_counter() - start
+        self._affected = result if isinstance(result, int) else 0
+        self._fetches = 0
+        self._fetched = 0
+        self._bytes = 0
+        return result
+
+    def execute(self, sql, args=None):
+        return self._timed(sql, lambda: self._cur.execute(sql, args))
+
+    def executemany(self, sql, args_seq):
+        return self._timed(sql, lambda: self._cur.executemany(sql, args_seq))
+
+    def _fetch(self, fetch, *args):
+        start = time.perf_counter()
+        rows = fetch(*args)
+        if self._sql is not None:
+            self._seconds += time.perf_counter() - start
+            self._fetches += 1
+            count, size = result_size(rows if rows is not None else ())
+            self._fetched += count
+            self._bytes += size
+        return rows
+
+    def fetchall(self):
+        return self._fetch(self._cur.fetchall)
+
+    def fetchmany(self, size):
+        return self._fetch(self._cur.fetchmany, size)
+
+    def close(self):
+        self.finish()
+        self._cur.close()
+
+
+class LogExporter:
+    """
+    Prints one summary line per stage and statement fingerprint
+    """
+
+    def __init__(self, log=print):
+        self.log = log
+
+    def export(self, snapshot):
+        for name, h in sorted(snapshot["stages"].items()):
+            self.log(
+                f"stage {name}: {h['count']} calls, {h['sum']:.3f} s total, p50 {h['p50'] * 1000:.1f} ms, p95 {h['p95'] * 1000:.1f} ms"
+            )
+        for key, s in sorted(snapshot["statements"].items(), key=lambda item: -item[1]["sum"]):
+            self.log(
+                f"sql {key[:100]}: {s['count']} calls, {s['sum']:.3f} s total, p95 {s['p95'] * 1000:.1f} ms, {s['rows']} rows, {s['bytes']} bytes"
+            )
+
+
+class JSONExporter:
+    """
+    Writes each snapshot to a JSON file at path, replacing it atomically
+    """
+
+    def __init__(self, path="data/instrumentation.json"):
+        self.path = path
+
+    def export(self, snapshot):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(f"{self.path}.part", "w") as file:
+            json.dump(snapshot, file, indent=2)
+        os.replace(f"{self.path}.part", self.path)
+
+
+def _label(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", " ")
+
+
+class PrometheusExporter:
+    """
+    Renders snapshots in the Prometheus text exposition format, keeping the latest in text and
+    writing it to path if given (for instance for node_exporter's textfile collector)
+    """
+
+    def __init__(self, path=None, prefix="fynesse"):
+        self.path = path
+        self.prefix = prefix
+        self.text = ""
+
+    def _histogram(self, name, label, h):
+        lines = []
+        cumulative = 0
+        for bound, count in h["buckets"]:
+            cumulative += count
+            lines.append(f'{name}_bucket{{{label},le="{bound}"}} {cumulative}')
+        lines.append(f"{name}_sum{{{label}}} {h['sum']}")
+        lines.append(f"{name}_count{{{label}}} {h['count']}")
+        return lines
+
+    def render(self, snapshot):
+        stage_name = f"{self.prefix}_stage_seconds"
+        sql_name = f"{self.prefix}_sql_seconds"
+        lines = [f"# TYPE {stage_name} histogram"]
+        for name, h in sorted(snapshot["stages"].items()):
+            lines += self._histogram(stage_name, f'stage="{_label(name)}"', h)
+        lines.append(f"# TYPE {sql_name} histogram")
+        for key, s in sorted(snapshot["statements"].items()):
+            lines += self._histogram(sql_name, f'fingerprint="{_label(key)}"', s)
+        for total in ("rows", "bytes"):
+            lines.append(f"# TYPE {self.prefix}_sql_{total}_total counter")
+            for key, s in sorted(snapshot["statements"].items()):
+                lines.append(
+                    f'{self.prefix}_sql_{total}_total{{fingerprint="{_label(key)}"}} {s[total]}'
+                )
+        return "\n".join(lines) + "\n"
+
+    def export(self, snapshot):
+        self.text = self.render(snapshot)
+        if self.path:
+            with open(f"{self.path}.part", "w") as file:
+                file.write(self.text)
+            os.replace(f"{self.path}.part", self.path)
@@ -0,0 +1,24 @@
+# This file supports deferring imports of heavy dependencies until they are used
+
+import importlib
+import sys
+import types
+
+
+class LazyModule(types.ModuleType):
+    """
+    Stands in for a module and imports it the first time one of its attributes is used
+    """
+
+    def __getattr__(self, attr):
+        module = importlib.import_module(self.__name__)
+        self.__dict__.update(module.__dict__)
+        return getattr(module, attr)
+
+
+def lazy_module(name):
+    """
+    Returns a stand-in for the module called name that imports it on first use, or the module
+    itself if it has already been imported
+    """
+    return sys.modules.get(name) or LazyModule(name)
@@ -0,0 +1,130 @@
+import threading
+import time
+
+import pymysql
+import pytest
+
+from fynesse import access
+
+
+class FakeConnection:
+    def __init__(self, number):
+        self.number = number
+        self.dropped = False
+        self.broken = False
+        self.reconnects = 0
+        self.closed = False
+
+    def ping(self, reconnect=True):
+        if self.broken:
+            raise pymysql.err.OperationalError(2006, "MySQL server has gone away")
+        if self.dropped:
+            assert reconnect
+            self.dropped = False
+            self.reconnects += 1
+
+    def close(self):
+        self.closed = True
+
+
+def fake_pool(size=2):
+    created = []
+
+    def connect():
+        created.append(FakeConnection(len(created)))
+        return created[-1]
+
+    return access.ConnectionPool(connect, size=size), created
+
+
+def test_idle_connection_is_reused():
+    pool, created = fake_pool()
+    with pool.connection() as first:
+        pass
+    with pool.connection() as second:
+        pass
+    assert second is first
+    assert len(created) == 1
+
+
+def test_dropped_connection_is_reconnected_on_checkout():
+    pool, created = fake_pool()
+    with pool.connection() as conn:
+        pass
+    conn.dropped = True
+    with pool.connection() as again:
+        assert again is conn
+        assert not again.dropped
+    assert conn.reconnects == 1
+
+
+def test_connection_that_cannot_reconnect_is_replaced():
+    pool, created = fake_pool()
+    with pool.connection() as conn:
+        pass
+    conn.broken = True
+    with pool.connection() as replacement:
+        assert replacement is not conn
+    assert conn.closed
+    assert len(created) == 2
+
+
+def test_operational_error_discards_connection():
+    pool, created = fake_pool()
+    with pytest.raises(pymysql.err.OperationalError):
+        with pool.connection() as conn:
+            raise pymysql.err.OperationalError(2013, "Lost connection")
+    assert conn.closed
+    with pool.connection() as replacement:
+        assert replacement is not conn
+
+
+def test_reset_closes_idle_and_returned_connections():
+    pool, created = fake_pool()
+    with pool.connection() as borrowed:
+        with pool.connection() as idle:
+            pass
+        pool.reset()
+        assert idle.closed
+        assert not borrowed.closed
+    assert borrowed.closed
+    with pool.connection() as fresh:
+        assert fresh not in (idle, borrowed)
+
+
+def test_pool_size_bounds_concurrency():
+    pool, created = fake_pool(size=3)
+    lock = threading.Lock()
+    active = []
+    peak = []
+
+    def borrow():
+        with pool.connection():
+            with lock:
+                active.append(1)
+                peak.append(len(active))
+            time.sleep(0.02)
+            with lock:
+                active.pop()
+
+    threads = [threading.Thread(target=borrow) for _ in range(12)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert max(peak) == 3
+    assert len(created) == 3
+
+
+def test_map_queries_keeps_order(tmp_path):
+    db = access.LocalDatabase(str(tmp_path / "test.db"), pool_size=3)
+    sqls = [("SELECT %s AS value", (i,)) for i in range(20)] + ["SELECT 20 AS value"]
+    results = db.map_queries(sqls)
+    assert [int(df["value"][0]) for df in results] == list(range(21))
+
+
+@pytest.mark.parametrize("sql", ["", "   \n"])
+def test_empty_sql_raises(tmp_path, sql):
+    db = access.LocalDatabase(str(tmp_path / "test.db"))
+    with pytest.raises(ValueError, match="empty"):
+        db.execute(sql)
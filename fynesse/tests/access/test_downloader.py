@@ -0,0 +1,122 @@
+import http.server
+import json
+import os
+import re
+import threading
+
+import pytest
+
+from fynesse import access
+
+CONTENT = bytes(range(256)) * 400
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    """
+    Serves CONTENT with Range support. With truncate_at set, promises the full length but
+    closes the connection after that many bytes.
+    """
+
+    truncate_at = None
+    ranges = []
+    encodings = []
+
+    def do_GET(self):
+        match = re.fullmatch(r"bytes=(\d+)-", self.headers.get("Range", ""))
+        start = int(match.group(1)) if match else 0
+        type(self).ranges.append(start if match else None)
+        type(self).encodings.append(self.headers.get("Accept-Encoding"))
+        if start >= len(CONTENT):
+            self.send_response(416)
+            self.send_header("Content-Range", f"bytes */{len(CONTENT)}")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = CONTENT[start:]
+        self.send_response(206 if match else 200)
+        if match:
+            self.send_header("Content-Range", f"bytes {start}-{len(CONTENT) - 1}/{len(CONTENT)}")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.truncate_at is not None:
+            self.wfile.write(body[: self.truncate_at])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    Handler.truncate_at = None
+    Handler.ranges = []
+    Handler.encodings = []
+    httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}/data.csv"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def make_downloader(tmp_path):
+    return access.Downloader(
+        manifest_path=str(tmp_path / "manifest.json"), chunk_size=1024, verbose=False
+    )
+
+
+def test_download_and_skip_on_rerun(server, tmp_path):
+    file_path = str(tmp_path / "data.csv")
+    downloader = make_downloader(tmp_path)
+    assert downloader.download(server, file_path) == len(CONTENT)
+    with open(file_path, "rb") as file:
+        assert file.read() == CONTENT
+    with open(tmp_path / "manifest.json") as file:
+        entry = json.load(file)[file_path]
+    assert entry["size"] == len(CONTENT)
+    assert entry["sha256"] == access.file_sha256(file_path)
+
+    assert make_downloader(tmp_path).download(server, file_path) == 0
+    assert Handler.ranges == [None]
+
+
+def test_resumes_part_file_with_range(server, tmp_path):
+    file_path = str(tmp_path / "data.csv")
+    with open(f"{file_path}.part", "wb") as file:
+        file.write(CONTENT[:30000])
+    assert make_downloader(tmp_path).download(server, file_path) == len(CONTENT) - 30000
+    assert Handler.ranges == [30000]
+    assert not os.path.exists(f"{file_path}.part")
+    with open(file_path, "rb") as file:
+        assert file.read() == CONTENT
+
+
+def test_restarts_after_416(server, tmp_path):
+    file_path = str(tmp_path / "data.csv")
+    # A part file longer than the file on the server can't be resumed
+    with open(f"{file_path}.part", "wb") as file:
+        file.write(CONTENT + b"stale")
+    assert make_downloader(tmp_path).download(server, file_path) == len(CONTENT)
+    assert Handler.ranges == [len(CONTENT) + 5, None]
+    with open(file_path, "rb") as file:
+        assert file.read() == CONTENT
+
+
+def test_truncated_download_raises_and_resumes(server, tmp_path):
+    file_path = str(tmp_path / "data.csv")
+    Handler.truncate_at = 40000
+    with pytest.raises(IOError, match="Rerun to resume"):
+        make_downloader(tmp_path).download(server, file_path)
+    assert not os.path.exists(file_path)
+    partial = os.path.getsize(f"{file_path}.part")
+    assert 0 < partial <= 40000
+
+    Handler.truncate_at = None
+    make_downloader(tmp_path).download(server, file_path)
+    assert Handler.ranges == [None, partial]
+    assert Handler.encodings[-1] == "identity"
+    with open(file_path, "rb") as file:
+        assert file.read() == CONTENT
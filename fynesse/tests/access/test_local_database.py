@@ -0,0 +1,42 @@
+import datetime
+
+import pytest
+
+from fynesse import assess, benchmark
+
+
+@pytest.fixture
+def db_towns(tmp_path):
+    return benchmark.synthetic_database(
+        str(tmp_path), rows=1000, postcodes=100, n_towns=1, years=range(2020, 2021)
+    )
+
+
+def test_execute_iter_df_types_columns(db_towns):
+    db, _ = db_towns
+    chunks = list(db.execute_iter_df("SELECT * FROM prices_coordinates_data", chunksize=300))
+    assert len(chunks) == 4
+    dtypes = chunks[0].dtypes
+    assert dtypes["price"] == "int64"
+    assert dtypes["latitude"] == "float64"
+    assert dtypes["longitude"] == "float64"
+    assert dtypes["date_of_transfer"] == "datetime64[ns]"
+    assert dtypes["db_id"] == "int64"
+    assert all((chunk.dtypes == dtypes).all() for chunk in chunks)
+
+
+def test_benchmark_spatial_index(db_towns):
+    db, towns = db_towns
+    db.create_grid_index()
+    report = assess.benchmark_spatial_index(
+        db,
+        towns["latitude"][0],
+        towns["longitude"][0],
+        datetime.date(2020, 1, 1),
+        datetime.date(2021, 1, 1),
+        sizes_km=(1, 5),
+        run=True,
+    )
+    assert list(report["plain_key"]) == ["pcd_date_lat_long_index"] * 2
+    assert list(report["grid_key"]) == ["prices_coordinates_data_grid_date_index"] * 2
+    assert (report["plain_returned"] == report["grid_returned"]).all()
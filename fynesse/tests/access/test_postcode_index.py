@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+
+from fynesse import access, benchmark
+
+
+@pytest.fixture
+def index(tmp_path):
+    postcodes = benchmark.synthetic_postcodes(50, benchmark.synthetic_towns(2))
+    path = str(tmp_path / "open_postcode_geo.csv")
+    benchmark._write_csv(postcodes, path)
+    index = access.PostcodeIndex(str(tmp_path / "postcode_index"))
+    index.build([path])
+    return index, postcodes
+
+
+def test_postcode_keys():
+    keys = access.postcode_keys(["CB2 1TP", "cb21tp", "SW1A 1AA", "E1 6AN", "", None, "X"])
+    assert list(keys) == [b"CB2 1TP", b"CB2 1TP", b"SW1A1AA", b"E1  6AN", b"", b"", b""]
+
+
+def test_postcode_keys_non_ascii():
+    keys = access.postcode_keys(["CB2 1TP", "CB2 1TÉ", "CB2-1TP"])
+    assert list(keys) == [b"CB2 1TP", b"", b""]
+
+
+def test_build_and_lookup(index):
+    index, postcodes = index
+    assert len(index) == len(postcodes)
+    sample = postcodes.iloc[[3, 0, 17]]
+    result = index.lookup(sample["postcode"].str.lower().str.replace(" ", ""))
+    assert result["found"].all()
+    np.testing.assert_allclose(result["latitude"], sample["latitude"], atol=1e-4)
+    np.testing.assert_allclose(result["longitude"], sample["longitude"], atol=1e-4)
+    assert list(result["live"]) == list(sample["status"] == "live")
+
+
+def test_lookup_misses_and_invalid_input(index):
+    index, postcodes = index
+    queries = [postcodes["postcode"][0], "ZZ9 9ZZ", "CB2 1TÉ", "", None, "not a postcode"]
+    result = index.lookup(queries)
+    assert list(result["found"]) == [True, False, False, False, False, False]
+    assert result["latitude"][1:].isna().all()
+    assert list(result["postcode"][:4]) == queries[:4]
+
+
+def test_lookup_status(index):
+    index, postcodes = index
+    result = index.lookup(postcodes["postcode"], status="live")
+    assert list(result["found"]) == list(postcodes["status"] == "live")
+    with pytest.raises(ValueError):
+        index.lookup(postcodes["postcode"], status="open")
@@ -0,0 +1,18 @@
+from fynesse import benchmark
+
+
+def test_parallel_refresh_matches_table(tmp_path):
+    db, _ = benchmark.synthetic_database(
+        str(tmp_path), rows=500, postcodes=80, n_towns=2, years=range(2020, 2022)
+    )
+    db.build_price_cube(max_workers=4)
+    (rows, total), = db.execute("SELECT COUNT(*), SUM(price) FROM prices_coordinates_data")
+    (cube_rows, cube_total), = db.execute("SELECT SUM(row_count), SUM(price_sum) FROM price_cube")
+    assert (int(cube_rows), int(cube_total)) == (rows, total)
+    (histogram_rows,), = db.execute("SELECT SUM(row_count) FROM price_cube_histogram")
+    assert int(histogram_rows) == rows
+
+    # Refreshing again without changes leaves every month alone
+    refreshed = db.execute("SELECT month, refreshed_at FROM price_cube_months ORDER BY month")
+    db.build_price_cube(max_workers=4)
+    assert db.execute("SELECT month, refreshed_at FROM price_cube_months ORDER BY month") == refreshed
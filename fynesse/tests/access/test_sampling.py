@@ -0,0 +1,97 @@
+import pandas as pd
+import pytest
+
+from fynesse import benchmark
+
+
+@pytest.fixture(scope="module")
+def db(tmp_path_factory):
+    db, _ = benchmark.synthetic_database(
+        str(tmp_path_factory.mktemp("sampling")),
+        rows=2000,
+        postcodes=100,
+        n_towns=2,
+        years=range(2018, 2022),
+    )
+    return db
+
+
+def columns(db, table):
+    return list(db.execute_to_df(f"SELECT * FROM {table} LIMIT 1").columns)
+
+
+@pytest.mark.parametrize("n", [0, 1, 250])
+def test_sample(db, n):
+    rows = db.sample("pp_data", n, seed=0)
+    assert len(rows) == n
+    assert rows["db_id"].is_unique
+    assert list(rows.columns) == columns(db, "pp_data")
+
+
+def test_sample_more_than_rows(db):
+    rows = db.sample("pp_data", 5000, seed=0)
+    assert len(rows) == 2000
+    assert rows["db_id"].is_unique
+
+
+def test_sample_is_seeded(db):
+    first = db.sample("pp_data", 50, seed=1)
+    assert first["db_id"].tolist() == db.sample("pp_data", 50, seed=1)["db_id"].tolist()
+
+
+@pytest.mark.parametrize("n", [0, 1, 100, 5000])
+def test_reservoir_sample(db, n):
+    rows = db.reservoir_sample("SELECT db_id, price FROM pp_data", n, seed=0, chunksize=300)
+    assert len(rows) == min(n, 2000)
+    assert rows["db_id"].is_unique
+    assert list(rows.columns) == ["db_id", "price"]
+
+
+def test_reservoir_sample_by(db):
+    rows = db.reservoir_sample(
+        "SELECT db_id, property_type FROM pp_data",
+        {"D": 10, "F": 3},
+        seed=0,
+        by="property_type",
+        chunksize=300,
+    )
+    counts = rows["property_type"].astype(str).value_counts()
+    assert counts.to_dict() == {"D": 10, "F": 3}
+    assert rows["db_id"].is_unique
+
+
+def year_counts(db):
+    counts = db.execute_to_df(
+        "SELECT YEAR(date_of_transfer) AS year, COUNT(*) AS row_count FROM pp_data GROUP BY year"
+    )
+    return dict(zip(counts["year"].astype(int), counts["row_count"].astype(int)))
+
+
+def sample_years(rows):
+    return pd.to_datetime(rows["date_of_transfer"]).dt.year.value_counts().to_dict()
+
+
+def test_stratified_sample_proportional(db):
+    counts = year_counts(db)
+    rows = db.stratified_sample("pp_data", 200, "year", seed=0)
+    assert len(rows) == 200
+    assert rows["db_id"].is_unique
+    total = sum(counts.values())
+    for year, size in sample_years(rows).items():
+        assert abs(size - 200 * counts[year] / total) < 1
+
+
+def test_stratified_sample_equal(db):
+    rows = db.stratified_sample("pp_data", 200, "year", seed=0, allocation="equal")
+    assert sample_years(rows) == {year: 50 for year in year_counts(db)}
+
+
+def test_stratified_sample_more_than_rows(db):
+    rows = db.stratified_sample("pp_data", 5000, "property_type", seed=0)
+    assert len(rows) == 2000
+
+
+def test_stratified_sample_empty(db):
+    rows = db.stratified_sample("pp_data", 0, "year", seed=0)
+    assert rows.empty
+    assert list(rows.columns) == columns(db, "pp_data")
@@ -0,0 +1,54 @@
+import pandas as pd
+import pytest
+
+from fynesse import access
+
+
+@pytest.fixture
+def db(tmp_path):
+    db = access.LocalDatabase(str(tmp_path / "test.db"))
+    db.execute("CREATE TABLE items (db_id INTEGER PRIMARY KEY, name VARCHAR(20), price INT)")
+    return db
+
+
+def test_quote_identifier():
+    assert access.quote_identifier("pp_data") == "`pp_data`"
+    assert access.quote_identifier("year") == "`year`"
+
+
+@pytest.mark.parametrize("name", ["pp`data", "x` ; DROP TABLE pp_data; --", "`"])
+def test_quote_identifier_rejects_backticks(name):
+    with pytest.raises(ValueError):
+        access.quote_identifier(name)
+
+
+def test_in_clause():
+    assert access.in_clause("`a`", (1, "x")) == ("`a` IN (%s, %s)", [1, "x"])
+
+
+def test_executemany_and_select_in(db):
+    rows = [(i, f"item {i}", i * 10) for i in range(1, 26)]
+    insert = "INSERT INTO items (db_id, name, price) VALUES (%s, %s, %s)"
+    db.executemany(insert, rows)
+    # Values are bound, so quotes in them are data
+    db.executemany(insert, [(26, "o'brien", 1)])
+
+    found = db.select_in("items", "name", ["item 3", "o'brien", "item 3", "missing"])
+    assert sorted(found["db_id"]) == [3, 26]
+
+    found = db.select_in("items", "db_id", list(range(0, 30)), columns=["db_id"], batch_size=7)
+    assert sorted(found["db_id"]) == list(range(1, 27))
+    assert list(found.columns) == ["db_id"]
+
+
+def test_select_in_empty(db):
+    empty = db.select_in("items", "db_id", [])
+    assert isinstance(empty, pd.DataFrame)
+    assert empty.empty
+    assert list(empty.columns) == ["db_id", "name", "price"]
+    assert list(db.select_in("items", "db_id", [], columns=["name"]).columns) == ["name"]
+
+
+def test_select_in_rejects_backtick_identifiers(db):
+    with pytest.raises(ValueError):
+        db.select_in("items", "db_id`", [1])
@@ -0,0 +1,56 @@
+import pymysql
+import pytest
+
+from fynesse import access
+
+
+@pytest.fixture
+def db():
+    db = access.LocalDatabase(":memory:")
+    db.execute("CREATE TABLE t (x int)")
+    return db
+
+
+def test_deadlocked_transaction_is_rolled_back_and_retried(db):
+    attempts = []
+
+    def work(cur):
+        attempts.append(len(attempts))
+        cur.execute("INSERT INTO t (x) VALUES (%s)", (len(attempts),))
+        if len(attempts) == 1:
+            raise pymysql.err.OperationalError(1213, "Deadlock found when trying to get lock")
+        return "done"
+
+    assert db._run_transaction(work, read_committed=True) == "done"
+    assert len(attempts) == 2
+    assert db.execute("SELECT x FROM t") == [(2,)]
+
+
+def test_other_errors_are_not_retried(db):
+    attempts = []
+
+    def work(cur):
+        attempts.append(1)
+        cur.execute("INSERT INTO t (x) VALUES (1)")
+        raise pymysql.err.OperationalError(1146, "Table doesn't exist")
+
+    with pytest.raises(pymysql.err.OperationalError):
+        db._run_transaction(work)
+    assert len(attempts) == 1
+    assert db.execute("SELECT x FROM t") == []
+
+
+def test_build_prices_coordinates_data_replaces_unchecked_rows(tmp_path):
+    from fynesse import benchmark
+
+    db, _ = benchmark.synthetic_database(
+        str(tmp_path), rows=300, postcodes=60, n_towns=2, years=range(2020, 2022)
+    )
+    rows = db.execute("SELECT COUNT(*) FROM prices_coordinates_data")[0][0]
+    # Rows for 2021 without a checkpoint, as left by loading the csv files
+    db.execute(
+        "DELETE FROM build_checkpoints WHERE table_name = %s AND part = %s",
+        args=("prices_coordinates_data", "2021"),
+    )
+    db.build_prices_coordinates_data(years=range(2020, 2022), max_workers=2)
+    assert db.execute("SELECT COUNT(*) FROM prices_coordinates_data")[0][0] == rows
@@ -0,0 +1,69 @@
+import pytest
+
+from fynesse import access, benchmark
+
+
+@pytest.fixture
+def db(tmp_path):
+    db, _ = benchmark.synthetic_database(
+        str(tmp_path), rows=300, postcodes=60, n_towns=2, years=range(2020, 2021)
+    )
+    return db
+
+
+def write_changes(tmp_path, name, df):
+    path = str(tmp_path / name)
+    benchmark._write_csv(df, path)
+    return path
+
+
+def twin(row, identifier):
+    """
+    Returns a transaction identical to row of pp_data other than its identifier
+    """
+    return row.assign(transaction_unique_identifier=identifier, record_status="A")
+
+
+def count_like(db, row):
+    sql = """
+        SELECT COUNT(*) FROM prices_coordinates_data
+        WHERE date_of_transfer = %s AND postcode = %s AND price = %s
+        """
+    args = (row["date_of_transfer"].iloc[0][:10], row["postcode"].iloc[0], int(row["price"].iloc[0]))
+    return db.execute(sql, args=args)[0][0]
+
+
+def pp_row(db):
+    df = db.execute_to_df(f"SELECT {', '.join(access.PP_COLUMNS)} FROM pp_data LIMIT 1")
+    df["date_of_transfer"] = df["date_of_transfer"].astype(str).str[:10]
+    df["price"] = df["price"].astype(int)
+    return df
+
+
+def test_delete_removes_one_of_identical_transactions(db, tmp_path):
+    row = pp_row(db)
+    total = db.execute("SELECT COUNT(*) FROM prices_coordinates_data")[0][0]
+    db.update_pp_data(file_path=write_changes(tmp_path, "add.csv", twin(row, "{TWIN}")))
+    assert count_like(db, row) == 2
+
+    removal = twin(row, "{TWIN}").assign(record_status="D")
+    db.update_pp_data(file_path=write_changes(tmp_path, "delete.csv", removal))
+    assert db.execute("SELECT COUNT(*) FROM pp_data WHERE transaction_unique_identifier = %s", args=("{TWIN}",))[0][0] == 0
+    assert count_like(db, row) == 1
+    assert db.execute("SELECT COUNT(*) FROM prices_coordinates_data")[0][0] == total
+
+
+def test_change_replaces_only_its_own_row(db, tmp_path):
+    row = pp_row(db)
+    db.update_pp_data(file_path=write_changes(tmp_path, "add.csv", twin(row, "{TWIN}")))
+    change = twin(row, "{TWIN}").assign(record_status="C", price=row["price"] + 1)
+    db.update_pp_data(file_path=write_changes(tmp_path, "change.csv", change))
+    assert count_like(db, row) == 1
+    assert count_like(db, change) == 1
+
+
+def test_applied_file_is_skipped(db, tmp_path, capsys):
+    path = write_changes(tmp_path, "add.csv", twin(pp_row(db), "{TWIN}"))
+    db.update_pp_data(file_path=path)
+    db.update_pp_data(file_path=path)
+    assert "already been applied" in capsys.readouterr().out
@@ -0,0 +1,69 @@
+import os
+import subprocess
+import sys
+
+from fynesse import benchmark
+
+
+def test_estimate_price_does_not_import_plotting():
+    loaded, ok = benchmark.check_compute_imports(verbose=False)
+    assert loaded == []
+    assert ok
+
+
+def test_check_compute_imports_reports_loaded_modules():
+    loaded, ok = benchmark.check_compute_imports(excluded=["geopandas", "matplotlib"], verbose=False)
+    assert loaded == ["geopandas"]
+    assert not ok
+
+
+# Runs estimate_price on a cold POI cache that fetches with assess.fetch_pois, whose osmnx
+# request is stubbed once osmnx has been imported, and prints the matplotlib backend
+_COLD_FETCH_SCRIPT = """
+import datetime, importlib, sys, tempfile
+import matplotlib
+from fynesse import address, assess, benchmark
+
+headless_osmnx = assess._headless_osmnx
+
+
+def stubbed_osmnx():
+    headless_osmnx()
+    ox = importlib.import_module("osmnx")
+    ox.features_from_bbox = benchmark.stub_fetch_pois(pois)
+    return ox
+
+
+assess._headless_osmnx = stubbed_osmnx
+with tempfile.TemporaryDirectory() as data_dir:
+    db, towns = benchmark.synthetic_database(
+        data_dir, rows=2000, n_towns=1, years=range(2019, 2021)
+    )
+    pois = benchmark.synthetic_pois(500, towns)
+    with benchmark.offline(data_dir, pois):
+        assess.poi_cache.fetch = assess.fetch_pois
+        address.estimate_price(
+            db, towns["latitude"][0], towns["longitude"][0], datetime.date(2019, 6, 1), "F"
+        )
+print("osmnx" in sys.modules, matplotlib.get_backend(auto_select=False))
+"""
+
+
+def cold_fetch(env):
+    output = subprocess.run(
+        [sys.executable, "-c", _COLD_FETCH_SCRIPT],
+        capture_output=True,
+        text=True,
+        check=True,
+        env=env,
+    ).stdout
+    return output.strip().splitlines()[-1]
+
+
+def test_cold_cache_fetch_uses_agg_backend():
+    env = {name: value for name, value in os.environ.items() if name != "MPLBACKEND"}
+    assert cold_fetch(env).lower() == "true agg"
+
+
+def test_cold_cache_fetch_keeps_chosen_backend():
+    assert cold_fetch({**os.environ, "MPLBACKEND": "svg"}).lower() == "true svg"
@@ -0,0 +1,82 @@
+import datetime
+import os
+
+import numpy as np
+
+from fynesse import address, assess, benchmark
+
+
+def test_warm_prediction_reuses_engine_and_tree(tmp_path, monkeypatch):
+    db, towns = benchmark.synthetic_database(
+        str(tmp_path), rows=3000, postcodes=300, n_towns=1, years=range(2019, 2021)
+    )
+    pois = benchmark.synthetic_pois(2000, towns)
+    date = datetime.date(2020, 3, 1)
+    latitude, longitude = towns["latitude"][0], towns["longitude"][0]
+    with benchmark.offline(str(tmp_path), pois):
+        registry = address.ModelRegistry(str(tmp_path / "registry"))
+        cold = address.predict_price(db, latitude, longitude, date, "D", registry=registry)
+
+        # Count POI loads and BallTree builds from here on
+        calls = []
+        get_pois = assess.get_pois_from_bbox
+        ball_tree = assess.neighbors.BallTree
+
+        def counted(func):
+            def wrapper(*args, **kwargs):
+                calls.append(func)
+                return func(*args, **kwargs)
+
+            return wrapper
+
+        monkeypatch.setattr(assess, "get_pois_from_bbox", counted(get_pois))
+        monkeypatch.setattr(assess.neighbors, "BallTree", counted(ball_tree))
+        warm = address.predict_price(db, latitude, longitude, date, "D", registry=registry)
+
+    assert np.allclose(cold, warm)
+    assert calls == []
+    assert registry.stats()["engines"] == 1
+
+
+def test_region_missing_a_feature_is_skipped(tmp_path):
+    db, towns = benchmark.synthetic_database(
+        str(tmp_path), rows=3000, postcodes=300, n_towns=2, years=range(2019, 2021)
+    )
+    pois = benchmark.synthetic_pois(2000, towns)
+    # No parks around the first town, so its park distances are all missing
+    town = (pois.index.get_level_values("osmid") - 1) % 2
+    pois = pois[(pois["leisure"] != "park") | (town == 1)]
+    requests_df = towns[["latitude", "longitude"]].assign(
+        date=datetime.date(2020, 3, 1), property_type="D"
+    )
+    with benchmark.offline(str(tmp_path), pois):
+        result = address.predict_prices(db, requests_df, registry=False)
+
+    assert np.isnan(result["mean"][0])
+    assert result["mean"][1] > 0
+
+
+def test_models_are_dropped_when_tables_change(tmp_path):
+    db, towns = benchmark.synthetic_database(
+        str(tmp_path), rows=3000, postcodes=300, n_towns=1, years=range(2019, 2021)
+    )
+    (tmp_path / "other").mkdir()
+    other, _ = benchmark.synthetic_database(
+        str(tmp_path / "other"), rows=3000, postcodes=300, n_towns=1, years=range(2019, 2021)
+    )
+    date = datetime.date(2020, 3, 1)
+    latitude, longitude = towns["latitude"][0], towns["longitude"][0]
+    with benchmark.offline(str(tmp_path), benchmark.synthetic_pois(2000, towns)):
+        registry = address.model_registry
+        address.predict_price(db, latitude, longitude, date, "D")
+        address.predict_price(other, latitude, longitude, date, "D")
+        assert registry.stats()["entries"] == 2
+        assert len(os.listdir(registry.cache_dir)) == 2
+
+        db.create_grid_index()
+        assert registry.stats()["entries"] == 1
+        assert len(os.listdir(registry.cache_dir)) == 1
+        assert registry.stats()["engines"] == 2
+
+        address.predict_price(db, latitude, longitude, date, "D")
+        assert registry.stats()["misses"] == 3
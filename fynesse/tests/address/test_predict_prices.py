@@ -0,0 +1,46 @@
+import datetime
+
+import numpy as np
+import pandas as pd
+
+from fynesse import address, benchmark
+
+
+def test_grouped_predictions_equal_per_request(tmp_path):
+    db, towns = benchmark.synthetic_database(
+        str(tmp_path), rows=4000, postcodes=400, n_towns=2, years=range(2019, 2021)
+    )
+    rng = np.random.default_rng(0)
+    n = 12
+    town = np.arange(n) % 2
+    requests_df = pd.DataFrame(
+        {
+            "latitude": towns["latitude"].to_numpy()[town] + rng.normal(0, 0.02, n),
+            "longitude": towns["longitude"].to_numpy()[town] + rng.normal(0, 0.03, n),
+            "date": [
+                datetime.date(2019, 6, 1) + datetime.timedelta(int(days))
+                for days in rng.integers(0, 200, n)
+            ],
+            "property_type": rng.choice(["D", "S", "T", "F"], n),
+        },
+        index=pd.RangeIndex(100, 100 + n),
+    )
+    with benchmark.offline(str(tmp_path), benchmark.synthetic_pois(2000, towns)):
+        grouped = address.predict_prices(
+            db, requests_df, registry=address.ModelRegistry(str(tmp_path / "grouped"))
+        )
+        registry = address.ModelRegistry(str(tmp_path / "single"))
+        single = [
+            address.predict_price(
+                db, row.latitude, row.longitude, row.date, row.property_type, registry=registry
+            ).iloc[0]
+            for row in requests_df.itertuples()
+        ]
+
+    assert list(grouped.index) == list(requests_df.index)
+    # Requests share models, so there are fewer groups than requests
+    assert registry.stats()["misses"] < n
+    assert grouped["mean"].notna().all()
+    np.testing.assert_allclose(grouped["mean"], single, rtol=1e-9)
+    assert (grouped["obs_ci_lower"] <= grouped["mean"]).all()
+    assert (grouped["mean"] <= grouped["obs_ci_upper"]).all()
@@ -0,0 +1,24 @@
+import datetime
+
+import pytest
+
+from fynesse import address, assess, benchmark
+
+
+@pytest.mark.parametrize("precomputed", [False, True])
+def test_labelled_empty_query_has_feature_columns(tmp_path, precomputed):
+    db, towns = benchmark.synthetic_database(
+        str(tmp_path), rows=500, postcodes=50, n_towns=1, years=range(2020, 2021)
+    )
+    latitude, longitude = towns["latitude"][0], towns["longitude"][0]
+    with benchmark.offline(str(tmp_path), benchmark.synthetic_pois(200, towns)):
+        if precomputed:
+            assess.build_postcode_features(db, assess.postcode_features.path)
+        # No transactions in 2010
+        data = assess.query(
+            db, latitude, longitude, 0.1, datetime.date(2010, 1, 1), datetime.date(2011, 1, 1)
+        )
+        df = assess.labelled(data, latitude, longitude, 0.1)
+
+    assert df.empty
+    assert list(df[address.FEATURES].columns) == address.FEATURES
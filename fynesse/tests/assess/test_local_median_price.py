@@ -0,0 +1,36 @@
+import geopandas as gpd
+import numpy as np
+
+from fynesse import assess
+
+
+def line_gdf(n=30):
+    """
+    n properties evenly spaced along a line, priced 0 to n - 1 in order
+    """
+    return gpd.GeoDataFrame(
+        {"price": np.arange(n, dtype=float)},
+        geometry=gpd.points_from_xy(np.linspace(0, 0.01 * (n - 1), n), np.zeros(n)),
+        crs=4326,
+    )
+
+
+def test_includes_self_by_default():
+    medians = assess.calculate_local_median_price(line_gdf(), k=2)
+    # The point itself and its two neighbours
+    assert medians[10] == 10.0
+
+
+def test_exclude_self_uses_k_others():
+    medians = assess.calculate_local_median_price(line_gdf(), k=2, exclude_self=True)
+    assert medians[10] == 10.0
+    # At the end of the line the two nearest others are both on one side
+    assert medians[0] == 1.5
+
+
+def test_chunked_matches_unchunked():
+    gdf = line_gdf()
+    np.testing.assert_array_equal(
+        assess.calculate_local_median_price(gdf, k=4, exclude_self=True, chunk_size=7),
+        assess.calculate_local_median_price(gdf, k=4, exclude_self=True),
+    )
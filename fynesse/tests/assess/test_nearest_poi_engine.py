@@ -0,0 +1,45 @@
+import numpy as np
+
+from fynesse import assess, benchmark
+
+
+def brute_force(points, pois, poi_key, poi_value):
+    xy = points.geometry.to_crs(crs=3857)
+    selected = pois[pois[poi_key] == poi_value].geometry.to_crs(crs=3857).centroid
+    dx = xy.x.to_numpy()[:, None] - selected.x.to_numpy()[None, :]
+    dy = xy.y.to_numpy()[:, None] - selected.y.to_numpy()[None, :]
+    return np.sqrt(dx**2 + dy**2).min(axis=1)
+
+
+def test_distances_equal_brute_force_minimum():
+    towns = benchmark.synthetic_towns(2)
+    pois = benchmark.synthetic_pois(500, towns)
+    points = assess.convert_df_to_gdf(benchmark.synthetic_postcodes(300, towns))
+    engine = assess.NearestPOIEngine(pois)
+
+    distances = engine.distances(points, assess.LABEL_FEATURES)
+    assert list(distances.index) == list(points.index)
+    for poi_key, poi_values in assess.LABEL_FEATURES.items():
+        for poi_value in poi_values:
+            np.testing.assert_allclose(
+                distances[f"dist_to_nearest_{poi_value}"],
+                brute_force(points, pois, poi_key, poi_value),
+            )
+
+    # Further categories reuse the projected points and add their own tree
+    cafes = engine.distances(points, {"amenity": ["cafe"]})
+    np.testing.assert_allclose(
+        cafes["dist_to_nearest_cafe"], brute_force(points, pois, "amenity", "cafe")
+    )
+    assert len(engine._trees) == 4
+
+
+def test_missing_categories_are_nan():
+    towns = benchmark.synthetic_towns(1)
+    pois = benchmark.synthetic_pois(50, towns)
+    points = assess.convert_df_to_gdf(benchmark.synthetic_postcodes(10, towns))
+    engine = assess.NearestPOIEngine(pois)
+
+    distances = engine.distances(points, {"amenity": ["hospital"], "tourism": ["museum"]})
+    assert distances.isna().all().all()
+    assert engine.distances(points.iloc[:0], assess.LABEL_FEATURES).empty
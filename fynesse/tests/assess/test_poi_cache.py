@@ -0,0 +1,63 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from fynesse import assess, benchmark
+
+
+def make_cache(tmp_path, delay=0.0):
+    """
+    Returns a POICache over synthetic POIs in tmp_path, and the list of bboxes it fetched
+    """
+    towns = benchmark.synthetic_towns(2)
+    pois = benchmark.synthetic_pois(400, towns)
+    stub = benchmark.stub_fetch_pois(pois)
+    calls = []
+    lock = threading.Lock()
+
+    def fetch(north, south, east, west, tags):
+        with lock:
+            calls.append((north, south, east, west))
+        time.sleep(delay)
+        return stub(north, south, east, west, tags)
+
+    cache = assess.POICache(cache_dir=str(tmp_path / "poi_cache"), fetch=fetch)
+    return cache, pois, towns, calls
+
+
+def town_bbox(towns, i=0, half=0.07):
+    lat, lon = towns["latitude"][i], towns["longitude"][i]
+    return lat + half, lat - half, lon + half, lon - half
+
+
+def test_warm_cache_does_not_fetch(tmp_path):
+    cache, _, towns, calls = make_cache(tmp_path)
+    first = cache.get(*town_bbox(towns))
+    assert len(calls) == 1
+    second = cache.get(*town_bbox(towns))
+    assert len(calls) == 1
+    assert sorted(first.index) == sorted(second.index)
+
+
+def test_results_are_clipped_to_bbox(tmp_path):
+    cache, pois, towns, _ = make_cache(tmp_path)
+    north, south, east, west = town_bbox(towns, half=0.03)
+    # Warm a larger area first so the clipped result comes from whole tiles on disk
+    cache.get(*town_bbox(towns, half=0.1))
+    result = cache.get(north, south, east, west)
+    expected = pois.cx[west:east, south:north]
+    assert len(result)
+    assert sorted(result.index) == sorted(expected.index)
+    assert result.geometry.y.between(south, north).all()
+    assert result.geometry.x.between(west, east).all()
+
+
+def test_concurrent_cold_gets(tmp_path):
+    cache, pois, towns, calls = make_cache(tmp_path, delay=0.05)
+    bbox = town_bbox(towns)
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(lambda _: cache.get(*bbox), range(8)))
+    expected = sorted(pois.cx[bbox[3] : bbox[2], bbox[1] : bbox[0]].index)
+    assert all(sorted(result.index) == expected for result in results)
+    # Each tile is fetched once, by whichever call took its lock first
+    assert len(calls) == 1
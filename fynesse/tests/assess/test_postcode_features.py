@@ -0,0 +1,23 @@
+import numpy as np
+
+from fynesse import assess, benchmark
+
+
+def test_build_postcode_features_on_fresh_cache(tmp_path):
+    db, towns = benchmark.synthetic_database(
+        str(tmp_path), rows=2000, postcodes=600, n_towns=3, years=range(2020, 2022)
+    )
+    pois = benchmark.synthetic_pois(600, towns)
+    path = str(tmp_path / "postcode_features.parquet")
+    with benchmark.offline(str(tmp_path), pois):
+        # Small chunks, so neighbouring chunks share the tiles of their margins
+        table = assess.build_postcode_features(db, path, chunk_size=0.05, max_workers=4)
+        features = assess.PostcodeFeatures(path).table()
+
+    assert len(table) == 600
+    assert features.index.is_unique
+    columns = [
+        f"dist_to_nearest_{value}" for values in assess.LABEL_FEATURES.values() for value in values
+    ]
+    assert list(features.columns) == columns
+    assert np.isfinite(features.to_numpy(dtype=float)).any(axis=0).all()
@@ -0,0 +1,89 @@
+import datetime
+
+import numpy as np
+import pytest
+
+from fynesse import access, assess, benchmark
+
+
+@pytest.fixture(scope="module")
+def db(tmp_path_factory):
+    db, _ = benchmark.synthetic_database(
+        str(tmp_path_factory.mktemp("price_cube")),
+        rows=5000,
+        postcodes=200,
+        n_towns=2,
+        years=range(2019, 2021),
+    )
+    db.build_price_cube()
+    return db
+
+
+def transactions(db):
+    df = db.execute_to_df(
+        """
+        SELECT postcode_data.postcode_area AS area, pcd.date_of_transfer, pcd.property_type, pcd.price
+        FROM prices_coordinates_data AS pcd
+        JOIN postcode_data ON postcode_data.postcode = pcd.postcode
+        """
+    )
+    df["date_of_transfer"] = df["date_of_transfer"].astype("datetime64[ns]")
+    df["year"] = df["date_of_transfer"].dt.year
+    return df
+
+
+def test_quantiles_match_exact_within_bucket(db):
+    quantiles = (0.1, 0.25, 0.5, 0.75, 0.9)
+    stats = assess.price_cube_query(db, level="area", period="year", quantiles=quantiles)
+    exact = transactions(db).groupby(["area", "year", "property_type"])["price"]
+    # Quantiles are interpolated within one bucket of log price
+    tolerance = np.exp(1 / access.PRICE_CUBE_RESOLUTION) - 1
+    checked = 0
+    for row in stats.itertuples(index=False):
+        prices = exact.get_group((row.area, int(row.year), row.property_type))
+        assert row.count == len(prices)
+        assert row.mean == pytest.approx(prices.mean())
+        if len(prices) < 50:
+            continue
+        for q in quantiles:
+            estimate = getattr(row, f"p{q * 100:g}")
+            assert estimate == pytest.approx(np.quantile(prices, q), rel=tolerance)
+        checked += 1
+    assert checked >= 10
+
+
+def test_quantiles_without_groups(db):
+    stats = assess.price_cube_query(db, level=None, period=None, by_property_type=False)
+    prices = transactions(db)["price"]
+    assert int(stats["count"][0]) == len(prices)
+    tolerance = np.exp(1 / access.PRICE_CUBE_RESOLUTION) - 1
+    assert stats["p50"][0] == pytest.approx(prices.median(), rel=tolerance)
+
+
+@pytest.mark.parametrize(
+    "start_date, end_date, months",
+    [
+        # Whole months of the range
+        (datetime.date(2019, 3, 1), datetime.date(2019, 5, 1), [3, 4]),
+        # A start within a month includes all of it
+        (datetime.date(2019, 3, 20), datetime.date(2019, 5, 1), [3, 4]),
+        # An end within a month includes all of it, an end on the first day excludes it
+        (datetime.date(2019, 3, 1), datetime.date(2019, 5, 2), [3, 4, 5]),
+        (datetime.date(2019, 3, 31), datetime.date(2019, 4, 1), [3]),
+    ],
+)
+def test_months_included_at_each_end(db, start_date, end_date, months):
+    stats = assess.price_cube_query(
+        db,
+        level=None,
+        by_property_type=False,
+        start_date=start_date,
+        end_date=end_date,
+        quantiles=(),
+    )
+    assert [month.month for month in stats["month"].astype("datetime64[ns]")] == months
+    df = transactions(db)
+    included = df["date_of_transfer"].dt.to_period("M").dt.month.isin(months) & (
+        df["year"] == 2019
+    )
+    assert int(stats["count"].sum()) == included.sum()
@@ -0,0 +1,29 @@
+from fynesse import assess, benchmark
+
+
+def test_profile_refreshes_rows_changed_in_place(tmp_path, capsys):
+    db, _ = benchmark.synthetic_database(
+        str(tmp_path), rows=500, postcodes=50, n_towns=2, years=range(2019, 2021)
+    )
+    profile_path = str(tmp_path / "profile.json")
+    profile = assess.profile_table(db, profile_path=profile_path)
+    assert profile.attrs["row_count"] == 500
+    assert "Profiled prices_coordinates_data for 2019." in capsys.readouterr().out
+
+    # Unchanged years are not rescanned
+    assess.profile_table(db, profile_path=profile_path)
+    assert "Profiled" not in capsys.readouterr().out
+
+    # A change in place keeps the row count
+    db.execute(
+        """
+        UPDATE prices_coordinates_data SET price = 123456789
+        WHERE db_id = (SELECT MIN(db_id) FROM prices_coordinates_data WHERE YEAR(date_of_transfer) = 2020)
+        """
+    )
+    profile = assess.profile_table(db, profile_path=profile_path)
+    out = capsys.readouterr().out
+    assert "Profiled prices_coordinates_data for 2020." in out
+    assert "for 2019." not in out
+    assert profile.loc["price", "max"] == 123456789
+    assert profile.attrs["row_count"] == 500
@@ -0,0 +1,99 @@
+import datetime
+
+from fynesse import assess, benchmark
+
+
+def test_update_pp_data_invalidates_memoized_query(tmp_path, monkeypatch):
+    monkeypatch.setattr(assess, "query_cache", assess.QueryCache())
+    db, towns = benchmark.synthetic_database(
+        str(tmp_path), rows=500, postcodes=50, n_towns=1, years=range(2020, 2021)
+    )
+    latitude, longitude = towns["latitude"][0], towns["longitude"][0]
+    args = (db, latitude, longitude, 1.0, datetime.date(2020, 1, 1), datetime.date(2021, 1, 1))
+    before = assess.query(*args)
+    assert len(assess.query(*args)) == len(before)
+    assert assess.query_cache.hits
+
+    removed = before["postcode"].iloc[0], before["price"].iloc[0]
+    row = db.execute_to_df(
+        "SELECT * FROM pp_data WHERE postcode = %s AND price = %s LIMIT 1", args=removed
+    ).drop(columns="db_id")
+    row["date_of_transfer"] = row["date_of_transfer"].astype(str).str[:10]
+    path = str(tmp_path / "changes.csv")
+    benchmark._write_csv(row.assign(record_status="D"), path)
+    db.update_pp_data(file_path=path)
+
+    assert len(assess.query(*args)) == len(before) - 1
+
+
+def test_clear_drops_only_that_database(tmp_path):
+    cache = assess.QueryCache(cache_dir=str(tmp_path / "query_cache"))
+
+    class Source:
+        def __init__(self, url):
+            self.url = url
+            self.database = "main"
+
+    one, other = Source("one"), Source("other")
+    gdf = assess.convert_df_to_gdf(
+        benchmark.synthetic_postcodes(10, benchmark.synthetic_towns(1)).assign(
+            price=1, date_of_transfer=datetime.date(2020, 6, 1)
+        )
+    )
+    for db in (one, other):
+        cache.put(cache.key(db, 60, 50, 2, -2, "2020-01-01", "2021-01-01"), gdf)
+
+    cache.clear(one)
+    assert cache.get(cache.key(one, 60, 50, 2, -2, "2020-01-01", "2021-01-01")) is None
+    assert cache.get(cache.key(other, 60, 50, 2, -2, "2020-01-01", "2021-01-01")) is not None
+    assert len(list((tmp_path / "query_cache").glob("*.parquet"))) == 1
+
+
+def cached_gdf(rows):
+    return assess.convert_df_to_gdf(
+        benchmark.synthetic_postcodes(rows, benchmark.synthetic_towns(1)).assign(
+            price=1, date_of_transfer=datetime.date(2020, 6, 1)
+        )
+    )
+
+
+def test_memory_is_bounded_by_bytes():
+    gdf = cached_gdf(200)
+    size = int(gdf.memory_usage(deep=True).sum())
+    cache = assess.QueryCache(max_bytes=int(size * 2.5))
+    keys = [cache.key(None, 60, 50, 2 + i, 1 + i, "2020-01-01", "2021-01-01") for i in range(4)]
+    for key in keys:
+        cache.put(key, gdf)
+    assert cache.stats()["entries"] == 2
+    assert cache.stats()["bytes"] == 2 * size
+    assert cache.get(keys[0]) is None
+    assert cache.get(keys[3]) is not None
+
+    # Results larger than max_bytes aren't kept in memory
+    cache.put(keys[0], cached_gdf(1000))
+    assert cache.get(keys[0]) is None
+    assert cache.stats()["bytes"] == 2 * size
+
+    cache.clear()
+    assert cache.stats()["bytes"] == 0
+
+
+def test_streamed_and_fetched_results_are_cached_apart(tmp_path, monkeypatch):
+    monkeypatch.setattr(assess, "query_cache", assess.QueryCache())
+    db, towns = benchmark.synthetic_database(
+        str(tmp_path), rows=500, postcodes=50, n_towns=1, years=range(2020, 2021)
+    )
+    args = (
+        db,
+        towns["latitude"][0],
+        towns["longitude"][0],
+        1.0,
+        datetime.date(2020, 1, 1),
+        datetime.date(2021, 1, 1),
+    )
+    uncached_fetched = assess.query(*args, cache=False).dtypes
+    uncached_streamed = assess.query(*args, chunksize=100, cache=False).dtypes
+    for _ in range(2):
+        assert assess.query(*args).dtypes.equals(uncached_fetched)
+        assert assess.query(*args, chunksize=100).dtypes.equals(uncached_streamed)
+    assert assess.query_cache.stats()["hits"] == 2
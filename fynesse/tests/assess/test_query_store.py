@@ -0,0 +1,40 @@
+import datetime
+
+import pandas as pd
+import pytest
+
+from fynesse import access, assess, benchmark
+
+COLUMNS = ["price", "date_of_transfer", "postcode", "property_type", "latitude", "longitude"]
+
+
+def rows(gdf):
+    df = pd.DataFrame(gdf[COLUMNS])
+    df["date_of_transfer"] = pd.to_datetime(df["date_of_transfer"])
+    df["property_type"] = df["property_type"].astype(str)
+    return df.sort_values(COLUMNS, ignore_index=True)
+
+
+@pytest.mark.parametrize(
+    "start_date, end_date, bbox_length",
+    [
+        (datetime.date(2019, 1, 1), datetime.date(2021, 1, 1), 0.2),
+        (datetime.date(2019, 3, 15), datetime.date(2020, 2, 10), 0.05),
+    ],
+)
+def test_query_store_equals_query(tmp_path, monkeypatch, start_date, end_date, bbox_length):
+    # The per-year csv files behind the store are written under data/
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "data").mkdir()
+    db, towns = benchmark.synthetic_database(
+        str(tmp_path), rows=3000, postcodes=200, n_towns=2, years=range(2019, 2021)
+    )
+    db.create_prices_coordinates_data(bulk=True)
+    store_path = str(tmp_path / "store")
+    access.create_prices_coordinates_store(store_path, years=range(2019, 2021), row_group_size=100)
+
+    args = (towns["latitude"][0], towns["longitude"][0], bbox_length, start_date, end_date)
+    expected = assess.query(db, *args, cache=False)
+    stored = assess.query_store(*args, store_path=store_path)
+    assert len(expected) > 0
+    pd.testing.assert_frame_equal(rows(stored), rows(expected), check_dtype=False)
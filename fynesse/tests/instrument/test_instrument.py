@@ -0,0 +1,151 @@
+import json
+import re
+import sqlite3
+
+import pytest
+
+from fynesse import instrument
+
+
+@pytest.fixture
+def recorder(monkeypatch):
+    recorder = instrument.Recorder()
+    recorder.enabled = True
+    monkeypatch.setattr(instrument, "recorder", recorder)
+    return recorder
+
+
+def test_histogram_bucket_counts():
+    h = instrument.Histogram(bounds=(1, 2, 4, float("inf")))
+    for value in (0.5, 1, 1.5, 2, 3, 10):
+        h.observe(value)
+    # Bounds are inclusive upper bounds
+    assert h.counts == [2, 2, 1, 1]
+    assert h.count == 6
+    assert h.sum == pytest.approx(18)
+
+
+def test_histogram_quantiles():
+    h = instrument.Histogram(bounds=(1, 2, 4, float("inf")))
+    assert h.quantile(0.5) is None
+    for value in (0.5, 1.5, 1.5, 3):
+        h.observe(value)
+    # Interpolated linearly within the bucket the quantile falls in
+    assert h.quantile(0.25) == pytest.approx(1.0)
+    assert h.quantile(0.5) == pytest.approx(1.5)
+    assert h.quantile(1.0) == pytest.approx(4.0)
+    h.observe(100)
+    # The overflow bucket has no upper bound, so its quantiles are its lower bound
+    assert h.quantile(1.0) == 4
+
+
+def test_histogram_to_dict():
+    h = instrument.Histogram(bounds=(1, float("inf")))
+    h.observe(0.5)
+    h.observe(5)
+    d = h.to_dict()
+    assert d["buckets"] == [[1, 1], ["+Inf", 1]]
+    assert (d["count"], d["sum"]) == (2, 5.5)
+    json.dumps(d)
+
+
+def test_fingerprint():
+    assert instrument.fingerprint(
+        "SELECT *  FROM t\n WHERE a = 'x' AND b IN (%s, %s, %s) AND c > 10"
+    ) == "SELECT * FROM t WHERE a = ? AND b IN (...) AND c > ?"
+
+
+def test_nested_stages(recorder):
+    @instrument.stage("outer")
+    def outer():
+        for _ in range(2):
+            with instrument.stage("inner"):
+                pass
+
+    outer()
+    outer()
+    assert recorder.stages["outer"].count == 2
+    assert recorder.stages["inner"].count == 4
+    assert recorder.stages["outer"].sum >= recorder.stages["inner"].sum
+
+
+def test_stage_records_on_exception(recorder):
+    @instrument.stage("failing")
+    def failing():
+        raise ValueError
+
+    with pytest.raises(ValueError):
+        failing()
+    assert recorder.stages["failing"].count == 1
+
+
+def test_disabled_records_nothing(recorder):
+    recorder.enabled = False
+    with instrument.stage("quiet"):
+        pass
+    instrument.stage("quiet")(lambda: None)()
+    assert recorder.stages == {}
+
+
+def test_instrumented_cursor(recorder):
+    conn = sqlite3.connect(":memory:")
+    cur = instrument.InstrumentedCursor(conn.cursor())
+    cur.execute("CREATE TABLE t (a INTEGER, b TEXT)", ())
+    cur.executemany("INSERT INTO t VALUES (?, ?)", [(i, "xy") for i in range(5)])
+    cur.execute("SELECT a, b FROM t WHERE a < 3", ())
+    assert len(cur.fetchall()) == 3
+    cur.execute("SELECT a, b FROM t WHERE a < 4", ())
+    cur.fetchmany(2)
+    cur.fetchmany(2)
+    cur.close()
+
+    statements = recorder.snapshot()["statements"]
+    select = statements["SELECT a, b FROM t WHERE a < ?"]
+    assert select["count"] == 2
+    assert select["rows"] == 3 + 4
+    assert select["bytes"] == (3 + 4) * (8 + 2)
+    assert statements["INSERT INTO t VALUES (?, ?)"]["count"] == 1
+
+
+def snapshot():
+    recorder = instrument.Recorder()
+    recorder.observe_stage("assess.query", 0.003)
+    recorder.observe_stage("assess.query", 0.2)
+    recorder.observe_statement('SELECT * FROM t WHERE a = "q"', 0.002, rows=10, size=80)
+    return recorder.snapshot()
+
+
+def test_prometheus_exposition_format():
+    text = instrument.PrometheusExporter(prefix="test").render(snapshot())
+    lines = text.splitlines()
+    assert text.endswith("\n")
+    assert lines[0] == "# TYPE test_stage_seconds histogram"
+    sample = re.compile(r'^[a-zA-Z_:][a-zA-Z0-9_:]*\{([a-z_]+="(?:[^"\\]|\\.)*",?)+\} \S+$')
+    for line in lines:
+        assert line.startswith("# TYPE ") or sample.match(line), line
+
+    prefix = 'test_stage_seconds_bucket{stage="assess.query"'
+    buckets = [line for line in lines if line.startswith(prefix)]
+    assert len(buckets) == len(instrument.LATENCY_BUCKETS)
+    counts = [int(line.rsplit(" ", 1)[1]) for line in buckets]
+    # Buckets are cumulative, ending with +Inf at the total count
+    assert counts == sorted(counts)
+    assert buckets[-1] == 'test_stage_seconds_bucket{stage="assess.query",le="+Inf"} 2'
+    assert 'test_stage_seconds_bucket{stage="assess.query",le="0.005"} 1' in lines
+    assert 'test_stage_seconds_count{stage="assess.query"} 2' in lines
+    assert 'test_sql_rows_total{fingerprint="SELECT * FROM t WHERE a = \\"q\\""} 10' in lines
+    assert "# TYPE test_sql_bytes_total counter" in lines
+
+
+def test_prometheus_and_json_exporters_write_files(tmp_path, recorder):
+    recorder.observe_stage("stage", 0.1)
+    prometheus = instrument.PrometheusExporter(path=str(tmp_path / "metrics.prom"))
+    json_exporter = instrument.JSONExporter(str(tmp_path / "out" / "instrumentation.json"))
+    lines = []
+    recorder.exporters = [prometheus, json_exporter, instrument.LogExporter(lines.append)]
+    recorder.export()
+
+    assert (tmp_path / "metrics.prom").read_text() == prometheus.text
+    with open(tmp_path / "out" / "instrumentation.json") as file:
+        assert json.load(file)["stages"]["stage"]["count"] == 1
+    assert lines and lines[0].startswith("stage stage: 1 calls")